@@ -0,0 +1,78 @@
+"""Add bundle search table
+
+Revision ID: 2b5c7e91d0a4
+Revises: 3fe0e77de7a4
+Create Date: 2016-04-18 15:12:40.518342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b5c7e91d0a4'
+down_revision = '3fe0e77de7a4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# The tables as of this revision (later ones may add columns).
+bundle = sa.table(
+    'bundle',
+    sa.column('uuid', sa.String),
+)
+bundle_metadata = sa.table(
+    'bundle_metadata',
+    sa.column('bundle_uuid', sa.String),
+    sa.column('metadata_key', sa.String),
+    sa.column('metadata_value', sa.Text),
+)
+bundle_search = sa.table(
+    'bundle_search',
+    sa.column('bundle_uuid', sa.String),
+    sa.column('name', sa.String),
+    sa.column('created', sa.Integer),
+    sa.column('data_size', sa.BigInteger),
+    sa.column('time', sa.Float),
+    sa.column('memory', sa.Float),
+    sa.column('job_handle', sa.String),
+    sa.column('description', sa.Text),
+)
+# Metadata key => function converting its value to the type of its column.
+SEARCH_KEYS = {
+    'name': unicode,
+    'created': int,
+    'data_size': int,
+    'time': float,
+    'memory': float,
+    'job_handle': unicode,
+    'description': unicode,
+}
+
+
+def upgrade():
+    # bundle_search automatically added, but it needs to be populated from the
+    # existing metadata.
+    connection = op.get_bind()
+    connection.execute(bundle_search.delete())
+    values = dict(
+        (row.uuid, dict(dict.fromkeys(SEARCH_KEYS), bundle_uuid=row.uuid))
+        for row in connection.execute(sa.select([bundle.c.uuid]))
+    )
+    rows = connection.execute(sa.select([
+        bundle_metadata.c.bundle_uuid,
+        bundle_metadata.c.metadata_key,
+        bundle_metadata.c.metadata_value,
+    ]).where(bundle_metadata.c.metadata_key.in_(SEARCH_KEYS.keys())))
+    for row in rows:
+        if row.bundle_uuid not in values:
+            continue
+        key = str(row.metadata_key)
+        try:
+            values[row.bundle_uuid][key] = SEARCH_KEYS[key](row.metadata_value)
+        except (TypeError, ValueError):
+            pass  # Left NULL
+    if values:
+        connection.execute(bundle_search.insert(), values.values())
+
+
+def downgrade():
+    op.drop_table('bundle_search')
@@ -0,0 +1,68 @@
+"""Add search token table
+
+Revision ID: 8d3a1f6c2e57
+Revises: 2b5c7e91d0a4
+Create Date: 2016-04-20 11:03:27.861194
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d3a1f6c2e57'
+down_revision = '2b5c7e91d0a4'
+
+from alembic import op
+import sqlalchemy as sa
+
+from codalab.model.util import get_search_tokens
+
+
+# The tables as of this revision (later ones may add columns).
+bundle_search = sa.table(
+    'bundle_search',
+    sa.column('bundle_uuid', sa.String),
+    sa.column('name', sa.String),
+    sa.column('description', sa.Text),
+)
+search_token = sa.table(
+    'search_token',
+    sa.column('object_type', sa.String),
+    sa.column('object_uuid', sa.String),
+    sa.column('token', sa.String),
+)
+worksheet = sa.table(
+    'worksheet',
+    sa.column('uuid', sa.String),
+    sa.column('name', sa.String),
+)
+
+
+def upgrade():
+    # search_token automatically added, but it needs to be populated.
+    connection = op.get_bind()
+    connection.execute(search_token.delete())
+    rows = connection.execute(sa.select([
+        bundle_search.c.bundle_uuid,
+        bundle_search.c.name,
+        bundle_search.c.description,
+    ])).fetchall()
+    for row in rows:
+        insert_tokens(connection, 'bundle', row.bundle_uuid, [row.bundle_uuid, row.name, row.description])
+    rows = connection.execute(sa.select([
+        worksheet.c.uuid,
+        worksheet.c.name,
+    ])).fetchall()
+    for row in rows:
+        insert_tokens(connection, 'worksheet', row.uuid, [row.uuid, row.name])
+
+
+def insert_tokens(connection, object_type, object_uuid, strings):
+    values = [
+        {'object_type': object_type, 'object_uuid': object_uuid, 'token': token}
+        for token in get_search_tokens(*strings)
+    ]
+    if values:
+        connection.execute(search_token.insert(), values)
+
+
+def downgrade():
+    op.drop_table('search_token')
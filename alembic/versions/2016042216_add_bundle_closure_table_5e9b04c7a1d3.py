@@ -0,0 +1,48 @@
+"""Add bundle closure table
+
+Revision ID: 5e9b04c7a1d3
+Revises: 8d3a1f6c2e57
+Create Date: 2016-04-22 16:41:09.273518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e9b04c7a1d3'
+down_revision = '8d3a1f6c2e57'
+
+import collections
+
+from alembic import op
+import sqlalchemy as sa
+
+from codalab.model.tables import (
+    bundle_closure as cl_bundle_closure,
+    bundle_dependency as cl_bundle_dependency,
+)
+from codalab.model.util import compute_ancestors
+
+
+def upgrade():
+    # bundle_closure automatically added, but it needs to be computed from the
+    # existing dependencies.
+    connection = op.get_bind()
+    connection.execute(cl_bundle_closure.delete())
+    parents = collections.defaultdict(set)
+    rows = connection.execute(sa.select([
+        cl_bundle_dependency.c.child_uuid,
+        cl_bundle_dependency.c.parent_uuid,
+    ]))
+    for row in rows:
+        parents[row.child_uuid].add(row.parent_uuid)
+    ancestors = compute_ancestors(parents.keys(), parents, {})
+    values = [
+        {'ancestor_uuid': ancestor_uuid, 'descendant_uuid': uuid, 'depth': depth}
+        for (uuid, l) in ancestors.iteritems()
+        for (ancestor_uuid, depth) in l.iteritems()
+    ]
+    if values:
+        connection.execute(cl_bundle_closure.insert(), values)
+
+
+def downgrade():
+    op.drop_table('bundle_closure')
@@ -0,0 +1,22 @@
+"""Add bundle version
+
+Revision ID: 7c1e4d2b9f38
+Revises: 5e9b04c7a1d3
+Create Date: 2016-04-26 14:12:45.520836
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c1e4d2b9f38'
+down_revision = '5e9b04c7a1d3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('bundle', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('bundle', 'version')
@@ -0,0 +1,48 @@
+"""Add event rollup tables
+
+Revision ID: 3f8a6b0d2c14
+Revises: 7c1e4d2b9f38
+Create Date: 2016-04-28 17:25:03.114592
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f8a6b0d2c14'
+down_revision = '7c1e4d2b9f38'
+
+from alembic import op
+import sqlalchemy as sa
+
+from codalab.model.tables import (
+    event as cl_event,
+    event_command_rollup as cl_event_command_rollup,
+    event_user_rollup as cl_event_user_rollup,
+)
+
+
+def upgrade():
+    # event_user_rollup and event_command_rollup automatically added, but they
+    # need to be computed from the existing events.
+    connection = op.get_bind()
+    for (table, columns) in [
+        # Anonymous events are rolled up under empty (rather than NULL) users.
+        (cl_event_user_rollup, [
+            cl_event.c.date,
+            sa.func.coalesce(cl_event.c.user_id, '').label('user_id'),
+            sa.func.coalesce(cl_event.c.user_name, '').label('user_name'),
+        ]),
+        (cl_event_command_rollup, [cl_event.c.date, cl_event.c.command]),
+    ]:
+        connection.execute(table.delete())
+        rows = connection.execute(sa.select(columns + [
+            sa.func.count(cl_event.c.id).label('count'),
+            sa.func.sum(cl_event.c.duration).label('duration'),
+        ]).group_by(*columns)).fetchall()
+        values = [dict(row) for row in rows]
+        if values:
+            connection.execute(table.insert(), values)
+
+
+def downgrade():
+    op.drop_table('event_command_rollup')
+    op.drop_table('event_user_rollup')
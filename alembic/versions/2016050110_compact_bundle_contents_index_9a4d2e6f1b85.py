@@ -0,0 +1,66 @@
+"""Store the bundle contents index in compressed chunks
+
+Revision ID: 9a4d2e6f1b85
+Revises: 3f8a6b0d2c14
+Create Date: 2016-05-01 10:12:47.503216
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9a4d2e6f1b85'
+down_revision = '3f8a6b0d2c14'
+
+from alembic import op
+import sqlalchemy as sa
+
+from codalab.model.contents_index import make_chunks, entry_key, split_path
+from codalab.model.tables import bundle_contents_chunk as cl_bundle_contents_chunk
+
+old_bundle_contents_index = sa.table(
+    'bundle_contents_index',
+    sa.column('bundle_uuid'),
+    sa.column('path'),
+    sa.column('type'),
+    sa.column('size'),
+    sa.column('perm'),
+    sa.column('link'),
+)
+
+
+def upgrade():
+    # bundle_contents_chunk automatically added, convert the old rows (one per
+    # file, with paths like '/', '/a', '/a/b') to it one bundle at a time,
+    # sorted by their keys (depth first, see entry_key).
+    connection = op.get_bind()
+    uuids = [row.bundle_uuid for row in connection.execute(
+        sa.select([sa.distinct(old_bundle_contents_index.c.bundle_uuid)])
+    ).fetchall()]
+    for uuid in uuids:
+        rows = connection.execute(
+            old_bundle_contents_index.select()
+                .where(old_bundle_contents_index.c.bundle_uuid == uuid)
+        ).fetchall()
+        entries = []
+        for row in rows:
+            parent, name = split_path(row.path.strip('/'))
+            entries.append([parent, name, row.type, row.size, row.perm, row.link])
+        entries.sort(key=lambda entry: entry_key(entry[0], entry[1]))
+        chunks = make_chunks(entries)
+        for chunk in chunks:
+            chunk['bundle_uuid'] = uuid
+        connection.execute(cl_bundle_contents_chunk.insert(), chunks)
+    op.drop_table('bundle_contents_index')
+
+
+def downgrade():
+    # The contents of the old index are not restored.
+    op.create_table('bundle_contents_index',
+        sa.Column('bundle_uuid', sa.String(length=63), sa.ForeignKey('bundle.uuid'), nullable=False),
+        sa.Column('path', sa.Text(), nullable=False),
+        sa.Column('type', sa.String(length=63), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('perm', sa.Integer(), nullable=False),
+        sa.Column('link', sa.Text(), nullable=True),
+    )
+    op.create_index('bundle_uuid_index', 'bundle_contents_index', ['bundle_uuid'], mysql_length=63)
+    op.drop_table('bundle_contents_chunk')
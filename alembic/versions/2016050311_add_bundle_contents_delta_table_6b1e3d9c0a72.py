@@ -0,0 +1,23 @@
+"""Add bundle_contents_delta table
+
+Revision ID: 6b1e3d9c0a72
+Revises: 9a4d2e6f1b85
+Create Date: 2016-05-03 11:08:55.216473
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b1e3d9c0a72'
+down_revision = '9a4d2e6f1b85'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # bundle_contents_delta automatically added.
+    pass
+
+
+def downgrade():
+    op.drop_table('bundle_contents_delta')
@@ -0,0 +1,26 @@
+"""Index worksheet items by sort key
+
+Revision ID: 4e7a0c2d8b19
+Revises: 6b1e3d9c0a72
+Create Date: 2016-05-04 18:31:09.647125
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e7a0c2d8b19'
+down_revision = '6b1e3d9c0a72'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Items appended one at a time used to have no sort key (meaning their id).
+    # Set it, so that items can be fetched in order of (sort_key, id).
+    op.execute("UPDATE worksheet_item SET sort_key = id WHERE sort_key IS NULL")
+    op.create_index('worksheet_item_worksheet_uuid_sort_key_index', 'worksheet_item',
+                    ['worksheet_uuid', 'sort_key', 'id'])
+
+
+def downgrade():
+    op.drop_index('worksheet_item_worksheet_uuid_sort_key_index', 'worksheet_item')
@@ -43,6 +43,7 @@ from codalab.objects.permission import (
     check_bundles_have_all_permission,
     check_worksheet_has_read_permission,
     check_worksheet_has_all_permission,
+    get_permission_resolver,
     parse_permission,
     permission_str,
     Group
@@ -88,6 +89,9 @@ class LocalBundleClient(BundleClient):
         user = self._current_user()
         return user.name if user else None
 
+    def _permissions(self):
+        return get_permission_resolver(self.model, self._current_user())
+
     def _bundle_to_bundle_info(self, bundle):
         """
         Helper: Convert bundle to bundle_info.
@@ -157,6 +161,10 @@ class LocalBundleClient(BundleClient):
         keywords = self.resolve_owner_in_keywords(keywords)
         return self.model.search_bundle_uuids(self._current_user_id(), worksheet_uuid, keywords)
 
+    def search_bundle_uuids_page(self, worksheet_uuid, keywords):
+        keywords = self.resolve_owner_in_keywords(keywords)
+        return self.model.search_bundle_uuids_page(self._current_user_id(), worksheet_uuid, keywords)
+
     def get_worksheet_uuid(self, base_worksheet_uuid, worksheet_spec):
         """
         Return the uuid of the specified worksheet if it exists.
@@ -268,7 +276,7 @@ class LocalBundleClient(BundleClient):
         self.upload_manager.update_metadata_and_save(bundle, new_bundle=True)
 
         # Inherit properties of worksheet
-        self._bundle_inherit_workheet_permissions(bundle.uuid, worksheet_uuid)
+        self._bundle_inherit_workheet_permissions([bundle.uuid], worksheet_uuid)
 
         # Add to worksheet
         if add_to_worksheet:
@@ -298,19 +306,28 @@ class LocalBundleClient(BundleClient):
         Helper function that creates the bundle but doesn't add it to the worksheet.
         Returns the uuid.
         """
-        bundle_subclass = get_bundle_subclass(bundle_type)
-        self.validate_user_metadata(bundle_subclass, metadata)
-        owner_id = self._current_user_id()
-        bundle = bundle_subclass.construct(targets=targets, command=command, metadata=metadata, owner_id=owner_id)
+        bundle = self._construct_derived_bundle(bundle_type, targets, command, metadata)
         self.model.save_bundle(bundle)
         # Inherit properties of worksheet
-        self._bundle_inherit_workheet_permissions(bundle.uuid, worksheet_uuid)
+        self._bundle_inherit_workheet_permissions([bundle.uuid], worksheet_uuid)
         return bundle.uuid
 
-    def _bundle_inherit_workheet_permissions(self, bundle_uuid, worksheet_uuid):
-        group_permissions = self.model.get_group_worksheet_permissions(self._current_user_id(), worksheet_uuid)
+    def _construct_derived_bundle(self, bundle_type, targets, command, metadata):
+        """
+        Helper function that constructs a new make or run bundle without saving it
+        (so that many of them can be saved at once with save_bundles).
+        """
+        bundle_subclass = get_bundle_subclass(bundle_type)
+        self.validate_user_metadata(bundle_subclass, metadata)
+        owner_id = self._current_user_id()
+        return bundle_subclass.construct(targets=targets, command=command, metadata=metadata, owner_id=owner_id)
+
+    def _bundle_inherit_workheet_permissions(self, bundle_uuids, worksheet_uuid):
+        if not bundle_uuids:
+            return
+        group_permissions = self._permissions().get_group_worksheet_permissions([worksheet_uuid])[worksheet_uuid]
         for permissions in group_permissions:
-            self.set_bundles_perm([bundle_uuid], permissions['group_uuid'], permission_str(permissions['permission']))
+            self.set_bundles_perm(bundle_uuids, permissions['group_uuid'], permission_str(permissions['permission']))
 
     @authentication_required
     def kill_bundles(self, bundle_uuids):
@@ -344,6 +361,7 @@ class LocalBundleClient(BundleClient):
         for bundle_uuid in bundle_uuids:
             bundle = self.model.get_bundle(bundle_uuid)
             self.model.update_bundle(bundle, {'owner_id': user_id})
+        self._permissions().invalidate()
 
     @authentication_required
     def update_bundle_metadata(self, uuid, metadata):
@@ -359,6 +377,8 @@ class LocalBundleClient(BundleClient):
         If |force|, allow deletion of bundles that have descendants or that appear across multiple worksheets.
         If |recursive|, add all bundles downstream too.
         If |data_only|, only remove from the bundle store, not the bundle metadata.
+        Return the bundles deleted, descendants first: they are deleted in that
+        order, in chunks, so if this is interrupted, it can just be run again.
         """
         relevant_uuids = self.model.get_self_and_descendants(uuids, depth=sys.maxint)
         uuids_set = set(uuids)
@@ -372,7 +392,11 @@ class LocalBundleClient(BundleClient):
                   '\n  '.join(bundle.simple_str() for bundle in relevant),
                 ))
             relevant_uuids = uuids
-        check_bundles_have_all_permission(self.model, self._current_user(), relevant_uuids)
+        descendant_counts = self.model.count_descendants(relevant_uuids)
+        relevant_uuids = sorted(relevant_uuids, key=lambda uuid: descendant_counts[uuid])
+        chunk_size = self.model.DELETE_CHUNK_SIZE
+        for i in range(0, len(relevant_uuids), chunk_size):
+            check_bundles_have_all_permission(self.model, self._current_user(), relevant_uuids[i:i + chunk_size])
 
         # Make sure we don't delete bundles which are active.
         if not force:
@@ -384,9 +408,14 @@ class LocalBundleClient(BundleClient):
 
         # Make sure that bundles are not referenced in multiple places (otherwise, it's very dangerous)
         result = self.model.get_host_worksheet_uuids(relevant_uuids)
+        all_host_worksheet_uuids = set(uuid for host_worksheet_uuids in result.values() for uuid in host_worksheet_uuids)
+        worksheets = {}
+        if all_host_worksheet_uuids:
+            worksheets = {worksheet.uuid: worksheet for worksheet in self.model.batch_get_worksheets(
+                fetch_items=False, uuid=list(all_host_worksheet_uuids))}
         for uuid, host_worksheet_uuids in result.items():
-            worksheets = self.model.batch_get_worksheets(fetch_items=False, uuid=host_worksheet_uuids)
-            frozen_worksheets = [worksheet for worksheet in worksheets if worksheet.frozen]
+            host_worksheets = [worksheets[worksheet_uuid] for worksheet_uuid in host_worksheet_uuids if worksheet_uuid in worksheets]
+            frozen_worksheets = [worksheet for worksheet in host_worksheets if worksheet.frozen]
             if len(frozen_worksheets) > 0:
                 raise UsageError("Can't delete bundle %s because it appears in frozen worksheets "
                                  "(need to delete worksheet first):\n  %s" %
@@ -394,31 +423,27 @@ class LocalBundleClient(BundleClient):
             if not force and len(host_worksheet_uuids) > 1:
                 raise UsageError("Can't delete bundle %s because it appears in multiple worksheets "
                                  "(--force to override):\n  %s" %
-                                 (uuid, '\n  '.join(worksheet.simple_str() for worksheet in worksheets)))
-
-        # Get data hashes
-        relevant_data_hashes = set(bundle.data_hash
-                                   for bundle in self.model.batch_get_bundles(uuid=relevant_uuids)
-                                   if bundle.data_hash)
-
-        # Delete the actual bundle
-        if not dry_run:
-            if data_only:
-                # Just remove references to the data hashes
-                self.model.remove_data_hash_references(relevant_uuids)
-            else:
-                # Actually delete the bundle
-                self.model.delete_bundles(relevant_uuids)
-
-            # Update user statistics
-            self.model.update_user_disk_used(self._current_user_id())
-
-        # Delete the data_hash
-        for uuid in relevant_uuids_set:
-            # check first is needs to be deleted
-            bundle_location = self.bundle_store.get_bundle_location(uuid)
-            if os.path.lexists(bundle_location):
-                self.bundle_store.cleanup(uuid, dry_run)
+                                 (uuid, '\n  '.join(worksheet.simple_str() for worksheet in host_worksheets)))
+
+        for i in range(0, len(relevant_uuids), chunk_size):
+            chunk = relevant_uuids[i:i + chunk_size]
+            # Delete the actual bundle
+            if not dry_run:
+                if data_only:
+                    # Just remove references to the data hashes
+                    self.model.remove_data_hash_references(chunk)
+                else:
+                    # Actually delete the bundle
+                    self.model.delete_bundles(chunk)
+
+            # Delete the data_hash
+            for uuid in chunk:
+                # check first is needs to be deleted
+                bundle_location = self.bundle_store.get_bundle_location(uuid)
+                if os.path.lexists(bundle_location):
+                    self.bundle_store.cleanup(uuid, dry_run)
+            if not dry_run and len(relevant_uuids) > chunk_size:
+                print >>sys.stderr, 'delete_bundles: %d/%d bundles deleted' % (i + len(chunk), len(relevant_uuids))
 
         return relevant_uuids
 
@@ -436,12 +461,13 @@ class LocalBundleClient(BundleClient):
         bundle_dict = {bundle.uuid: self._bundle_to_bundle_info(bundle) for bundle in bundles}
 
         # Filter out bundles that we don't have read permission on
+        resolver = self._permissions()
         def select_unreadable_bundles(uuids):
-            permissions = self.model.get_user_bundle_permissions(self._current_user_id(), uuids, self.model.get_bundle_owner_ids(uuids))
+            permissions = resolver.get_bundle_permissions(uuids)
             return [uuid for uuid, permission in permissions.items() if permission < GROUP_OBJECT_PERMISSION_READ]
 
         def select_unreadable_worksheets(uuids):
-            permissions = self.model.get_user_worksheet_permissions(self._current_user_id(), uuids, self.model.get_worksheet_owner_ids(uuids))
+            permissions = resolver.get_worksheet_permissions(uuids)
             return [uuid for uuid, permission in permissions.items() if permission < GROUP_OBJECT_PERMISSION_READ]
 
         # Mask bundles that we can't access
@@ -487,8 +513,8 @@ class LocalBundleClient(BundleClient):
 
         if get_permissions:
             # Fill the info
-            group_result = self.model.batch_get_group_bundle_permissions(self._current_user_id(), uuids)
-            result = self.model.get_user_bundle_permissions(self._current_user_id(), uuids, self.model.get_bundle_owner_ids(uuids))
+            group_result = resolver.get_group_bundle_permissions(uuids)
+            result = resolver.get_bundle_permissions(uuids)
             for uuid, info in bundle_dict.items():
                 info['group_permissions'] = group_result[uuid]
                 info['permission'] = result[uuid]
@@ -606,23 +632,16 @@ class LocalBundleClient(BundleClient):
         # If old_output is given, look at ancestors of old_output until we
         # reached some depth.  If it's not given, we first get all the
         # descendants first, and then get their ancestors.
-        infos = {}  # uuid -> bundle info
         if old_output:
             bundle_uuids = [old_output]
         else:
             bundle_uuids = self.model.get_self_and_descendants(old_inputs, depth=depth)
-        all_bundle_uuids = list(bundle_uuids) # should be infos.keys() in order
-        for _ in range(depth):
-            new_bundle_uuids = []
-            for bundle_uuid in bundle_uuids:
-                if bundle_uuid in infos: continue  # Already visited
-                info = infos[bundle_uuid] = self.get_bundle_info(bundle_uuid)
-                for dep in info['dependencies']:
-                    parent_uuid = dep['parent_uuid']
-                    if parent_uuid not in infos:
-                        new_bundle_uuids.append(parent_uuid)
-            all_bundle_uuids = new_bundle_uuids + all_bundle_uuids
-            bundle_uuids = new_bundle_uuids
+        # Ancestors (farthest first) followed by the bundles themselves.
+        ancestors = self.model.get_ancestors(bundle_uuids, depth - 1)
+        for uuid in bundle_uuids:
+            ancestors.pop(uuid, None)
+        all_bundle_uuids = sorted(ancestors, key=lambda uuid: (-ancestors[uuid], uuid)) + list(bundle_uuids)
+        infos = self.get_bundle_infos(all_bundle_uuids) if depth > 0 else {}  # uuid -> bundle info
 
         # Make sure we have read access to all the bundles involved here.
         check_bundles_have_read_permission(self.model, self._current_user(), list(infos.keys()))
@@ -631,6 +650,7 @@ class LocalBundleClient(BundleClient):
         old_to_new = {}  # old_uuid -> new_uuid
         downstream = set()  # old_uuid -> whether we're downstream of an input (and actually needs to be mapped onto a new uuid)
         created_uuids = set()  # set of uuids which were newly created
+        new_bundles = []  # bundles to create, saved all at once at the end
         plan = []  # sequence of (old, new) bundle infos to make
         for old, new in zip(old_inputs, new_inputs):
             old_to_new[old] = new
@@ -683,8 +703,10 @@ class LocalBundleClient(BundleClient):
                 else:
                     if new_info['bundle_type'] not in ('make', 'run'):
                         raise UsageError('Can\'t mimic %s since it is not make or run' % old_bundle_uuid)
-                    new_bundle_uuid = self._derive_bundle(new_info['bundle_type'], \
-                        targets, new_info['command'], new_metadata, worksheet_uuid)
+                    new_bundle = self._construct_derived_bundle(new_info['bundle_type'], \
+                        targets, new_info['command'], new_metadata)
+                    new_bundles.append(new_bundle)
+                    new_bundle_uuid = new_bundle.uuid
 
                 new_info['uuid'] = new_bundle_uuid
                 plan.append((info, new_info))
@@ -704,6 +726,11 @@ class LocalBundleClient(BundleClient):
             for uuid in all_bundle_uuids:
                 recurse(uuid)
 
+        # Save the new bundles
+        if not dry_run:
+            self.model.save_bundles(new_bundles)
+            self._bundle_inherit_workheet_permissions([bundle.uuid for bundle in new_bundles], worksheet_uuid)
+
         # Add to worksheet
         if not dry_run:
             if shadow:
@@ -847,6 +874,12 @@ class LocalBundleClient(BundleClient):
         self._set_owner_names(results)
         return results
 
+    def search_worksheets_page(self, keywords):
+        keywords = self.resolve_owner_in_keywords(keywords)
+        page = self.model.search_worksheets_page(self._current_user_id(), keywords)
+        self._set_owner_names(page['worksheets'])
+        return page
+
     def _set_owner_names(self, results):
         """
         Helper function: Set owner_name given owner_id of each item in results.
@@ -873,14 +906,28 @@ class LocalBundleClient(BundleClient):
         # Note that these group_permissions is universal and permissions are relative to the current user.
         # Need to make another database query.
         if fetch_permission:
-            result['group_permissions'] = self.model.get_group_worksheet_permissions(
-                self._current_user_id(), worksheet.uuid)
-            result['permission'] = self.model.get_user_worksheet_permissions(
-                self._current_user_id(), [worksheet.uuid], {worksheet.uuid: worksheet.owner_id}
+            resolver = self._permissions()
+            result['group_permissions'] = resolver.get_group_worksheet_permissions([worksheet.uuid])[worksheet.uuid]
+            result['permission'] = resolver.get_worksheet_permissions(
+                [worksheet.uuid], {worksheet.uuid: worksheet.owner_id}
             )[worksheet.uuid]
 
         return result
 
+    def get_worksheet_items_page(self, uuid, after=None, limit=None):
+        """
+        Return {'items': ..., 'next': ...}, where items are up to limit items of
+        the worksheet (in the same format as those of get_worksheet_info),
+        starting after the page that ended with the continuation token after,
+        and next is the continuation token for the next page, or None if there
+        are no more. Used to load large worksheets incrementally.
+        """
+        worksheet = self.model.get_worksheet(uuid, fetch_items=False)
+        check_worksheet_has_read_permission(self.model, self._current_user(), worksheet)
+        page = self.model.get_worksheet_items(uuid, after, limit)
+        items = [(item['bundle_uuid'], item['subworksheet_uuid'], item['value'], item['type']) for item in page['items']]
+        return {'items': self._convert_items_from_db(items), 'next': page['next']}
+
     def _user_id_to_name(self, user_id):
         return self._user_id_to_names([user_id])[0]
 
@@ -986,6 +1033,8 @@ class LocalBundleClient(BundleClient):
             else:
                 raise UsageError('Unknown key: %s' % key)
         self.model.update_worksheet_metadata(worksheet, metadata)
+        if 'owner_id' in metadata:
+            self._permissions().invalidate()
 
     @authentication_required
     def delete_worksheet(self, uuid, force):
@@ -1145,6 +1194,7 @@ class LocalBundleClient(BundleClient):
     def rm_group(self, group_spec):
         group_info = self._get_group_info(group_spec, need_admin=True)
         self.model.delete_group(group_info['uuid'])
+        self._permissions().invalidate()
         return group_info
 
     @authentication_required
@@ -1215,6 +1265,7 @@ class LocalBundleClient(BundleClient):
         else:
             member = self.model.add_user_in_group(user_info['id'], group_info['uuid'], is_admin)
             member['operation'] = 'Added'
+        self._permissions().invalidate()
         member['name'] = user_info['name']
         return member
 
@@ -1232,6 +1283,7 @@ class LocalBundleClient(BundleClient):
         if len(members) > 0:
             member = members[0]
             self.model.delete_user_in_group(user_info['id'], group_info['uuid'])
+            self._permissions().invalidate()
             member['name'] = user_info['name']
             return member
         return None
@@ -1255,6 +1307,7 @@ class LocalBundleClient(BundleClient):
             else:
                 if old_permission > 0:
                     self.model.delete_bundle_permission(group_info['uuid'], bundle_uuid)
+        self._permissions().invalidate()
 
         return {'group_info': group_info, 'permission': new_permission}
 
@@ -1277,6 +1330,7 @@ class LocalBundleClient(BundleClient):
         else:
             if old_permission > 0:
                 self.model.delete_worksheet_permission(group_info['uuid'], worksheet.uuid)
+        self._permissions().invalidate()
         return {'worksheet': {'uuid': worksheet.uuid, 'name': worksheet.name},
                 'group_info': group_info,
                 'permission': new_permission}
@@ -1306,6 +1360,26 @@ class LocalBundleClient(BundleClient):
     def get_events_log_info(self, query_info, offset, limit):
         return self.model.get_events_log_info(query_info, offset, limit)
 
+    def get_model_stats(self, reset=False):
+        """
+        Return the statistics recorded by the model instrumentation (see
+        ModelInstrumentation.get_stats), or None if the model isn't
+        instrumented, along with the statistics of the bundle cache.
+        If |reset|, start recording from scratch afterwards.
+        Only the root user can do this.
+        """
+        if self._current_user_id() != self.model.root_user_id:
+            raise PermissionError('Only the root user can get the model statistics.')
+        result = {
+            'instrumentation': None,
+            'bundle_cache': self.model.get_bundle_cache_stats(),
+        }
+        if self.model.instrumentation is not None:
+            result['instrumentation'] = self.model.instrumentation.get_stats()
+            if reset:
+                self.model.instrumentation.reset()
+        return result
+
     def get_user_info(self, user_id, fetch_extra=False):
         if user_id is None:
             user_id = self._current_user_id()
@@ -83,6 +83,7 @@ class RemoteBundleClient(BundleClient):
       'chown_bundles',
       'get_bundle_uuids',
       'search_bundle_uuids',
+      'search_bundle_uuids_page',
       'get_bundle_info',
       'get_bundle_infos',
       'get_target_info',
@@ -92,6 +93,8 @@ class RemoteBundleClient(BundleClient):
       'new_worksheet',
       'list_worksheets',
       'search_worksheets',
+      'search_worksheets_page',
+      'get_worksheet_items_page',
       'get_worksheet_uuid',
       'get_worksheet_info',
       'add_worksheet_item',
@@ -104,6 +107,7 @@ class RemoteBundleClient(BundleClient):
       'login',
       'get_user_info',
       'update_user_info',
+      'get_model_stats',
       # Commands related to groups and permissions.
       'list_groups',
       'new_group',
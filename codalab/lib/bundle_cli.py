@@ -144,6 +144,8 @@ OTHER_COMMANDS = (
     'bs-rm-partition',
     'bs-ls-partitions',
     'bs-health-check',
+    'reconcile-disk-used',
+    'model-stats',
 )
 
 
@@ -2249,7 +2251,7 @@ class BundleCLI(object):
             Commands.Argument('-o', '--offset', help='Offset in the result list.', type=int, default=0),
             Commands.Argument('-l', '--limit', help='Limit in the result list.', type=int, default=20),
             Commands.Argument('-n', '--count', help='Just count.', action='store_true'),
-            Commands.Argument('-g', '--group-by', help='Group by this field (e.g., date).'),
+            Commands.Argument('-g', '--group-by', help='Group by this field (user, command, uuid or date) and print the number and total duration of the events in each group.'),
         ),
     )
     def do_events_command(self, args):
@@ -2382,11 +2384,84 @@ class BundleCLI(object):
             Commands.Argument('-f', '--force', help='Perform all garbage collection and database updates instead of just printing what would happen', action='store_true'),
             Commands.Argument('-d', '--data-hash', help='Compute the digest for every bundle and compare against data_hash for consistency', action='store_true'),
             Commands.Argument('-r', '--repair', help='When used with --force and --data-hash, repairs incorrect data_hash in existing bundles', action='store_true'),
+            Commands.Argument('-v', '--verify', help='When used with --data-hash, reads every file instead of trusting the file hashes cached for each partition', action='store_true'),
         ),
     )
     def do_bs_health_check(self, args):
         print >> sys.stderr, 'Performing Health Check...'
-        self.manager.bundle_store().health_check(self.manager.current_client().model, args.force, args.data_hash, args.repair)
+        self.manager.bundle_store().health_check(self.manager.current_client().model, args.force, args.data_hash, args.repair, args.verify)
+
+    @Commands.command(
+        'reconcile-disk-used',
+        help='Recompute the disk used by each user from scratch and correct any drift in the recorded values (local only). Run periodically. Performs a dry run by default, use -f to apply the corrections.',
+        arguments=(
+            Commands.Argument('-u', '--user-id', help='Only reconcile this user.'),
+            Commands.Argument('-f', '--force', help='Correct the recorded values instead of just printing them.', action='store_true'),
+        ),
+    )
+    def do_reconcile_disk_used_command(self, args):
+        self._fail_if_headless('reconcile-disk-used')
+        self._fail_if_not_local('reconcile-disk-used')
+        client = self.manager.current_client()
+        user_ids = [args.user_id] if args.user_id else None
+        drifted = client.model.reconcile_user_disk_used(user_ids, dry_run=not args.force)
+        for user_id, recorded, actual in drifted:
+            print >>self.stdout, '%s\t%s\t%s' % (user_id, formatting.size_str(recorded), formatting.size_str(actual))
+        print >>self.stdout, '%d user(s) %s' % (len(drifted), 'corrected' if args.force else 'need correction')
+
+    @Commands.command(
+        'model-stats',
+        help='Print the number, time and SQL statements of the model calls made by the server since it started (root only), slowest first.',
+        arguments=(
+            Commands.Argument('-r', '--requests', help='Print the requests (commands and REST routes) instead of the model methods.', action='store_true'),
+            Commands.Argument('--request', help='Print the model methods called by this request.'),
+            Commands.Argument('-l', '--limit', help='Print at most this many rows.', type=int, default=20),
+            Commands.Argument('--reset', help='Start recording from scratch afterwards.', action='store_true'),
+        ),
+    )
+    def do_model_stats_command(self, args):
+        client = self.manager.current_client()
+        stats = client.get_model_stats(args.reset)
+        cache_stats = stats['bundle_cache']
+        print >>self.stdout, 'Bundle cache: %d/%d bundles, %d hits, %d misses' % (
+            cache_stats['size'], cache_stats['capacity'], cache_stats['hits'], cache_stats['misses'])
+        stats = stats['instrumentation']
+        if stats is None:
+            print >>self.stdout, 'The model is not instrumented.'
+            return
+        if args.request:
+            if args.request not in stats['requests']:
+                raise UsageError('No calls recorded for request %s' % args.request)
+            calls = stats['requests'][args.request].get('methods', {})
+        elif args.requests:
+            calls = stats['requests']
+        else:
+            calls = stats['methods']
+
+        def ms(seconds):
+            return '%.1f' % (seconds * 1000) if seconds is not None else None
+
+        rows = []
+        for name, call_stats in calls.iteritems():
+            time_stats = call_stats['time']
+            num_calls = call_stats['calls']
+            rows.append({
+                'name': name,
+                'calls': num_calls,
+                'total_ms': ms(time_stats['total']),
+                'mean_ms': ms(time_stats['mean']),
+                'p50_ms': ms(time_stats['p50']),
+                'p99_ms': ms(time_stats['p99']),
+                'max_ms': ms(time_stats['max']),
+                'sql/call': '%.1f' % (float(call_stats['statements']) / num_calls),
+                'rows/call': '%.1f' % (float(call_stats['rows']) / num_calls),
+                'errors': call_stats['errors'],
+                'total': time_stats['total'],
+            })
+        rows.sort(key=lambda row: row['total'], reverse=True)
+        print >>self.stdout, 'Since %s:' % formatting.date_str(stats['start_time'])
+        columns = ('name', 'calls', 'total_ms', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms', 'sql/call', 'rows/call', 'errors')
+        self.print_table(columns, rows[:args.limit], justify=dict((column, 1) for column in columns[1:]))
 
     def _fail_if_headless(self, message):
         if self.headless:
@@ -1,10 +1,13 @@
 import os
 import re
+import stat
 import sys
 
 from .hash_ring import HashRing
 
-from codalab.lib import path_util, spec_util
+from codalab.lib import copy_util, crypt_util, path_util, spec_util
+from codalab.lib.dedup_index import DedupIndex
+from codalab.lib.hash_cache import FileHashCache
 from codalab.common import State
 
 
@@ -86,15 +89,25 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
     A MultiDiskBundleStore is responsible for taking a set of locations and load-balancing the placement of
     bundle data between the locations. It accomplishes this goal using a consistent hash ring, a technique
     discovered by Karger et al. in 1997.
+
+    If |deduplicate| is True, bundles with the same data_hash on the same partition share their files (see
+    deduplicate). |hash_threads| is the number of files hashed at a time when computing data hashes (see
+    path_util.hash_files_contents), HASH_THREADS if None.
     """
 
     # Location where MultiDiskBundleStore data and temp data is kept relative to CODALAB_HOME
     DATA_SUBDIRECTORY = 'bundles'
     TEMP_SUBDIRECTORY = 'temp'
     MISC_TEMP_SUBDIRECTORY = 'misc_temp' # BundleServer writes out to here, so should have a different name
+    # Cache of the hashes of the files of the partition (see hash_cache.py), relative to the partition
+    HASH_CACHE_FILE = 'file_hashes.sqlite'
+    # Bundles of the partition that share their files (see dedup_index.py), relative to the partition
+    DEDUP_INDEX_FILE = 'shared_data.sqlite'
 
-    def __init__(self, codalab_home):
+    def __init__(self, codalab_home, deduplicate=False, hash_threads=None):
         self.codalab_home = path_util.normalize(codalab_home)
+        self.deduplicate_bundles = deduplicate
+        self.hash_threads = hash_threads
 
         self.partitions = os.path.join(self.codalab_home, 'partitions')
         self.mtemp = os.path.join(self.codalab_home, MultiDiskBundleStore.MISC_TEMP_SUBDIRECTORY)
@@ -151,6 +164,9 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
 
         self.ring.add_node(new_partition_name)  # Add the node to the partition locations
         delete_on_success = []  # Paths to bundles that will be deleted after the copy finishes successfully
+        relocations = dict()  # Partition -> {bundle: new partition path}
+        # Keep the files shared by bundles shared (see deduplicate).
+        copier = copy_util.TreeCopier(preserve_hardlinks=True)
 
         print >> sys.stderr, "Marking bundles for placement on new partition %s (might take a while)" % new_partition_name
         # For each bundle in the bundle store, check to see if any hash to the new partition. If so move them over
@@ -165,8 +181,9 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
                     from_path = os.path.join(self.partitions, partition, MultiDiskBundleStore.DATA_SUBDIRECTORY, bundle)
                     to_path = os.path.join(mtemp, bundle)
                     print >> sys.stderr, "copying %s to %s" % (from_path, to_path)
-                    path_util.copy(from_path, to_path)
+                    path_util.copy(from_path, to_path, copier=copier)
                     delete_on_success += [from_path]
+                    relocations.setdefault(partition, {})[bundle] = target
 
         print >> sys.stderr, "Adding new partition as %s..." % new_partition_location
         path_util.soft_link(target, new_partition_location)
@@ -176,6 +193,8 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
         new_mtemp = os.path.join(new_partition_location, MultiDiskBundleStore.TEMP_SUBDIRECTORY)
         path_util.rename(new_mtemp, new_mdata)
         path_util.make_directory(new_mtemp)
+        for partition, partition_relocations in relocations.iteritems():
+            self._move_dedup_references(os.path.join(self.partitions, partition), partition_relocations)
 
         # Go through and purge all of the originals at this time
         print >> sys.stderr, "Cleaning up drives..."
@@ -236,26 +255,34 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
             new_partition = self.ring.get_node(bundle)
             relocations[bundle] = os.path.join(self.partitions, new_partition)
 
-        # Copy all bundles off of the old partition to temp directories on the new partition
-        for bundle, partition in relocations.iteritems():
+        # Copy all bundles off of the old partition to temp directories on the new partition, keeping the files shared
+        # by bundles shared on each new partition (see deduplicate).
+        copiers = dict()
+        for bundle, new_partition_path in relocations.iteritems():
             # temporary directory on the partition
-            temp_dir = os.path.join(partition, MultiDiskBundleStore.TEMP_SUBDIRECTORY)
+            temp_dir = os.path.join(new_partition_path, MultiDiskBundleStore.TEMP_SUBDIRECTORY)
             from_path = os.path.join(old_mdata, bundle)
             to_path = os.path.join(temp_dir, 'stage-%s' % bundle)
-            path_util.copy(from_path, to_path)
+            if new_partition_path not in copiers:
+                copiers[new_partition_path] = copy_util.TreeCopier(preserve_hardlinks=True)
+            path_util.copy(from_path, to_path, copier=copiers[new_partition_path])
 
         # Now that each bundle is on the proper partition, move each from the staging area to the
         # production mdata/ subdirectory on its partition.
-        for bundle, partition in relocations.iteritems():
-            temp_dir = os.path.join(partition, MultiDiskBundleStore.TEMP_SUBDIRECTORY)
+        for bundle, new_partition_path in relocations.iteritems():
+            temp_dir = os.path.join(new_partition_path, MultiDiskBundleStore.TEMP_SUBDIRECTORY)
             from_path = os.path.join(temp_dir, 'stage-%s' % bundle)
-            to_path = os.path.join(partition, MultiDiskBundleStore.DATA_SUBDIRECTORY, bundle)
+            to_path = os.path.join(new_partition_path, MultiDiskBundleStore.DATA_SUBDIRECTORY, bundle)
             path_util.rename(from_path, to_path)
+        self._move_dedup_references(partition_abs_path, relocations)
 
         # Remove data from partition and unlink from CodaLab
         print >> sys.stderr, "Cleaning bundles off of partition..."
         path_util.remove(old_mdata)
         path_util.remove(old_mtemp)
+        for file_name in [MultiDiskBundleStore.HASH_CACHE_FILE, MultiDiskBundleStore.DEDUP_INDEX_FILE]:
+            if os.path.exists(os.path.join(partition_abs_path, file_name)):
+                path_util.remove(os.path.join(partition_abs_path, file_name))
         print >> sys.stderr, "Unlinking partition %s from CodaLab deployment..." % partition
         path_util.remove(partition_abs_path)
         print >> sys.stderr, "Partition removed successfully from bundle store pool"
@@ -272,15 +299,133 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
 
     def cleanup(self, uuid, dry_run):
         '''
-        Remove the bundle with given UUID from on-disk storage.
+        Remove the bundle with given UUID from on-disk storage. If it shares its files with other bundles (see
+        deduplicate), they keep them, with their permissions unchanged (see path_util.remove).
         '''
         absolute_path = self.get_bundle_location(uuid)
         print >>sys.stderr, "cleanup: data %s" % absolute_path
         if not dry_run:
             path_util.remove(absolute_path)
+            index_path = os.path.join(self.partitions, self.ring.get_node(uuid), MultiDiskBundleStore.DEDUP_INDEX_FILE)
+            if os.path.exists(index_path):
+                index = DedupIndex(index_path)
+                try:
+                    num_references = index.remove(uuid)
+                finally:
+                    index.close()
+                if num_references > 0:
+                    print >>sys.stderr, "cleanup: data still shared by %d bundles" % num_references
+
+    def get_dedup_index(self, partition):
+        """
+        Return the DedupIndex of the given partition.
+        """
+        return DedupIndex(os.path.join(self.partitions, partition, MultiDiskBundleStore.DEDUP_INDEX_FILE))
 
+    def deduplicate(self, model, uuid, data_hash, data_size):
+        """
+        If deduplication is enabled, replace the files of the bundle with the given UUID, whose contents have the given
+        data_hash and data_size, by hardlinks to the files of a READY bundle with the same data_hash on the same
+        partition, if there is one, and record both in the DedupIndex of the partition. Bundle contents never change
+        once they're READY, so they can share their files. Return the number of bytes shared.
+        """
+        # Empty bundles have nothing to share, but are common enough to make their data_hash expensive to look up.
+        if not self.deduplicate_bundles or data_hash is None or not data_size:
+            return 0
+        partition = self.ring.get_node(uuid)
+        bundle_path = self.get_bundle_location(uuid)
+        index = self.get_dedup_index(partition)
+        try:
+            # Prefer the bundles already sharing their files, so that they all share the same ones.
+            candidate_uuids = [other_uuid for other_uuid in index.get_uuids(data_hash) if other_uuid != uuid]
+            if not candidate_uuids:
+                candidate_uuids = [
+                    record.uuid for record in model.batch_get_bundle_records([], data_hash=data_hash, state=State.READY)
+                    if record.uuid != uuid and self.ring.get_node(record.uuid) == partition
+                ]
+            shared_size = 0
+            for other_uuid in candidate_uuids:
+                other_path = self.get_bundle_location(other_uuid)
+                if os.path.lexists(other_path):
+                    _, shared_size = self._share_files(partition, other_path, bundle_path)
+                    index.add(other_uuid, data_hash)
+                    break
+            index.add(uuid, data_hash)
+        finally:
+            index.close()
+        if shared_size > 0:
+            print >>sys.stderr, "deduplicate: %s shares %d bytes" % (uuid, shared_size)
+        return shared_size
+
+    def _share_files(self, partition, source_path, dest_path, dry_run=False):
+        """
+        Replace the files under |dest_path| by hardlinks to the files at the same relative paths under |source_path|,
+        when they have the same size and mode (the caller checks that their contents are the same). Return the number
+        of files and bytes that weren't already shared.
+        """
+        temp_dir = os.path.join(self.partitions, partition, MultiDiskBundleStore.TEMP_SUBDIRECTORY)
+        if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+            _, dest_files = path_util.recursive_ls(dest_path)
+        else:
+            dest_files = [dest_path]
+        (num_files, size) = (0, 0)
+        for dest_file in dest_files:
+            source_file = source_path + path_util.get_relative_path(dest_path, dest_file)
+            try:
+                source_stat = os.lstat(source_file)
+                dest_stat = os.lstat(dest_file)
+            except OSError:
+                continue
+            if (not stat.S_ISREG(source_stat.st_mode) or not stat.S_ISREG(dest_stat.st_mode) or
+                    (source_stat.st_dev, source_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino) or
+                    source_stat.st_size != dest_stat.st_size or source_stat.st_mode != dest_stat.st_mode):
+                continue
+            if not dry_run:
+                # Link next to the bundle first, so that the file is replaced atomically.
+                temp_path = os.path.join(temp_dir, 'dedup-%s' % crypt_util.get_random_string())
+                try:
+                    os.link(source_file, temp_path)
+                except OSError as e:
+                    print >>sys.stderr, "deduplicate: unable to link %s: %s" % (source_file, e)
+                    continue
+                os.rename(temp_path, dest_file)
+            num_files += 1
+            size += dest_stat.st_size
+        return (num_files, size)
+
+    def _move_dedup_references(self, old_partition_path, relocations):
+        """
+        Move the entries of the relocated bundles, given as {uuid: new partition path}, from the DedupIndex of the
+        partition at |old_partition_path| to those of their new partitions.
+        """
+        old_index_path = os.path.join(old_partition_path, MultiDiskBundleStore.DEDUP_INDEX_FILE)
+        if not os.path.exists(old_index_path):
+            return
+        old_index = DedupIndex(old_index_path)
+        new_indices = dict()
+        try:
+            for uuid, data_hash in old_index.get_all().iteritems():
+                if uuid not in relocations:
+                    continue
+                new_partition_path = relocations[uuid]
+                if new_partition_path not in new_indices:
+                    new_indices[new_partition_path] = DedupIndex(
+                        os.path.join(new_partition_path, MultiDiskBundleStore.DEDUP_INDEX_FILE))
+                new_indices[new_partition_path].add(uuid, data_hash)
+                old_index.remove(uuid)
+        finally:
+            old_index.close()
+            for index in new_indices.itervalues():
+                index.close()
+
+
+    def get_hash_cache(self, partition):
+        """
+        Return the FileHashCache of the given partition.
+        """
+        return FileHashCache(os.path.join(self.partitions, partition, MultiDiskBundleStore.HASH_CACHE_FILE))
 
-    def health_check(self, model, force=False, compute_data_hash=False, repair_hashes=False):
+    def health_check(self, model, force=False, compute_data_hash=False, repair_hashes=False, verify_hashes=False):
         """
         MultiDiskBundleStore.health_check(): In the MultiDiskBundleStore, bundle contents are stored on disk, and
         occasionally the disk gets out of sync with the database, in which case we make repairs in the following ways:
@@ -291,9 +436,14 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
                directory. If they are then delete the dependencies.
             5. For bundle <UUID> marked READY or FAILED, <UUID>.cid or <UUID>.status, or the <UUID>(-internal).sh files
                should not exist.
+            6. Removes the bundles recorded as sharing their files (see deduplicate) that no longer exist or have
+               another data_hash, and hardlinks again the files that bundles recorded with the same data_hash don't
+               share.
         |force|: Perform any destructive operations on the bundle store the health check determines are necessary. False by default
         |compute_data_hash|: If True, compute the data_hash for every single bundle ourselves and see if it's consistent with what's in
                              the database. False by default.
+        |verify_hashes|: If True, read every file when computing data_hash instead of using the hashes cached for the
+                         partition. False by default.
         """
         UUID_REGEX = re.compile(r'^(%s)' % spec_util.UUID_STR)
 
@@ -359,8 +509,46 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
             return to_delete
 
 
+        def _check_shared_data(partition, db_bundle_by_uuid, verified_uuids):
+            """
+            Checks the DedupIndex of the partition against the bundles on disk, and returns the number of problems.
+            Files are only linked again between bundles whose contents were just checked against their data_hash
+            (in |verified_uuids|).
+            """
+            index_path = os.path.join(self.partitions, partition, MultiDiskBundleStore.DEDUP_INDEX_FILE)
+            if not os.path.exists(index_path):
+                return 0
+            problems = 0
+            index = DedupIndex(index_path)
+            try:
+                uuids_by_data_hash = dict()
+                for uuid, data_hash in sorted(index.get_all().iteritems()):
+                    bundle = db_bundle_by_uuid.get(uuid, None)
+                    if bundle == None or bundle.data_hash != data_hash or not os.path.lexists(self.get_bundle_location(uuid)):
+                        problems += 1
+                        print >> sys.stderr, 'Bundle %s is recorded as sharing data %s, but is missing or has data_hash %s' % (
+                            uuid, data_hash, bundle.data_hash if bundle else None)
+                        if force:
+                            index.remove(uuid)
+                        continue
+                    uuids_by_data_hash.setdefault(data_hash, []).append(uuid)
+                for data_hash, uuids in uuids_by_data_hash.iteritems():
+                    source_path = self.get_bundle_location(uuids[0])
+                    for uuid in uuids[1:]:
+                        repair = force and uuids[0] in verified_uuids and uuid in verified_uuids
+                        num_files, size = self._share_files(
+                            partition, source_path, self.get_bundle_location(uuid), dry_run=not repair)
+                        if num_files > 0:
+                            problems += 1
+                            print >> sys.stderr, 'Bundle %s does not share %d files (%d bytes) with bundle %s%s' % (
+                                uuid, num_files, size, uuids[0], '' if repair else ' (use --data-hash to repair)')
+            finally:
+                index.close()
+            return problems
+
         partitions, _ = path_util.ls(self.partitions)
         trash_count = 0
+        shared_data_problems = 0
 
         for partition in partitions:
             print >> sys.stderr, 'Looking for trash in partition %s...' % partition
@@ -387,37 +575,51 @@ class MultiDiskBundleStore(BaseBundleStore, BundleStoreCleanupMixin, BundleStore
 
             # Check for each bundle if we need to compute its data_hash
             data_hash_recomputed = 0
+            verified_uuids = set()
 
             print >> sys.stderr, 'Checking data_hash of bundles in partition %s...' % partition
-            for bundle_path in bundle_paths:
-                uuid = _get_uuid(bundle_path)
-                bundle = db_bundle_by_uuid.get(uuid, None)
-                if bundle == None:
-                    continue
-                if compute_data_hash or bundle.data_hash == None:
-                    dirs_and_files = path_util.recursive_ls(bundle_path) if os.path.isdir(bundle_path) else ([], [bundle_path])
-                    data_hash = '0x%s' % path_util.hash_directory(bundle_path, dirs_and_files)
-                    if bundle.data_hash == None:
-                        data_hash_recomputed += 1
-                        print >> sys.stderr, 'Giving bundle %s data_hash %s' % (bundle_path, data_hash)
-                        if force:
-                            db_update = dict(data_hash=data_hash)
-                            model.update_bundle(bundle, db_update)
-                    elif compute_data_hash and data_hash != bundle.data_hash:
-                        data_hash_recomputed += 1
-                        print >> sys.stderr, 'Bundle %s should have data_hash %s, actual digest is %s' % (bundle_path, bundle.data_hash, data_hash)
-                        if repair_hashes and force:
-                            db_update = dict(data_hash=data_hash)
-                            model.update_bundle(bundle, db_update)
-
+            hash_cache = self.get_hash_cache(partition)
+            try:
+                for bundle_path in bundle_paths:
+                    uuid = _get_uuid(bundle_path)
+                    bundle = db_bundle_by_uuid.get(uuid, None)
+                    if bundle == None:
+                        continue
+                    if compute_data_hash or bundle.data_hash == None:
+                        dirs_and_files = path_util.recursive_ls(bundle_path) if os.path.isdir(bundle_path) else ([], [bundle_path])
+                        data_hash = '0x%s' % path_util.hash_directory(bundle_path, dirs_and_files, self.hash_threads, hash_cache, verify_hashes)
+                        if bundle.data_hash == None:
+                            data_hash_recomputed += 1
+                            print >> sys.stderr, 'Giving bundle %s data_hash %s' % (bundle_path, data_hash)
+                            if force:
+                                db_update = dict(data_hash=data_hash)
+                                model.update_bundle(bundle, db_update)
+                        elif data_hash == bundle.data_hash:
+                            verified_uuids.add(uuid)
+                        elif compute_data_hash and data_hash != bundle.data_hash:
+                            data_hash_recomputed += 1
+                            print >> sys.stderr, 'Bundle %s should have data_hash %s, actual digest is %s' % (bundle_path, bundle.data_hash, data_hash)
+                            if repair_hashes and force:
+                                db_update = dict(data_hash=data_hash)
+                                model.update_bundle(bundle, db_update)
+                if compute_data_hash:
+                    # Every file of the partition has been looked up.
+                    hash_cache.prune()
+            finally:
+                hash_cache.close()
+
+            print >> sys.stderr, 'Checking shared data of bundles in partition %s...' % partition
+            shared_data_problems += _check_shared_data(partition, db_bundle_by_uuid, verified_uuids)
 
         if force:
             print >> sys.stderr, '\tDeleted %d objects from the bundle store' % trash_count
             print >> sys.stderr, '\tRecomputed data_hash for %d bundles' % data_hash_recomputed
+            print >> sys.stderr, '\tProblems with shared data: %d' % shared_data_problems
         else:
             print >> sys.stderr, 'Dry-Run Statistics, re-run with --force to perform updates:'
             print >> sys.stderr, '\tObjects marked for deletion: %d' % trash_count
             print >> sys.stderr, '\tBundles that need data_hash recompute: %d' % data_hash_recomputed
+            print >> sys.stderr, '\tProblems with shared data: %d' % shared_data_problems
 
 
 
@@ -48,6 +48,7 @@ from codalab.lib.download_manager import DownloadManager
 from codalab.lib.emailer import SMTPEmailer, ConsoleEmailer
 from codalab.lib.upload_manager import UploadManager
 from codalab.lib import formatting
+from codalab.model.instrumentation import ModelInstrumentation
 from codalab.model.worker_model import WorkerModel
 
 def cached(fn):
@@ -287,7 +288,9 @@ class CodaLabManager(object):
         """
         store_type = self.config.get('bundle_store', 'MultiDiskBundleStore')
         if store_type == MultiDiskBundleStore.__name__:
-            return MultiDiskBundleStore(self.codalab_home)
+            return MultiDiskBundleStore(self.codalab_home,
+                                        self.config.get('deduplicate_bundles', False),
+                                        self.config.get('hash_threads'))
         else:
             print >>sys.stderr, "Invalid bundle store type \"%s\"", store_type
             sys.exit(1)
@@ -364,17 +367,23 @@ class CodaLabManager(object):
         model = None
         if model_class == 'MySQLModel':
             from codalab.model.mysql_model import MySQLModel
-            model = MySQLModel(engine_url=self.config['server']['engine_url'], default_user_info=self.default_user_info())
+            model = MySQLModel(engine_url=self.config['server']['engine_url'], default_user_info=self.default_user_info(),
+                               read_engine_url=self.config['server'].get('read_engine_url'))
         elif model_class == 'SQLiteModel':
             from codalab.model.sqlite_model import SQLiteModel
             # Patch for backwards-compatibility until we have a cleaner abstraction around config
             # that can update configs to newer "versions"
             engine_url = self.config['server'].get('engine_url', "sqlite:///{}".format(os.path.join(self.codalab_home, 'bundle.db')))
-            model = SQLiteModel(engine_url=engine_url, default_user_info=self.default_user_info())
+            model = SQLiteModel(engine_url=engine_url, default_user_info=self.default_user_info(),
+                                read_engine_url=self.config['server'].get('read_engine_url'))
         else:
             raise UsageError('Unexpected model class: %s, expected MySQLModel or SQLiteModel' % (model_class,))
         model.root_user_id = self.root_user_id()
         model.system_user_id = self.system_user_id()
+        model.slow_query_threshold = self.config['server'].get('slow_query_threshold')
+        model.read_your_writes_window = self.config['server'].get('read_your_writes_window', model.read_your_writes_window)
+        if self.config['server'].get('instrumentation', True):
+            ModelInstrumentation().instrument(model)
         return model
 
     @cached
@@ -0,0 +1,214 @@
+"""
+copy_util copies files and directories in-process, without following symlinks
+and preserving permissions like `rsync -prl`, but using the cheapest way the
+file systems allow to copy each file:
+    hardlink: share the file (only if asked, since the copy isn't independent)
+    reflink: share the blocks of the file until either copy is modified
+             (FICLONE, e.g. on Btrfs and XFS)
+    copy_file_range: copy within the kernel, possibly server-side (Linux 4.5+)
+    sendfile: copy within the kernel
+    read_write: copy through a buffer
+Each strategy falls back to the next one when the file systems don't support
+it. Only Linux is supported (see is_supported); path_util.copy falls back to
+rsync elsewhere.
+"""
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import sys
+
+
+STRATEGIES = ('hardlink', 'reflink', 'copy_file_range', 'sendfile', 'read_write')
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Number of bytes copied by each copy_file_range / sendfile call.
+KERNEL_COPY_SIZE = 1 << 30
+# Size of the buffer used to copy files without the help of the kernel.
+BUFFER_SIZE = 1 << 20
+
+# Errors meaning that a strategy isn't supported for the given files, rather
+# than that copying them failed.
+UNSUPPORTED_ERRNOS = frozenset([
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP,
+    errno.EPERM, errno.EMLINK, errno.EBADF,
+])
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    functions = {}
+    if hasattr(libc, 'copy_file_range'):
+        function = libc.copy_file_range
+        function.argtypes = [
+            ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int,
+            ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint,
+        ]
+        function.restype = ctypes.c_ssize_t
+        functions['copy_file_range'] = function
+    if hasattr(libc, 'sendfile'):
+        function = libc.sendfile
+        function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_long), ctypes.c_size_t]
+        function.restype = ctypes.c_ssize_t
+        functions['sendfile'] = function
+    return functions
+
+
+_libc_functions = _load_libc() if sys.platform.startswith('linux') else None
+
+
+def is_supported():
+    return _libc_functions is not None
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class TreeCopier(object):
+    """
+    Copies files and directories with the given strategies (all but hardlink
+    by default), remembering the ones that turned out not to be supported so
+    that copying a large directory doesn't retry them for every file.
+    If |preserve_hardlinks|, files hardlinked to each other (even across
+    several calls of copy) are hardlinked in the copies too, like `rsync -H`.
+    |counts| has the number of files copied with each strategy.
+    """
+    def __init__(self, strategies=None, preserve_hardlinks=False):
+        if strategies is None:
+            strategies = [strategy for strategy in STRATEGIES if strategy != 'hardlink']
+        self.strategies = list(strategies)
+        # (strategy, source device, destination device) that failed before.
+        self.unsupported = set()
+        self.counts = collections.Counter()
+        # (device, inode) of the source files with several links -> their copy.
+        self.copies = {} if preserve_hardlinks else None
+
+    def copy(self, source_path, dest_path):
+        """
+        Copy |source_path| to |dest_path|, which must not exist.
+        """
+        dest_dev = os.stat(os.path.dirname(os.path.abspath(dest_path))).st_dev
+        self._copy(source_path, dest_path, dest_dev)
+
+    def _copy(self, source_path, dest_path, dest_dev):
+        source_stat = os.lstat(source_path)
+        if stat.S_ISLNK(source_stat.st_mode):
+            os.symlink(os.readlink(source_path), dest_path)
+        elif stat.S_ISDIR(source_stat.st_mode):
+            os.mkdir(dest_path, 0700)
+            for file_name in os.listdir(source_path):
+                self._copy(os.path.join(source_path, file_name), os.path.join(dest_path, file_name), dest_dev)
+            # Only now, in case the directory is read-only.
+            os.chmod(dest_path, stat.S_IMODE(source_stat.st_mode))
+        elif stat.S_ISREG(source_stat.st_mode):
+            self._copy_file(source_path, source_stat, dest_path, dest_dev)
+        # Like rsync without -D, skip devices, sockets and pipes.
+
+    def _copy_file(self, source_path, source_stat, dest_path, dest_dev):
+        mode = stat.S_IMODE(source_stat.st_mode)
+        strategies = [
+            strategy for strategy in self.strategies
+            if (strategy, source_stat.st_dev, dest_dev) not in self.unsupported
+        ]
+        copy_key = (source_stat.st_dev, source_stat.st_ino)
+        if self.copies is not None and source_stat.st_nlink > 1:
+            if copy_key in self.copies:
+                try:
+                    os.link(self.copies[copy_key], dest_path)
+                    self.counts['preserved_hardlink'] += 1
+                    return
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED_ERRNOS:
+                        raise
+            self.copies[copy_key] = dest_path
+
+        if 'hardlink' in strategies:
+            strategies.remove('hardlink')
+            try:
+                os.link(source_path, dest_path)
+                self.counts['hardlink'] += 1
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.unsupported.add(('hardlink', source_stat.st_dev, dest_dev))
+
+        with open(source_path, 'rb') as source:
+            dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            with os.fdopen(dest_fd, 'wb') as dest:
+                for strategy in strategies + ['read_write']:
+                    try:
+                        getattr(self, '_' + strategy)(source, dest, source_stat.st_size)
+                    except _Unsupported:
+                        self.unsupported.add((strategy, source_stat.st_dev, dest_dev))
+                        # Start over from the beginning of both files.
+                        source.seek(0)
+                        dest.seek(0)
+                        dest.truncate()
+                        continue
+                    self.counts[strategy] += 1
+                    break
+        os.chmod(dest_path, mode)
+
+    def _reflink(self, source, dest, size):
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+        except IOError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                raise _Unsupported()
+            raise
+
+    def _kernel_copy(self, name, call, size):
+        function = (_libc_functions or {}).get(name)
+        if function is None:
+            raise _Unsupported()
+        copied = 0
+        while True:
+            result = call(function, KERNEL_COPY_SIZE)
+            if result < 0:
+                error = ctypes.get_errno()
+                # Errors after a part of the file was copied are real failures.
+                if error in UNSUPPORTED_ERRNOS and copied == 0:
+                    raise _Unsupported()
+                raise OSError(error, os.strerror(error))
+            if result == 0:
+                break
+            copied += result
+        if copied < size:
+            # Some kernels copy nothing from special file systems, e.g. /proc.
+            raise _Unsupported()
+
+    def _copy_file_range(self, source, dest, size):
+        self._kernel_copy(
+            'copy_file_range',
+            lambda function, count: function(source.fileno(), None, dest.fileno(), None, count, 0),
+            size)
+
+    def _sendfile(self, source, dest, size):
+        self._kernel_copy(
+            'sendfile',
+            lambda function, count: function(dest.fileno(), source.fileno(), None, count),
+            size)
+
+    def _read_write(self, source, dest, size):
+        shutil.copyfileobj(source, dest, BUFFER_SIZE)
+
+
+def copy(source_path, dest_path, hardlink=False):
+    """
+    Copy |source_path| to |dest_path|, which must not exist, hardlinking the
+    files if |hardlink| and it's possible. Only use that when neither copy is
+    going to be modified. Return the number of files copied with each strategy.
+    """
+    copier = TreeCopier(STRATEGIES if hardlink else None)
+    copier.copy(source_path, dest_path)
+    return copier.counts
@@ -0,0 +1,63 @@
+"""
+dedup_index provides DedupIndex, which records which bundles of a partition of
+the MultiDiskBundleStore share their files (are hardlinked to each other)
+because they have the same data_hash, in a SQLite file.
+
+The number of bundles recorded with a data_hash is the reference count of
+their data: removing one of them only frees the space once it drops to zero.
+"""
+import sqlite3
+
+
+class DedupIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS bundle_data ('
+            'uuid TEXT NOT NULL PRIMARY KEY, data_hash TEXT NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS bundle_data_data_hash_index ON bundle_data (data_hash)'
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, uuid, data_hash):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO bundle_data (uuid, data_hash) VALUES (?, ?)', (uuid, data_hash)
+        )
+        self.connection.commit()
+
+    def remove(self, uuid):
+        """
+        Forget the bundle with the given uuid and return the number of bundles
+        still sharing its data (0 if it wasn't recorded).
+        """
+        data_hash = self.get_data_hash(uuid)
+        if data_hash is None:
+            return 0
+        self.connection.execute('DELETE FROM bundle_data WHERE uuid = ?', (uuid,))
+        self.connection.commit()
+        return len(self.get_uuids(data_hash))
+
+    def get_data_hash(self, uuid):
+        row = self.connection.execute('SELECT data_hash FROM bundle_data WHERE uuid = ?', (uuid,)).fetchone()
+        return row[0] if row else None
+
+    def get_uuids(self, data_hash):
+        """
+        Return the uuids of the bundles recorded with the given data_hash.
+        """
+        return [
+            row[0] for row in
+            self.connection.execute('SELECT uuid FROM bundle_data WHERE data_hash = ? ORDER BY uuid', (data_hash,))
+        ]
+
+    def get_all(self):
+        """
+        Return {uuid: data_hash} for all the bundles recorded.
+        """
+        return dict(self.connection.execute('SELECT uuid, data_hash FROM bundle_data'))
@@ -38,10 +38,7 @@ class DownloadManager(object):
             # worker system launches, since it's not used.
             return file_util.index_contents(final_path, depth)
         else:
-            index = self._bundle_model.get_bundle_contents_index(uuid)
-            if index is None:
-                return None
-            return file_util.restrict_contents_index(index, path, depth)
+            return self._bundle_model.get_bundle_contents_target_info(uuid, path, depth)
 
     def stream_tarred_gzipped_directory(self, uuid, path):
         """
@@ -0,0 +1,100 @@
+"""
+hash_cache provides FileHashCache, a persistent cache of the hashes of the
+contents of files (see path_util.hash_file_contents), stored in a SQLite file.
+
+Bundle contents don't change once they are READY, so the MultiDiskBundleStore
+keeps one cache per partition and recomputing the data_hash of a bundle only
+needs to stat its files instead of reading them.
+"""
+import os
+import sqlite3
+import stat
+import time
+
+
+class FileHashCache(object):
+    """
+    Maps (device, inode, size, mtime in nanoseconds) of regular files to the
+    hash of their contents. A file that is modified gets a new mtime (and
+    usually a new size), so its cached hash is simply never looked up again.
+    """
+    # Files modified less than this many seconds ago are not cached, since they
+    # could still be modified without changing their mtime (e.g. on file
+    # systems with coarse timestamps).
+    RACY_WINDOW = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS file_hash ('
+            'device INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (device, inode))'
+        )
+        self.connection.commit()
+        # (device, inode) of the files looked up or stored since we were opened.
+        self.seen = set()
+
+    def close(self):
+        self.connection.close()
+
+    def get_key(self, path):
+        """
+        Return the key of the file at |path|, or None if it is not a regular
+        file (links are cheap to hash and aren't cached).
+        """
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        # os.stat has no st_mtime_ns in Python 2; a double still has a
+        # resolution well under a microsecond for current dates.
+        return (st.st_dev, st.st_ino, st.st_size, int(round(st.st_mtime * 1e9)))
+
+    def lookup(self, keys):
+        """
+        Return the list of the cached hashes of the files with the given keys
+        (None for those not in the cache).
+        """
+        hashes = []
+        for key in keys:
+            row = None
+            if key is not None:
+                self.seen.add(key[:2])
+                row = self.connection.execute(
+                    'SELECT hash FROM file_hash WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                    key
+                ).fetchone()
+            hashes.append(row[0] if row else None)
+        return hashes
+
+    def update(self, keys, hashes):
+        """
+        Cache the hashes of the files with the given keys.
+        """
+        racy_mtime_ns = (time.time() - self.RACY_WINDOW) * 1e9
+        rows = []
+        for (key, contents_hash) in zip(keys, hashes):
+            if key is None or key[3] >= racy_mtime_ns:
+                continue
+            self.seen.add(key[:2])
+            rows.append(key + (contents_hash,))
+        if rows:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO file_hash (device, inode, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self.connection.commit()
+
+    def prune(self):
+        """
+        Remove the hashes of all the files that haven't been looked up since we
+        were opened. Only call this after hashing every file of the partition.
+        Return the number of hashes removed.
+        """
+        stale = [
+            key for key in self.connection.execute('SELECT device, inode FROM file_hash')
+            if tuple(key) not in self.seen
+        ]
+        self.connection.executemany('DELETE FROM file_hash WHERE device = ? AND inode = ?', stale)
+        self.connection.commit()
+        return len(stale)
@@ -9,7 +9,7 @@ There are a few classes of methods provided here:
     safe_join, get_relative_path, ls, recursive_ls
 
   Functions to read files to compute hashes, write results to stdout, etc:
-    getmtime, get_size, hash_directory, hash_file_contents
+    getmtime, get_size, scan_path, hash_directory, hash_files_contents, hash_file_contents
 
   Functions that modify that filesystem in controlled ways:
     copy, make_directory, set_write_permissions, rename, remove
@@ -17,8 +17,10 @@ There are a few classes of methods provided here:
 import errno
 import hashlib
 import itertools
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
+import stat
 import subprocess
 import sys
 
@@ -26,13 +28,18 @@ from codalab.common import (
   precondition,
   UsageError,
 )
-from codalab.lib import file_util
+from codalab.lib import copy_util, file_util
 
 
 # Block sizes and canonical strings used when hashing files.
 BLOCK_SIZE = 0x40000
 FILE_PREFIX = 'file'
 LINK_PREFIX = 'link'
+# Number of files hashed at a time by default. hashlib releases the GIL while
+# hashing each block, so threads keep both the disks and the CPUs busy.
+HASH_THREADS = 8
+# Number of files handed to a hashing thread at a time.
+HASH_CHUNK_SIZE = 8
 
 
 def path_error(message, path):
@@ -183,19 +190,66 @@ def get_size(path, dirs_and_files=None):
     return sum(os.lstat(path).st_size for path in itertools.chain(*dirs_and_files))
 
 
-def hash_path(path, dirs_and_files=None):
+def scan_path(path, compute_hash=True, num_threads=None, hash_cache=None, verify=False):
+    """
+    Walk the file or directory at the given path once, calling lstat once per
+    entry, and return (hash, size, contents index), where:
+        hash: what hash_directory returns for the path (None if not
+              |compute_hash|). The other arguments are passed to it.
+        size: what get_size returns for the path.
+        contents index: what worker.file_util.index_contents returns for the
+                        path.
+    Like recursive_ls, does not descend into symlinked directories.
+    """
+    (directories, files) = ([], [])
+    size = 0
+    index = None
+    # Stack of (path, lstat of the path, index entry of the path).
+    stack = [(path, os.lstat(path), {'name': os.path.basename(path)})]
+    while stack:
+        (entry_path, entry_stat, entry) = stack.pop()
+        size += entry_stat.st_size
+        entry['size'] = entry_stat.st_size
+        entry['perm'] = entry_stat.st_mode & 0777
+        if index is None:
+            index = entry
+        if stat.S_ISDIR(entry_stat.st_mode):
+            entry['type'] = 'directory'
+            entry['contents'] = []
+            directories.append(entry_path)
+            for file_name in os.listdir(entry_path):
+                child_path = os.path.join(entry_path, file_name)
+                child = {'name': file_name}
+                entry['contents'].append(child)
+                stack.append((child_path, os.lstat(child_path), child))
+            continue
+        if stat.S_ISLNK(entry_stat.st_mode):
+            entry['type'] = 'link'
+            entry['link'] = os.readlink(entry_path)
+        elif stat.S_ISREG(entry_stat.st_mode):
+            entry['type'] = 'file'
+        files.append(entry_path)
+    contents_hash = None
+    if compute_hash:
+        contents_hash = hash_directory(path, (directories, files), num_threads, hash_cache, verify)
+    return (contents_hash, size, index)
+
+
+def hash_path(path, dirs_and_files=None, num_threads=None, hash_cache=None, verify=False):
     if os.path.isfile(path):
-        return hash_file_contents(path)
+        return hash_files_contents([path], num_threads, hash_cache, verify)[0]
     elif os.path.isdir(path):
-        return hash_directory(path, dirs_and_files)
+        return hash_directory(path, dirs_and_files, num_threads, hash_cache, verify)
     else:
         print >> sys.stderr, 'Path %s not valid' % path
 
-def hash_directory(path, dirs_and_files=None):
+def hash_directory(path, dirs_and_files=None, num_threads=None, hash_cache=None, verify=False):
     """
     Return the hash of the contents of the folder at the given path.
     This hash is independent of the path itself - if you were to move the
     directory and call get_hash again, you would get the same result.
+    The files are hashed |num_threads| at a time, using and updating
+    |hash_cache| if given (see hash_files_contents).
     """
     (directories, files) = dirs_and_files or recursive_ls(path)
     # Sort and then hash all directories and then compute a hash of the hashes.
@@ -210,16 +264,52 @@ def hash_directory(path, dirs_and_files=None):
     # Use a similar two-level hashing scheme for all files, but incorporate a
     # hash of both the file name and contents.
     file_hash = hashlib.sha1()
-    for file_name in sorted(files):
+    files = sorted(files)
+    for (file_name, contents_hash) in itertools.izip(files, hash_files_contents(files, num_threads, hash_cache, verify)):
         relative_path = get_relative_path(path, file_name)
         file_hash.update(hashlib.sha1(relative_path).hexdigest())
-        file_hash.update(hash_file_contents(file_name))
+        file_hash.update(contents_hash)
     # Return a hash of the two hashes.
     overall_hash = hashlib.sha1(directory_hash.hexdigest())
     overall_hash.update(file_hash.hexdigest())
     return overall_hash.hexdigest()
 
 
+def hash_files_contents(paths, num_threads=None, hash_cache=None, verify=False):
+    """
+    Return the list of the hashes of the contents of the files at the given
+    paths (see hash_file_contents), hashing up to |num_threads| (HASH_THREADS
+    by default) files at a time.
+    |hash_cache|: a FileHashCache (see hash_cache.py). Only the files whose
+                  hashes are not in it are read, and their hashes are added.
+    |verify|: read all the files anyway, warning about those whose contents
+              don't match their cached hash, and fix the cache.
+    """
+    if hash_cache is not None:
+        keys = [hash_cache.get_key(path) for path in paths]
+        cached_hashes = hash_cache.lookup(keys)
+        hashes = [None] * len(paths) if verify else list(cached_hashes)
+        missing = [i for (i, contents_hash) in enumerate(hashes) if contents_hash is None]
+        for (i, contents_hash) in zip(missing, hash_files_contents([paths[i] for i in missing], num_threads)):
+            if cached_hashes[i] is not None and cached_hashes[i] != contents_hash:
+                print >> sys.stderr, 'WARNING: Contents of %s changed, but not its size or mtime' % paths[i]
+            hashes[i] = contents_hash
+        hash_cache.update([keys[i] for i in missing], [hashes[i] for i in missing])
+        return hashes
+
+    if num_threads is None:
+        num_threads = HASH_THREADS
+    num_threads = min(num_threads, len(paths))
+    if num_threads <= 1:
+        return [hash_file_contents(path) for path in paths]
+    pool = ThreadPool(num_threads)
+    try:
+        return pool.map(hash_file_contents, paths, HASH_CHUNK_SIZE)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def hash_file_contents(path):
     """
     Return the hash of the file's contents, read in blocks of size BLOCK_SIZE.
@@ -244,12 +334,18 @@ def hash_file_contents(path):
 # Functions that modify that filesystem in controlled ways.
 ################################################################################
 
-def copy(source_path, dest_path, follow_symlinks=False, exclude_patterns=None):
+def copy(source_path, dest_path, follow_symlinks=False, exclude_patterns=None, hardlink=False, copier=None):
     """
     Copy |source_path| to |dest_path|.
     Assume dest_path doesn't exist.
     |follow_symlinks|: whether to follow symlinks
     |exclude_patterns|: patterns to not copy
+    |hardlink|: hardlink the files when possible (see copy_util.copy). Only
+                use this when neither copy is going to be modified.
+    |copier|: copy_util.TreeCopier to copy with, e.g. to keep the hardlinks
+              between several copies.
+    Unless following symlinks or excluding files, copies in-process (see
+    copy_util), falling back to rsync.
     Note: this only works in Linux.
     """
     if os.path.exists(dest_path):
@@ -263,6 +359,17 @@ def copy(source_path, dest_path, follow_symlinks=False, exclude_patterns=None):
             raise path_error('not following symlinks', source_path)
         if not os.path.exists(source_path):
             raise path_error('does not exist', source_path)
+        if not follow_symlinks and exclude_patterns is None and copy_util.is_supported():
+            try:
+                if copier is not None:
+                    copier.copy(source_path, dest_path)
+                else:
+                    copy_util.copy(source_path, dest_path, hardlink)
+                return
+            except EnvironmentError as e:
+                print >> sys.stderr, 'Unable to copy %s in-process (%s), falling back to rsync' % (source_path, e)
+                if os.path.lexists(dest_path):
+                    remove(dest_path)
         command = [
             'rsync',
             '-pr%s' % ('L' if follow_symlinks else 'l'),
@@ -301,15 +408,28 @@ def rename(old_path, new_path):
     subprocess.call(['mv', old_path, new_path])
 
 
+def set_directory_write_permissions(path):
+    # Give write permissions to the directories under |path|, which is all that
+    # removing their contents needs. Unlike set_write_permissions, leave the
+    # files alone, since they may be hardlinked from elsewhere (see copy).
+    for (directory, _, _) in os.walk(path):
+        mode = os.lstat(directory).st_mode
+        if not mode & stat.S_IWUSR:
+            try:
+                os.chmod(directory, mode | stat.S_IWUSR)
+            except OSError:
+                pass  # Removing its contents will fail below.
+
+
 def remove(path):
     """
     Remove the given path, whether it is a directory, file, or link.
     """
     check_isvalid(path, 'remove')
-    set_write_permissions(path)  # Allow permissions
     if os.path.islink(path):
         os.unlink(path)
     elif os.path.isdir(path):
+        set_directory_write_permissions(path)  # Allow permissions
         try:
             shutil.rmtree(path)
         except shutil.Error:
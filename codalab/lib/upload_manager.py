@@ -152,21 +152,17 @@ class UploadManager(object):
     def update_metadata_and_save(self, bundle, new_bundle):
         """
         Updates the metadata about the contents of the bundle, including
-        data_size as well as the total amount of disk used by the user.
+        data_size as well as the total amount of disk used by the user, and
+        its contents index. Then lets the bundle store deduplicate its contents.
 
         If |new_bundle| is True, saves the bundle as a new bundle. Otherwise,
         updates it.
         """
         bundle_path = self._bundle_store.get_bundle_location(bundle.uuid)
 
-        dirs_and_files = None
-        if os.path.isdir(bundle_path):
-            dirs_and_files = path_util.recursive_ls(bundle_path)
-        else:
-            dirs_and_files = [], [bundle_path]
-
-        data_hash = '0x%s' % (path_util.hash_directory(bundle_path, dirs_and_files))
-        data_size = path_util.get_size(bundle_path, dirs_and_files)
+        (data_hash, data_size, index) = path_util.scan_path(bundle_path, num_threads=self._bundle_store.hash_threads)
+        data_hash = '0x%s' % data_hash
+        index['name'] = bundle.uuid
 
         if new_bundle:
             bundle.data_hash = data_hash
@@ -180,8 +176,8 @@ class UploadManager(object):
                 },
             }
             self._bundle_model.update_bundle(bundle, bundle_update)
-
-        self._bundle_model.update_user_disk_used(bundle.owner_id)
+        self._bundle_model.update_bundle_contents_index(bundle.uuid, index)
+        self._bundle_store.deduplicate(self._bundle_model, bundle.uuid, data_hash, data_size)
 
     def has_contents(self, bundle):
         return os.path.exists(self._bundle_store.get_bundle_location(bundle.uuid))
@@ -195,4 +191,3 @@ class UploadManager(object):
             },
         }
         self._bundle_model.update_bundle(bundle, bundle_update)
-        self._bundle_model.update_user_disk_used(bundle.owner_id)
@@ -38,6 +38,7 @@ class LocalMachine(Machine):
         # practice, this is not a bit worry.
         pairs = bundle.get_dependency_paths(bundle_store, parent_dict, temp_dir)
         print >>sys.stderr, 'LocalMachine.start_bundle: copying dependencies of %s to %s' % (bundle.uuid, temp_dir)
+        # The run can modify its copies, so they are never hardlinks (see path_util.copy).
         for (source, target) in pairs:
             path_util.copy(source, target, follow_symlinks=False)
 
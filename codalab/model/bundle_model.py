@@ -3,25 +3,29 @@ BundleModel is a wrapper around database calls to save and load bundle metadata.
 """
 
 import collections
-import copy
+from contextlib import contextmanager
 import datetime
+import difflib
 import json
-import os.path
 import re
 import sys
+import threading
 import time
 import uuid
 
 from sqlalchemy import (
     and_,
+    bindparam,
     or_,
     not_,
     select,
     union,
     desc,
+    event,
     func,
 )
 from sqlalchemy.exc import (
+    IntegrityError as DatabaseIntegrityError,
     OperationalError,
     ProgrammingError,
 )
@@ -43,13 +47,43 @@ from codalab.lib import (
     spec_util,
     worksheet_util,
 )
-from codalab.model.util import LikeQuery
+from codalab.model.contents_index import (
+    apply_deltas,
+    build_index,
+    decode_chunk,
+    DELTA_ACTIONS,
+    delta_to_entry,
+    entry_key,
+    flatten_index,
+    key_depth,
+    make_chunks,
+    path_depth,
+    remove_orphans,
+    target_key_ranges,
+)
+from codalab.model.events_log_writer import EventsLogWriter
+from codalab.model.util import (
+    BUNDLE_SEARCH_KEYS,
+    bundle_search_values,
+    compute_ancestors,
+    decode_continuation_token,
+    encode_continuation_token,
+    get_bind_params,
+    get_query_search_tokens,
+    get_search_tokens,
+    LikeQuery,
+    VersionedLRUCache,
+)
 from codalab.model.tables import (
     bundle as cl_bundle,
-    bundle_contents_index as cl_bundle_contents_index,
+    bundle_closure as cl_bundle_closure,
+    bundle_contents_chunk as cl_bundle_contents_chunk,
+    bundle_contents_delta as cl_bundle_contents_delta,
     bundle_dependency as cl_bundle_dependency,
     bundle_metadata as cl_bundle_metadata,
     bundle_action as cl_bundle_action,
+    bundle_search as cl_bundle_search,
+    search_token as cl_search_token,
     group as cl_group,
     group_bundle_permission as cl_group_bundle_permission,
     group_object_permission as cl_group_worksheet_permission,
@@ -61,6 +95,8 @@ from codalab.model.tables import (
     worksheet_tag as cl_worksheet_tag,
     worksheet_item as cl_worksheet_item,
     event as cl_event,
+    event_command_rollup as cl_event_command_rollup,
+    event_user_rollup as cl_event_user_rollup,
     user as cl_user,
     chat as cl_chat,
     user_verification as cl_user_verification,
@@ -70,6 +106,8 @@ from codalab.model.tables import (
     oauth2_auth_code,
     db_metadata,
 )
+from codalab.objects.bundle_record import BundleRecord
+from codalab.objects.metadata import Metadata
 from codalab.objects.worksheet import (
     item_sort_key,
     Worksheet,
@@ -84,6 +122,9 @@ from codalab.objects.user import (
 )
 
 SEARCH_KEYWORD_REGEX = re.compile('^([\.\w/]*)=(.*)$')
+# Statements that don't write to the database (see BundleModel._note_write),
+# including the ones that manage transactions and savepoints.
+READ_STATEMENT_REGEX = re.compile(r'^\s*(SELECT|EXPLAIN|SHOW|BEGIN|SAVEPOINT|RELEASE|ROLLBACK)\b', re.IGNORECASE)
 
 def str_key_dict(row):
     '''
@@ -95,13 +136,51 @@ def str_key_dict(row):
     return dict((str(k), v) for k, v in row.items())
 
 class BundleModel(object):
-    def __init__(self, engine, default_user_info):
+    # Maximum number of bundles kept in the in-process bundle cache.
+    BUNDLE_CACHE_SIZE = 10000
+    # Only bundles in these states are cached, since they rarely change.
+    CACHED_BUNDLE_STATES = (State.READY, State.FAILED)
+    # Maximum number of bundles deleted in one transaction (or looked up in one
+    # IN clause when deleting).
+    DELETE_CHUNK_SIZE = 500
+    # Maximum number of rows inserted by one statement of do_multirow_insert,
+    # e.g. for the search tokens of a large save_bundles.
+    INSERT_CHUNK_SIZE = 1000
+    # Stored in event_user_rollup instead of the NULL user_id and user_name of
+    # anonymous events, since NULLs never violate its unique constraint.
+    ANONYMOUS_EVENT_USER = ''
+    # Maximum number of compiled search queries kept (see _execute_search_query).
+    QUERY_CACHE_SIZE = 1000
+    # Default number of seconds after a write during which reads stay on the
+    # primary engine (see get_read_engine).
+    READ_YOUR_WRITES_WINDOW = 10
+    # Whether request_scope can make units of work (needs savepoints).
+    UNITS_OF_WORK = True
+    # Spacing of the worksheet item sort keys assigned when renumbering, so
+    # that later insertions fit in between (see _get_new_item_sort_keys).
+    WORKSHEET_ITEM_SORT_KEY_GAP = 100
+
+    def __init__(self, engine, default_user_info, read_engine=None):
         '''
         Initialize a BundleModel with the given SQLAlchemy engine.
+        If |read_engine| is given (e.g., a read replica of |engine|), read-only
+        methods use it instead (see get_read_engine).
         '''
         self.engine = engine
+        self.read_engine = read_engine
+        self.read_your_writes_window = self.READ_YOUR_WRITES_WINDOW
+        self._local = threading.local()
+        event.listen(engine, 'after_cursor_execute', self._note_write)
         self.default_user_info = default_user_info
         self.public_group_uuid = ''
+        self.bundle_cache = VersionedLRUCache(self.BUNDLE_CACHE_SIZE)
+        self.query_cache = VersionedLRUCache(self.QUERY_CACHE_SIZE)
+        # If set, search queries taking at least this many seconds are logged
+        # along with their query plan.
+        self.slow_query_threshold = None
+        # Set by ModelInstrumentation.instrument.
+        self.instrumentation = None
+        self.events_log_writer = None
         self.create_tables()
 
     def _reset(self):
@@ -122,7 +201,7 @@ class BundleModel(object):
 
     def do_multirow_insert(self, connection, table, values):
         '''
-        Insert multiple rows into the given table.
+        Insert multiple rows into the given table, INSERT_CHUNK_SIZE at a time.
 
         This method may be overridden by models that use more powerful SQL dialects.
         '''
@@ -131,8 +210,96 @@ class BundleModel(object):
         #   - Some dialects do not support empty inserts, so we test 'if values'.
         #   - Some dialects do not support multiple inserts in a single statement,
         #     which we deal with by using the DBAPI execute_many pattern.
-        if values:
-            connection.execute(table.insert(), values)
+        for i in range(0, len(values), self.INSERT_CHUNK_SIZE):
+            connection.execute(table.insert(), values[i:i + self.INSERT_CHUNK_SIZE])
+
+    def _note_write(self, conn, cursor, statement, parameters, context, executemany):
+        '''
+        Listener for statements executed on the primary engine: remember when
+        this thread last wrote to it.
+        '''
+        if not READ_STATEMENT_REGEX.match(statement):
+            self._local.last_write_time = time.time()
+
+    @contextmanager
+    def request_scope(self, unit_of_work=True):
+        '''
+        Within this block (e.g., for the duration of a request), reads only
+        stay on the primary engine after writes made within the block.
+
+        If |unit_of_work|, the model calls made by this thread within the block
+        also share one connection and transaction per engine, begun by the first
+        call that needs it and committed at the end of the block (or rolled back
+        if the block raises). Each call runs in a savepoint, so a call that fails
+        only undoes its own writes. Blocks that wait for other processes to see
+        their writes (e.g., the worker routes) shouldn't be units of work.
+        '''
+        previous = getattr(self._local, 'last_write_time', None)
+        self._local.last_write_time = None
+        if not (unit_of_work and self.UNITS_OF_WORK) or getattr(self._local, 'unit_of_work', None) is not None:
+            # Not a unit of work, or part of the enclosing one.
+            try:
+                yield
+            finally:
+                self._local.last_write_time = previous
+            return
+
+        engines = self._local.unit_of_work = []
+        try:
+            yield
+            self._commit_unit_of_work()
+        finally:
+            self._local.unit_of_work = None
+            wrote = self._local.last_write_time is not None
+            self._local.last_write_time = previous
+            if engines:
+                # The block (or a commit) failed.
+                for engine in engines:
+                    engine.rollback()
+                if wrote:
+                    # Bundles read after the rolled back writes may be cached.
+                    self.bundle_cache.clear()
+
+    def _commit_unit_of_work(self):
+        '''
+        Commit the transactions of the current unit of work, if any, so far (the
+        next calls begin new ones), e.g. to keep long operations from running in
+        one huge transaction. Must not be called within a transaction.
+        '''
+        engines = getattr(self._local, 'unit_of_work', None) or []
+        while engines:
+            engines[0].commit()
+            del engines[0]
+
+    def _begin(self, read_only=False):
+        '''
+        Return a context manager for a transaction on the primary engine (or on
+        get_read_engine() if |read_only|), which yields the connection to use.
+        Within a unit of work (see request_scope), this is a savepoint of its
+        transaction on that engine.
+        '''
+        engine = self.get_read_engine() if read_only else self.engine
+        engines = getattr(self._local, 'unit_of_work', None)
+        if engines is None:
+            return engine.begin()
+        if engine not in engines:
+            engine.begin()
+            engines.append(engine)
+        return engine.begin_nested()
+
+    def get_read_engine(self):
+        '''
+        Return the engine read-only methods should use: the read engine, unless
+        this thread (in the current request_scope, if any) wrote to the primary
+        engine in the last read_your_writes_window seconds, in which case the
+        write might not have reached the read engine yet.
+        '''
+        if self.read_engine is None:
+            return self.engine
+        last_write_time = getattr(self._local, 'last_write_time', None)
+        if last_write_time is not None and time.time() - last_write_time < self.read_your_writes_window:
+            return self.engine
+        return self.read_engine
 
     def make_clause(self, key, value):
         if isinstance(value, (list, set, tuple)):
@@ -174,7 +341,7 @@ class BundleModel(object):
         '''
         if len(uuids) == 0:
             return []
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(select([
                 cl_bundle_metadata.c.bundle_uuid,
                 cl_bundle_metadata.c.metadata_value
@@ -191,7 +358,7 @@ class BundleModel(object):
         '''
         if len(uuids) == 0:
             return []
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(select([
                 table.c.uuid,
                 table.c.owner_id,
@@ -207,7 +374,7 @@ class BundleModel(object):
         Get all bundles that depend on the bundle with the given uuids.
         Return {parent_uuid: [child_uuid, ...], ...}
         '''
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(select([
               cl_bundle_dependency.c.parent_uuid,
               cl_bundle_dependency.c.child_uuid,
@@ -223,11 +390,14 @@ class BundleModel(object):
         bundle_uuids = ['0x12435']
         Return {'0x12435': [host_worksheet_uuid, ...], ...}
         '''
-        with self.engine.begin() as connection:
-            rows = connection.execute(select([
-              cl_worksheet_item.c.worksheet_uuid,
-              cl_worksheet_item.c.bundle_uuid,
-            ]).where(cl_worksheet_item.c.bundle_uuid.in_(bundle_uuids))).fetchall()
+        bundle_uuids = list(bundle_uuids)
+        rows = []
+        with self._begin(read_only=True) as connection:
+            for i in range(0, len(bundle_uuids), self.DELETE_CHUNK_SIZE):
+                rows.extend(connection.execute(select([
+                  cl_worksheet_item.c.worksheet_uuid,
+                  cl_worksheet_item.c.bundle_uuid,
+                ]).where(cl_worksheet_item.c.bundle_uuid.in_(bundle_uuids[i:i + self.DELETE_CHUNK_SIZE]))).fetchall())
         result = dict((uuid, []) for uuid in bundle_uuids)
         for row in rows:
             result[row.bundle_uuid].append(row.worksheet_uuid)
@@ -240,22 +410,125 @@ class BundleModel(object):
         '''
         Get all bundles that depend on bundles with the given uuids.
         depth = 1 gets only children
+        Return the given uuids followed by their descendants in order of depth.
+        '''
+        result = list(uuids)
+        descendants = self.get_descendants(uuids, depth)
+        for uuid in uuids:
+            descendants.pop(uuid, None)
+        result.extend(sorted(descendants, key=lambda uuid: (descendants[uuid], uuid)))
+        return result
+
+    def _get_closure(self, column, other_column, uuids, depth):
+        if len(uuids) == 0 or (depth is not None and depth <= 0):
+            return {}
+        clause = column.in_(uuids)
+        if depth is not None:
+            clause = and_(clause, cl_bundle_closure.c.depth <= depth)
+        with self._begin(read_only=True) as connection:
+            rows = connection.execute(select([
+                other_column,
+                func.min(cl_bundle_closure.c.depth),
+            ]).where(clause).group_by(other_column)).fetchall()
+        return dict((row[0], row[1]) for row in rows)
+
+    def get_ancestors(self, uuids, depth=None):
+        '''
+        Get all bundles that bundles with the given uuids (transitively) depend
+        on, up to the given depth (depth = 1 gets only parents).
+        Return {ancestor_uuid: depth, ...}, where depth is the distance to the
+        closest of the given bundles.
+        '''
+        return self._get_closure(cl_bundle_closure.c.descendant_uuid, cl_bundle_closure.c.ancestor_uuid, uuids, depth)
+
+    def get_descendants(self, uuids, depth=None):
+        '''
+        Get all bundles that (transitively) depend on bundles with the given
+        uuids, up to the given depth (depth = 1 gets only children).
+        Return {descendant_uuid: depth, ...}, where depth is the distance to the
+        closest of the given bundles.
+        '''
+        return self._get_closure(cl_bundle_closure.c.ancestor_uuid, cl_bundle_closure.c.descendant_uuid, uuids, depth)
+
+    def count_descendants(self, uuids):
+        '''
+        Return {uuid: number of bundles that (transitively) depend on it, ...}
+        for the given uuids. Since a bundle has more descendants than any of its
+        descendants, sorting by this count puts descendants first.
+        '''
+        uuids = list(uuids)
+        result = dict((uuid, 0) for uuid in uuids)
+        with self._begin(read_only=True) as connection:
+            for i in range(0, len(uuids), self.DELETE_CHUNK_SIZE):
+                rows = connection.execute(select([
+                    cl_bundle_closure.c.ancestor_uuid,
+                    func.count(cl_bundle_closure.c.descendant_uuid),
+                ]).where(
+                    cl_bundle_closure.c.ancestor_uuid.in_(uuids[i:i + self.DELETE_CHUNK_SIZE])
+                ).group_by(cl_bundle_closure.c.ancestor_uuid)).fetchall()
+                result.update((row[0], row[1]) for row in rows)
+        return result
+
+    def get_provenance_subgraph(self, uuids, depth):
+        '''
+        Get the provenance graph around the bundles with the given uuids: their
+        ancestors and descendants up to the given depth, along with all the
+        dependencies between these bundles.
+        Return {'ancestors': {uuid: depth, ...}, 'descendants': {uuid: depth, ...},
+        'dependencies': [dependency row dict, ...]}
+        '''
+        ancestors = self.get_ancestors(uuids, depth)
+        descendants = self.get_descendants(uuids, depth)
+        nodes = set(uuids) | set(ancestors) | set(descendants)
+        with self._begin(read_only=True) as connection:
+            rows = connection.execute(cl_bundle_dependency.select().where(and_(
+                cl_bundle_dependency.c.child_uuid.in_(nodes),
+                cl_bundle_dependency.c.parent_uuid.in_(nodes),
+            )).order_by(cl_bundle_dependency.c.id)).fetchall()
+        return {
+            'ancestors': ancestors,
+            'descendants': descendants,
+            'dependencies': [str_key_dict(row) for row in rows],
+        }
+
+    def _update_bundle_closure(self, connection, uuids):
+        '''
+        Recompute the bundle_closure rows of the bundles with the given uuids and
+        of all their descendants from the current bundle_dependency rows.  This
+        must be called whenever the dependencies of these bundles change.
         '''
-        frontier = uuids
-        visited = list(frontier)
-        while len(frontier) > 0 and depth > 0:
-            # Get children of all nodes in frontier
-            result = self.get_children_uuids(frontier)
-            new_frontier = []
-            for l in result.values():
-                for uuid in l:
-                    if uuid in visited:
-                        continue
-                    new_frontier.append(uuid)
-                    visited.append(uuid)
-            frontier = new_frontier
-            depth -= 1
-        return visited
+        if len(uuids) == 0:
+            return
+        affected = set(uuids)
+        affected.update(row.descendant_uuid for row in connection.execute(
+            select([cl_bundle_closure.c.descendant_uuid]).where(cl_bundle_closure.c.ancestor_uuid.in_(uuids))
+        ))
+        connection.execute(cl_bundle_closure.delete().where(
+            cl_bundle_closure.c.descendant_uuid.in_(affected)
+        ))
+
+        parents = collections.defaultdict(set)
+        for row in connection.execute(select([
+            cl_bundle_dependency.c.child_uuid,
+            cl_bundle_dependency.c.parent_uuid,
+        ]).where(cl_bundle_dependency.c.child_uuid.in_(affected))):
+            parents[row.child_uuid].add(row.parent_uuid)
+
+        # The ancestors of parents outside of the affected set haven't changed.
+        external = set(parent for l in parents.values() for parent in l) - affected
+        known_ancestors = dict((uuid, {}) for uuid in external)
+        if external:
+            for row in connection.execute(cl_bundle_closure.select().where(
+                cl_bundle_closure.c.descendant_uuid.in_(external)
+            )):
+                known_ancestors[row.descendant_uuid][row.ancestor_uuid] = row.depth
+
+        ancestors = compute_ancestors(affected, parents, known_ancestors)
+        self.do_multirow_insert(connection, cl_bundle_closure, [
+            {'ancestor_uuid': ancestor_uuid, 'descendant_uuid': uuid, 'depth': depth}
+            for (uuid, l) in ancestors.iteritems()
+            for (ancestor_uuid, depth) in l.iteritems()
+        ])
 
     def search_bundle_uuids(self, user_id, worksheet_uuid, keywords):
         '''
@@ -264,6 +537,8 @@ class BundleModel(object):
         - <key>=<value>
         - .floating: return bundles not in any worksheet
         - .offset=<int>: return bundles starting at this offset
+        - .after=<token>: return bundles after the page that ended with this
+          continuation token (see search_bundle_uuids_page)
         - .limit=<int>: maximum number of bundles to return
         - .count: just return the number of bundles
         - .mine: sugar for owner_id=user_id
@@ -280,13 +555,26 @@ class BundleModel(object):
         Search only bundles which are readable by user_id.
         worksheet_uuid is not used right now.
         '''
+        return self.search_bundle_uuids_page(user_id, worksheet_uuid, keywords)['uuids']
+
+    def search_bundle_uuids_page(self, user_id, worksheet_uuid, keywords):
+        '''
+        Same as search_bundle_uuids, but return {'uuids': ..., 'next': ...}, where
+        next is a continuation token to pass as .after=<token> to get the next
+        page of results, or None if there are no more.
+        Results are ordered by the sort key (if any), then by id.
+        '''
         clauses = []
         offset = 0
         limit = 10
+        after = None
         format_func = None
         count = False
         sort_key = [None]
+        sort_desc = [False]
         sum_key = [None]
+        # What the structure of the query depends on (see _execute_search_query)
+        shape = ['bundles', user_id == self.root_user_id]
 
         # Number nested subqueries
         subquery_index = [0]
@@ -294,19 +582,23 @@ class BundleModel(object):
             subquery_index[0] += 1
             return clause.alias('q' + str(subquery_index[0]))
 
-        def is_numeric(key):
-            return key != 'name'
+        def is_numeric(key, field):
+            # Metadata values are stored as text, so they need to be cast to
+            # numbers; the typed columns (e.g., of bundle_search) don't.
+            return key != 'name' and field is cl_bundle_metadata.c.metadata_value
 
         def make_condition(key, field, value):
             # Special
             if value == '.sort':
-                if is_numeric(key): field = field * 1
+                if is_numeric(key, field): field = field * 1
                 sort_key[0] = field
+                sort_desc[0] = False
             elif value == '.sort-':
-                if is_numeric(key): field = field * 1
-                sort_key[0] = desc(field)
+                if is_numeric(key, field): field = field * 1
+                sort_key[0] = field
+                sort_desc[0] = True
             elif value == '.sum':
-                sum_key[0] = field * 1
+                sum_key[0] = field * 1 if is_numeric(key, field) else field
             else:
                 # Ordinary value
                 if isinstance(value, list):
@@ -333,8 +625,10 @@ class BundleModel(object):
             elif keyword == '.count':
                 count = True
                 limit = None
+                shape.append(keyword)
                 continue
             elif keyword == '.floating':
+                shape.append(keyword)
                 # Get bundles that have host worksheets, and then take the complement.
                 with_hosts = alias(select([cl_bundle.c.uuid]).where(cl_bundle.c.uuid == cl_worksheet_item.c.bundle_uuid))
                 clause = not_(cl_bundle.c.uuid.in_(with_hosts))
@@ -349,11 +643,14 @@ class BundleModel(object):
                     value = value.split(',')
             else:
                 key, value = 'uuid_name', keyword
+            shape.append((key, self._get_keyword_shape(key, value)))
 
             clause = None
             # Special functions
             if key == '.offset':
                 offset = int(value)
+            elif key == '.after':
+                after = value
             elif key == '.limit':
                 limit = int(value)
             elif key == '.format':
@@ -400,14 +697,17 @@ class BundleModel(object):
                     clause = cl_worksheet_item.c.bundle_uuid == cl_bundle.c.uuid  # Join constraint
                 else:
                     clause = cl_bundle.c.uuid.in_(alias(select([cl_worksheet_item.c.bundle_uuid]).where(condition)))
-            elif key == 'uuid_name': # Search uuid and name by default
-                clause = []
-                clause.append(cl_bundle.c.uuid.like('%' + value + '%'))
-                clause.append(cl_bundle.c.uuid.in_(alias(select([cl_bundle_metadata.c.bundle_uuid]).where(and_(
-                    cl_bundle_metadata.c.metadata_key == 'name',
-                    cl_bundle_metadata.c.metadata_value.like('%' + value + '%'),
-                )))))
-                clause = or_(*clause)
+            elif key == 'uuid_name': # Search uuid, name and description by default
+                condition = or_(
+                    cl_bundle_search.c.bundle_uuid.like('%' + value + '%'),
+                    cl_bundle_search.c.name.like('%' + value + '%'),
+                    cl_bundle_search.c.description.like('%' + value + '%'),
+                )
+                # Narrow down the candidates using the substring index.
+                candidates = self._search_token_query('bundle', value)
+                if candidates is not None:
+                    condition = and_(cl_bundle_search.c.bundle_uuid.in_(alias(candidates)), condition)
+                clause = cl_bundle.c.uuid.in_(alias(select([cl_bundle_search.c.bundle_uuid]).where(condition)))
             elif key == '':  # Match any field
                 clause = []
                 clause.append(cl_bundle.c.uuid.like('%' + value + '%'))
@@ -416,6 +716,16 @@ class BundleModel(object):
                     cl_bundle_metadata.c.metadata_value.like('%' + value + '%'),
                 ))))
                 clause = or_(*clause)
+            # Hot metadata fields, which have typed columns in bundle_search.
+            elif key in BUNDLE_SEARCH_KEYS:
+                condition = make_condition(key, cl_bundle_search.c[key], value)
+                if condition is None:  # top-level
+                    clause = and_(
+                        cl_bundle.c.uuid == cl_bundle_search.c.bundle_uuid,  # Join constraint
+                        cl_bundle_search.c[key] != None,  # Only bundles that have this key
+                    )
+                else:  # embedded
+                    clause = cl_bundle.c.uuid.in_(alias(select([cl_bundle_search.c.bundle_uuid]).where(condition)))
             # Otherwise, assume metadata.
             else:
                 condition = make_condition(key, cl_bundle_metadata.c.metadata_value, value)
@@ -453,23 +763,72 @@ class BundleModel(object):
             query = alias(select([cl_bundle.c.uuid, sum_key[0].label('num')]).distinct().where(clause))
             # Sum the numbers
             query = select([func.sum(query.c.num)])
+            if sort_key[0] is not None:
+                query = query.order_by(desc(sort_key[0]) if sort_desc[0] else sort_key[0])
         else:
-            query = select([cl_bundle.c.uuid]).distinct().where(clause).offset(offset).limit(limit)
-
-        # Sort
-        if sort_key[0] is not None:
-            query = query.order_by(sort_key[0])
+            if after is not None:
+                clause = and_(clause, self._make_keyset_clause(sort_key[0], sort_desc[0], cl_bundle.c.id, after))
+            query = self._make_keyset_query([cl_bundle.c.uuid, cl_bundle.c.id], sort_key[0], sort_desc[0], cl_bundle.c.id, clause)
+            query = query.offset(offset).limit(limit)
 
         # Count
         if count:
             query = alias(query).count()
 
-        #print 'QUERY', self._render_query(query)
-        result = self._execute_query(query)
-        #print 'RESULT', result
+        with self._begin(read_only=True) as connection:
+            rows = self._execute_search_query(connection, tuple(shape), query)
         if count or sum_key[0] is not None:  # Just returning a single number
-            return worksheet_util.apply_func(format_func, result[0])
-        return result
+            return {'uuids': worksheet_util.apply_func(format_func, rows[0][0]), 'next': None}
+        return {
+            'uuids': [row.uuid for row in rows],
+            'next': self._make_continuation_token(rows, sort_key[0], limit),
+        }
+
+    def _make_keyset_query(self, columns, sort_field, descending, id_column, clause):
+        '''
+        Select the distinct |columns| (which must include |id_column|) of the rows
+        matching |clause|, ordered by |sort_field| (if any) and then |id_column|,
+        going in the same direction.
+        '''
+        columns = list(columns)
+        if sort_field is not None:
+            columns.append(sort_field.label('sort_value'))
+        query = select(columns).distinct().where(clause)
+        order = [sort_field, id_column] if sort_field is not None else [id_column]
+        if descending:
+            order = [desc(field) for field in order]
+        return query.order_by(*order)
+
+    def _make_keyset_clause(self, sort_field, descending, id_column, token):
+        '''
+        Return a clause selecting the rows that come after the continuation token
+        in the order of _make_keyset_query.
+        NULL sort values come first in ascending order (and last in descending
+        order), and can't be compared with, so they need their own cases.
+        '''
+        sort_value, last_id = decode_continuation_token(token)
+        if descending:
+            after_id = id_column < last_id
+        else:
+            after_id = id_column > last_id
+        if sort_field is None:
+            return after_id
+        if sort_value is None:
+            same_value = and_(sort_field == None, after_id)
+            return same_value if descending else or_(sort_field != None, same_value)
+        same_value = and_(sort_field == sort_value, after_id)
+        if descending:
+            return or_(sort_field < sort_value, sort_field == None, same_value)
+        return or_(sort_field > sort_value, same_value)
+
+    def _make_continuation_token(self, rows, sort_field, limit):
+        '''
+        Return the continuation token for the page |rows| (None if it's the last).
+        '''
+        if limit is None or len(rows) < limit or not rows:
+            return None
+        last_row = rows[-1]
+        return encode_continuation_token(last_row.sort_value if sort_field is not None else None, last_row.id)
 
     def get_bundle_uuids(self, conditions, max_results):
         '''
@@ -508,6 +867,62 @@ class BundleModel(object):
 
         return self._execute_query(query)
 
+    def _get_keyword_shape(self, key, value):
+        '''
+        Return what the structure of a search query depends on in the value of
+        the keyword key=value (as opposed to its bind parameters).
+        '''
+        if key in ('.offset', '.limit', '.format'):
+            return None
+        if key == '.after':
+            sort_value, _ = decode_continuation_token(value)
+            return sort_value is None  # Compared with IS NULL
+        if isinstance(value, list):
+            return len(value)
+        if value in ('.sort', '.sort-', '.sum'):
+            return value
+        # LIKE or =, and the number of trigrams used by _search_token_query
+        return ('%' in value, len(get_query_search_tokens(value)))
+
+    def _execute_search_query(self, connection, shape, query):
+        '''
+        Execute |query| and return the rows, reusing the statement compiled for
+        a previous query with the same |shape|, a tuple describing everything
+        the structure of the query depends on: since identical structures have
+        the same bind parameters, only their values need to be swapped in.
+        Queries that take at least slow_query_threshold seconds are logged.
+        '''
+        binds = get_bind_params(query)
+        # The number of parameters is used as the version as a sanity check.
+        entry = self.query_cache.get(shape, len(binds))
+        if entry is None:
+            compiled = query.compile(dialect=connection.dialect)
+            entry = (compiled, [compiled.bind_names[bind] for bind in binds])
+            self.query_cache.put(shape, len(binds), entry)
+        compiled, names = entry
+        params = dict((name, bind.effective_value) for (name, bind) in zip(names, binds))
+        start_time = time.time()
+        rows = connection.execute(compiled, params).fetchall()
+        elapsed = time.time() - start_time
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            self._log_slow_query(connection, compiled, params, elapsed)
+        return rows
+
+    def _log_slow_query(self, connection, compiled, params, elapsed):
+        '''
+        Print a slow query, its parameters and its query plan to stderr.
+        '''
+        params = compiled.construct_params(params)
+        if compiled.positional:
+            params = [params[name] for name in compiled.positiontup]
+        explain = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+        plan = connection.execute(explain + compiled.string, params).fetchall()
+        print >>sys.stderr, '=== SLOW QUERY (%.3fs): %s' % (elapsed, compiled.string)
+        print >>sys.stderr, 'Parameters: %r' % (params,)
+        print >>sys.stderr, 'Query plan:'
+        for row in plan:
+            print >>sys.stderr, '  ' + ' | '.join(str(value) for value in row)
+
     # Helper function: return string representing SQL query.
     def _render_query(self, query):
         query = query.compile()
@@ -517,28 +932,52 @@ class BundleModel(object):
         return s
 
     def _execute_query(self, query):
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(query).fetchall()
         return [row[0] for row in rows]
 
     def batch_get_bundles(self, **kwargs):
         '''
         Return a list of bundles given a SQLAlchemy clause on the cl_bundle table.
+
+        Bundles in CACHED_BUNDLE_STATES are kept in an in-process cache, which is
+        validated against the version column of the bundle table.
         '''
         clause = self.make_kwargs_clause(cl_bundle, kwargs)
-        with self.engine.begin() as connection:
-            bundle_rows = connection.execute(
-              cl_bundle.select().where(clause)
-            ).fetchall()
-            if not bundle_rows:
+        cached_values = {}
+        with self._begin(read_only=True) as connection:
+            if len(self.bundle_cache) > 0:
+                # Only fetch the bundles whose cached copy is missing or stale.
+                version_rows = connection.execute(
+                  select([cl_bundle.c.uuid, cl_bundle.c.version]).where(clause)
+                ).fetchall()
+                for row in version_rows:
+                    value = self.bundle_cache.get(row.uuid, row.version)
+                    if value is not None:
+                        cached_values[row.uuid] = value
+                clause = self.make_clause(cl_bundle.c.uuid, [
+                  row.uuid for row in version_rows if row.uuid not in cached_values
+                ])
+                bundle_rows = connection.execute(
+                  cl_bundle.select().where(clause)
+                ).fetchall() if clause is not False else []
+            else:
+                bundle_rows = connection.execute(
+                  cl_bundle.select().where(clause)
+                ).fetchall()
+                self.bundle_cache.add_misses(len(bundle_rows))
+            if not bundle_rows and not cached_values:
                 return []
             uuids = set(bundle_row.uuid for bundle_row in bundle_rows)
-            dependency_rows = connection.execute(cl_bundle_dependency.select().where(
-              cl_bundle_dependency.c.child_uuid.in_(uuids)
-            ).order_by(cl_bundle_dependency.c.id)).fetchall()
-            metadata_rows = connection.execute(cl_bundle_metadata.select().where(
-              cl_bundle_metadata.c.bundle_uuid.in_(uuids)
-            )).fetchall()
+            if uuids:
+                dependency_rows = connection.execute(cl_bundle_dependency.select().where(
+                  cl_bundle_dependency.c.child_uuid.in_(uuids)
+                ).order_by(cl_bundle_dependency.c.id)).fetchall()
+                metadata_rows = connection.execute(cl_bundle_metadata.select().where(
+                  cl_bundle_metadata.c.bundle_uuid.in_(uuids)
+                )).fetchall()
+            else:
+                dependency_rows = metadata_rows = []
 
         # Make a dictionary for each bundle with both data and metadata.
         bundle_values = {row.uuid: str_key_dict(row) for row in bundle_rows}
@@ -554,16 +993,74 @@ class BundleModel(object):
                 raise IntegrityError('Got metadata %s without bundle' % (metadata_row,))
             bundle_values[metadata_row.bundle_uuid]['metadata'].append(metadata_row)
 
-        # Construct and validate all of the retrieved bundles.
-        sorted_values = sorted(bundle_values.itervalues(), key=lambda r: r['id'])
+        # Construct and validate all of the retrieved bundles (cached bundles
+        # were validated when they were first retrieved).
+        for bundle_value in bundle_values.itervalues():
+            if bundle_value['state'] in self.CACHED_BUNDLE_STATES:
+                self.bundle_cache.put(bundle_value['uuid'], bundle_value['version'], bundle_value)
+        sorted_values = sorted(bundle_values.values() + cached_values.values(), key=lambda r: r['id'])
         bundles = [
           get_bundle_subclass(bundle_value['bundle_type'])(bundle_value)
           for bundle_value in sorted_values
         ]
         for bundle in bundles:
-            bundle.validate()
+            if bundle.uuid in bundle_values:
+                bundle.validate()
         return bundles
 
+    def get_bundle_cache_stats(self):
+        '''
+        Return statistics (size, hits, misses, hit_rate) about the bundle cache.
+        '''
+        return self.bundle_cache.get_stats()
+
+    def batch_get_bundle_records(self, columns, metadata_keys=(), fetch_dependencies=False, **kwargs):
+        '''
+        Lightweight version of batch_get_bundles for hot paths that only need a
+        few fields of many bundles: return a list of BundleRecords with only the
+        given |columns| (plus id, uuid and bundle_type), the given |metadata_keys|
+        and, if |fetch_dependencies|, the dependency rows.  Nothing is validated.
+        '''
+        columns = set(columns) | set(['id', 'uuid', 'bundle_type'])
+        clause = self.make_kwargs_clause(cl_bundle, kwargs)
+        with self._begin(read_only=True) as connection:
+            bundle_rows = connection.execute(
+              select([cl_bundle.c[column] for column in columns]).where(clause).order_by(cl_bundle.c.id)
+            ).fetchall()
+            if not bundle_rows:
+                return []
+            uuids = set(bundle_row.uuid for bundle_row in bundle_rows)
+            if fetch_dependencies:
+                dependency_rows = connection.execute(cl_bundle_dependency.select().where(
+                  cl_bundle_dependency.c.child_uuid.in_(uuids)
+                ).order_by(cl_bundle_dependency.c.id)).fetchall()
+            if metadata_keys:
+                metadata_rows = connection.execute(select([
+                  cl_bundle_metadata.c.bundle_uuid,
+                  cl_bundle_metadata.c.metadata_key,
+                  cl_bundle_metadata.c.metadata_value,
+                ]).where(and_(
+                  cl_bundle_metadata.c.bundle_uuid.in_(uuids),
+                  cl_bundle_metadata.c.metadata_key.in_(metadata_keys),
+                ))).fetchall()
+
+        records = collections.OrderedDict((row.uuid, BundleRecord(str_key_dict(row))) for row in bundle_rows)
+        if fetch_dependencies:
+            for record in records.itervalues():
+                record.dependencies = []
+            for dep_row in dependency_rows:
+                records[dep_row.child_uuid].dependencies.append(dep_row)
+        if metadata_keys:
+            uuid_metadata_rows = collections.defaultdict(list)
+            for metadata_row in metadata_rows:
+                uuid_metadata_rows[metadata_row.bundle_uuid].append(metadata_row)
+            for record in records.itervalues():
+                # Convert the values to the right types using the specs of the requested keys.
+                specs = [spec for spec in get_bundle_subclass(record.bundle_type).METADATA_SPECS
+                         if spec.key in metadata_keys]
+                record.metadata = Metadata.collapse_dicts(specs, uuid_metadata_rows[record.uuid])
+        return records.values()
+
     def batch_update_bundles(self, bundles, update, condition=None):
         '''
         Update a list of bundles given a dict mapping columns to new values and
@@ -582,9 +1079,9 @@ class BundleModel(object):
             clause = cl_bundle.c.id.in_(bundle_ids)
             if condition:
                 clause = and_(clause, self.make_kwargs_clause(cl_bundle, condition))
-            with self.engine.begin() as connection:
+            with self._begin() as connection:
                 result = connection.execute(
-                  cl_bundle.update().where(clause).values(update)
+                  cl_bundle.update().where(clause).values(dict(update, version=cl_bundle.c.version + 1))
                 )
                 success = result.rowcount == len(bundle_ids)
                 if success:
@@ -594,11 +1091,11 @@ class BundleModel(object):
         return True
 
     def add_bundle_action(self, uuid, action):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(cl_bundle_action.insert().values({'bundle_uuid': uuid, 'action': action}))
 
     def pop_bundle_actions(self):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             results = connection.execute(cl_bundle_action.select()).fetchall()  # Get the actions
             connection.execute(cl_bundle_action.delete())  # Delete all actions
             return [x for x in results]
@@ -607,19 +1104,71 @@ class BundleModel(object):
         '''
         Save a bundle. On success, sets the Bundle object's id from the result.
         '''
-        bundle.validate()
-        bundle_value = bundle.to_dict()
-        dependency_values = bundle_value.pop('dependencies')
-        metadata_values = bundle_value.pop('metadata')
-
-        # Check to see if bundle is already present, as in a local 'cl cp'
-        if not self.batch_get_bundles(uuid=bundle.uuid):
-            with self.engine.begin() as connection:
-                result = connection.execute(cl_bundle.insert().values(bundle_value))
-                self.do_multirow_insert(connection, cl_bundle_dependency, dependency_values)
-                self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
-                bundle.id = result.lastrowid
+        self.save_bundles([bundle])
 
+    def save_bundles(self, bundles):
+        '''
+        Save a list of bundles in a single transaction, using one query to check
+        which ones already exist and multi-row inserts for everything else.
+        On success, sets the id of each saved Bundle object.
+        '''
+        if not bundles:
+            return
+        for bundle in bundles:
+            bundle.validate()
+
+        with self._begin() as connection:
+            # Skip bundles which are already present, as in a local 'cl cp'
+            uuids = [bundle.uuid for bundle in bundles]
+            existing_uuids = set(row.uuid for row in connection.execute(
+                select([cl_bundle.c.uuid]).where(cl_bundle.c.uuid.in_(uuids))
+            ))
+            new_bundles = []
+            for bundle in bundles:
+                if bundle.uuid not in existing_uuids:
+                    existing_uuids.add(bundle.uuid)
+                    new_bundles.append(bundle)
+            if not new_bundles:
+                return
+
+            bundle_values = []
+            dependency_values = []
+            metadata_values = []
+            search_values = []
+            search_token_values = []
+            for bundle in new_bundles:
+                bundle_value = bundle.to_dict()
+                dependency_values.extend(bundle_value.pop('dependencies'))
+                bundle_metadata_values = bundle_value.pop('metadata')
+                metadata_values.extend(bundle_metadata_values)
+                bundle_values.append(bundle_value)
+                search_value = bundle_search_values(bundle_metadata_values)
+                search_value['bundle_uuid'] = bundle.uuid
+                search_values.append(search_value)
+                search_token_values.extend(
+                    {'object_type': 'bundle', 'object_uuid': bundle.uuid, 'token': token}
+                    for token in get_search_tokens(bundle.uuid, search_value['name'], search_value['description'])
+                )
+
+            new_uuids = [bundle.uuid for bundle in new_bundles]
+            self.do_multirow_insert(connection, cl_bundle, bundle_values)
+            self.do_multirow_insert(connection, cl_bundle_dependency, dependency_values)
+            self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+            self._update_bundle_closure(connection, new_uuids)
+            self.do_multirow_insert(connection, cl_bundle_search, search_values)
+            connection.execute(cl_search_token.delete().where(and_(
+                cl_search_token.c.object_type == 'bundle',
+                cl_search_token.c.object_uuid.in_(new_uuids),
+            )))
+            self.do_multirow_insert(connection, cl_search_token, search_token_values)
+            self._apply_disk_used_deltas(connection, {}, self._get_disk_used_by_owner(connection, new_uuids))
+
+            # Multi-row inserts don't return the new ids, so look them up.
+            ids = dict(connection.execute(
+                select([cl_bundle.c.uuid, cl_bundle.c.id]).where(cl_bundle.c.uuid.in_(new_uuids))
+            ).fetchall())
+            for bundle in new_bundles:
+                bundle.id = ids[bundle.uuid]
 
     def update_bundle(self, bundle, update):
         '''
@@ -639,8 +1188,7 @@ class BundleModel(object):
             bundle.metadata.set_metadata_key(key, value)
         bundle.validate()
         # Construct clauses and update lists for updating certain bundle columns.
-        if update:
-            clause = cl_bundle.c.uuid == bundle.uuid
+        clause = cl_bundle.c.uuid == bundle.uuid
         if metadata_update:
             metadata_clause = and_(
               cl_bundle_metadata.c.bundle_uuid == bundle.uuid,
@@ -650,27 +1198,97 @@ class BundleModel(object):
               row_dict for row_dict in bundle.to_dict().pop('metadata')
               if row_dict['metadata_key'] in metadata_update
             ]
+            search_keys = [key for key in metadata_update if key in BUNDLE_SEARCH_KEYS]
+        # Only these fields affect how much disk the bundle counts against its owner.
+        affects_disk_used = 'data_hash' in update or 'owner_id' in update or 'data_size' in metadata_update
         # Perform the actual updates.
-        with self.engine.begin() as connection:
-            if update:
-                connection.execute(cl_bundle.update().where(clause).values(update))
+        with self._begin() as connection:
+            if affects_disk_used:
+                old_disk_used = self._get_disk_used_by_owner(connection, [bundle.uuid])
+            # Always bump the version, since cached copies include the metadata.
+            connection.execute(cl_bundle.update().where(clause).values(dict(update, version=cl_bundle.c.version + 1)))
             if metadata_update:
                 connection.execute(cl_bundle_metadata.delete().where(metadata_clause))
                 self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+                if search_keys:
+                    self._update_bundle_search(connection, bundle, search_keys, metadata_values)
+            if affects_disk_used:
+                self._apply_disk_used_deltas(connection, old_disk_used,
+                                             self._get_disk_used_by_owner(connection, [bundle.uuid]))
+
+    def _update_bundle_search(self, connection, bundle, search_keys, metadata_values):
+        '''
+        Update the bundle_search columns |search_keys| of the given bundle from
+        the (new) metadata rows |metadata_values|.
+        '''
+        search_value = bundle_search_values(metadata_values)
+        search_value = dict((key, search_value[key]) for key in search_keys)
+        result = connection.execute(cl_bundle_search.update().where(
+            cl_bundle_search.c.bundle_uuid == bundle.uuid
+        ).values(search_value))
+        if result.rowcount == 0:
+            # No row yet, so build the whole thing from the bundle's metadata.
+            search_value = bundle_search_values(bundle.to_dict()['metadata'])
+            search_value['bundle_uuid'] = bundle.uuid
+            connection.execute(cl_bundle_search.insert().values(search_value))
+        if 'name' in search_keys or 'description' in search_keys:
+            search_value = bundle_search_values(bundle.to_dict()['metadata'])
+            self._update_search_tokens(connection, 'bundle', bundle.uuid,
+                                       [bundle.uuid, search_value['name'], search_value['description']])
+
+    def _update_search_tokens(self, connection, object_type, object_uuid, strings):
+        '''
+        Replace the substring index entries of the given object (bundle or
+        worksheet) with the trigrams of |strings|.
+        '''
+        connection.execute(cl_search_token.delete().where(and_(
+            cl_search_token.c.object_type == object_type,
+            cl_search_token.c.object_uuid == object_uuid,
+        )))
+        self.do_multirow_insert(connection, cl_search_token, [
+            {'object_type': object_type, 'object_uuid': object_uuid, 'token': token}
+            for token in get_search_tokens(*strings)
+        ])
+
+    def _search_token_query(self, object_type, value):
+        '''
+        Return a query selecting the uuids of the objects of the given type whose
+        indexed strings contain every trigram of the LIKE pattern |value|, or None
+        if |value| is too short to have any.  The result is a superset of the
+        matches, so it should be combined with the actual LIKE clause.
+        '''
+        tokens = get_query_search_tokens(value)
+        if not tokens:
+            return None
+        return select([cl_search_token.c.object_uuid]).where(and_(
+            cl_search_token.c.object_type == object_type,
+            cl_search_token.c.token.in_(tokens),
+        )).group_by(cl_search_token.c.object_uuid).having(
+            func.count(cl_search_token.c.token.distinct()) == len(tokens)
+        )
 
     def get_bundle_states(self, uuids):
         '''
         Return {uuid: state, ...}
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             rows = connection.execute(select([cl_bundle.c.uuid, cl_bundle.c.state]).where(cl_bundle.c.uuid.in_(uuids))).fetchall()
             return dict((r.uuid, r.state) for r in rows)
 
     def delete_bundles(self, uuids):
         '''
-        Delete bundles with the given uuids.
+        Delete bundles with the given uuids, DELETE_CHUNK_SIZE at a time, each
+        chunk in its own transaction. Descendants should come before their
+        ancestors, so that if this is interrupted, the bundles left are still
+        consistent and can be deleted by calling this again.
         '''
-        with self.engine.begin() as connection:
+        for i in range(0, len(uuids), self.DELETE_CHUNK_SIZE):
+            self._delete_bundle_chunk(uuids[i:i + self.DELETE_CHUNK_SIZE])
+            self._commit_unit_of_work()
+
+    def _delete_bundle_chunk(self, uuids):
+        with self._begin() as connection:
+            self._apply_disk_used_deltas(connection, self._get_disk_used_by_owner(connection, uuids), {})
             # We must delete bundles rows in the opposite order that we create them
             # to avoid foreign-key constraint failures.
             connection.execute(cl_group_bundle_permission.delete().where(
@@ -682,19 +1300,38 @@ class BundleModel(object):
             connection.execute(cl_bundle_metadata.delete().where(
                 cl_bundle_metadata.c.bundle_uuid.in_(uuids)
             ))
+            connection.execute(cl_bundle_search.delete().where(
+                cl_bundle_search.c.bundle_uuid.in_(uuids)
+            ))
+            connection.execute(cl_search_token.delete().where(and_(
+                cl_search_token.c.object_type == 'bundle',
+                cl_search_token.c.object_uuid.in_(uuids),
+            )))
             connection.execute(cl_bundle_dependency.delete().where(
                 cl_bundle_dependency.c.child_uuid.in_(uuids)
             ))
-            connection.execute(cl_bundle_contents_index.delete().where(
-                cl_bundle_contents_index.c.bundle_uuid.in_(uuids)
+            self._update_bundle_closure(connection, uuids)
+            connection.execute(cl_bundle_contents_delta.delete().where(
+                cl_bundle_contents_delta.c.bundle_uuid.in_(uuids)
+            ))
+            connection.execute(cl_bundle_contents_chunk.delete().where(
+                cl_bundle_contents_chunk.c.bundle_uuid.in_(uuids)
             ))
             connection.execute(cl_bundle.delete().where(
                 cl_bundle.c.uuid.in_(uuids)
             ))
+        self.bundle_cache.invalidate(uuids)
 
     def remove_data_hash_references(self, uuids):
-        with self.engine.begin() as connection:
-            connection.execute(cl_bundle.update().where(cl_bundle.c.uuid.in_(uuids)).values({'data_hash': None}))
+        for i in range(0, len(uuids), self.DELETE_CHUNK_SIZE):
+            chunk = uuids[i:i + self.DELETE_CHUNK_SIZE]
+            with self._begin() as connection:
+                self._apply_disk_used_deltas(connection, self._get_disk_used_by_owner(connection, chunk), {})
+                connection.execute(cl_bundle.update().where(cl_bundle.c.uuid.in_(chunk)).values({
+                    'data_hash': None,
+                    'version': cl_bundle.c.version + 1,
+                }))
+            self._commit_unit_of_work()
 
     def update_bundle_contents_index(self, uuid, index):
         """
@@ -702,68 +1339,158 @@ class BundleModel(object):
         values.
 
         For reference on the format of index, see
-        worker.file_util.index_contents.
+        worker.file_util.index_contents. For how it's stored, see
+        codalab.model.contents_index.
         """
-        rows = []
-        def recurse(entry, parent_path):
-            entry['bundle_uuid'] = uuid
-            entry['path'] = os.path.join(parent_path, entry['name'])
-            del entry['name']
-            if 'contents' in entry:
-                for child_entry in entry['contents']:
-                    recurse(child_entry, entry['path'])
-                del entry['contents']
-            if 'link' not in entry:
-                entry['link'] = None
-            rows.append(entry)
-        index_copy = copy.deepcopy(index)
-        if index_copy['name'] != uuid:
+        if index['name'] != uuid:
             raise UsageError(
                 'Valid indices have the directory with the name as the UUID '
                 'being the top-level directory.')
-        # Clear the top-level name to save space in the database.
-        index_copy['name'] = ''
-        recurse(index_copy, '/')
-        with self.engine.begin() as connection:
-            connection.execute(cl_bundle_contents_index.delete().where(
-                cl_bundle_contents_index.c.bundle_uuid == uuid
+        rows = make_chunks(flatten_index(index))
+        for row in rows:
+            row['bundle_uuid'] = uuid
+        with self._begin() as connection:
+            connection.execute(cl_bundle_contents_delta.delete().where(
+                cl_bundle_contents_delta.c.bundle_uuid == uuid
+            ))
+            connection.execute(cl_bundle_contents_chunk.delete().where(
+                cl_bundle_contents_chunk.c.bundle_uuid == uuid
             ))
-            self.do_multirow_insert(connection, cl_bundle_contents_index, rows)
+            self.do_multirow_insert(connection, cl_bundle_contents_chunk, rows)
+
+    def add_bundle_contents_deltas(self, uuid, deltas):
+        """
+        Records changes to the contents index of the given bundle, e.g. as the
+        files of a running bundle change. They're visible to lookups right
+        away, and are applied to the stored index by
+        merge_bundle_contents_deltas.
+
+        For reference on the format of deltas, see
+        codalab.model.contents_index.delta_to_entry. Removing a directory
+        doesn't remove its contents until the deltas are merged, so they should
+        be removed too.
+        """
+        rows = []
+        for delta in deltas:
+            if delta.get('action') not in DELTA_ACTIONS:
+                raise UsageError('Invalid contents index delta action: %r' % (delta.get('action'),))
+            key, entry = delta_to_entry(delta)
+            rows.append({
+                'bundle_uuid': uuid,
+                'key': key,
+                'entry': None if entry is None else json.dumps(entry),
+            })
+        with self._begin() as connection:
+            self.do_multirow_insert(connection, cl_bundle_contents_delta, rows)
+
+    def merge_bundle_contents_deltas(self, uuid):
+        """
+        Applies the changes recorded by add_bundle_contents_deltas to the
+        stored contents index of the given bundle.
+        """
+        with self._begin() as connection:
+            max_id = connection.execute(
+                select([func.max(cl_bundle_contents_delta.c.id)])
+                    .where(cl_bundle_contents_delta.c.bundle_uuid == uuid)
+            ).scalar()
+            if max_id is None:
+                return
+            entries = remove_orphans(self._get_contents_entries(connection, uuid, max_delta_id=max_id))
+            rows = make_chunks(entries)
+            for row in rows:
+                row['bundle_uuid'] = uuid
+            connection.execute(cl_bundle_contents_delta.delete().where(and_(
+                cl_bundle_contents_delta.c.bundle_uuid == uuid,
+                cl_bundle_contents_delta.c.id <= max_id,
+            )))
+            connection.execute(cl_bundle_contents_chunk.delete().where(
+                cl_bundle_contents_chunk.c.bundle_uuid == uuid
+            ))
+            self.do_multirow_insert(connection, cl_bundle_contents_chunk, rows)
 
     def get_bundle_contents_index(self, uuid):
         """
         For reference on the format of the returned index, see
         worker.file_util.index_contents.
         """
-        with self.engine.begin() as connection:
-            # Sort so that all directories appear before the files inside them.
-            rows = connection.execute(
-                cl_bundle_contents_index.select()
-                    .where(cl_bundle_contents_index.c.bundle_uuid == uuid)
-                    .order_by(cl_bundle_contents_index.c.path)
-            ).fetchall()
+        with self._begin(read_only=True) as connection:
+            entries = self._get_contents_entries(connection, uuid)
+        return build_index(entries, uuid)
 
-        if not rows:
-            return None
-
-        directories = {}
-        for row in rows:
-            result = str_key_dict(row)
-            del result['bundle_uuid']
-            del result['path']
-            if result['link'] is None:
-                del result['link']
-            if row.path == '/':
-                result['name'] = uuid
-                if row.type != 'directory':
-                    return result
-            else:
-                result['name'] = os.path.basename(row.path)
-                directories[os.path.dirname(row.path)]['contents'].append(result)
-            if row.type == 'directory':
-                result['contents'] = []
-                directories[row.path] = result
-        return directories['/']
+    def get_bundle_contents_target_info(self, uuid, path, depth):
+        """
+        Returns the part of the contents index of the given bundle for the
+        target at path, including at most depth levels of contents (all of them
+        if depth is None), or None if the target doesn't exist. The result is
+        the same as that of worker.file_util.restrict_contents_index, but only
+        the entries needed are read.
+        """
+        with self._begin(read_only=True) as connection:
+            if depth is None:
+                max_keys = [
+                    connection.execute(
+                        select([func.max(column)]).where(table.c.bundle_uuid == uuid)
+                    ).scalar()
+                    for (table, column) in [
+                        (cl_bundle_contents_chunk, cl_bundle_contents_chunk.c.last_key),
+                        (cl_bundle_contents_delta, cl_bundle_contents_delta.c.key),
+                    ]
+                ]
+                max_keys = [key for key in max_keys if key is not None]
+                if not max_keys:
+                    return None
+                depth = max(key_depth(max(max_keys)) - path_depth(path), 0)
+            entries = self._get_contents_entries(connection, uuid, target_key_ranges(path, depth))
+        return build_index(entries, uuid, path, depth)
+
+    def _get_contents_entries(self, connection, uuid, key_ranges=None, max_delta_id=None):
+        """
+        Return the sorted entries of the contents index of the given bundle
+        whose keys are in one of the sorted ranges [low, high) given, or all of
+        them if key_ranges is None, only decoding the chunks that overlap the
+        ranges. The deltas recorded for the bundle (up to max_delta_id, if
+        given) are applied.
+        """
+        def make_range_clause(table, low_column, high_column):
+            clause = table.c.bundle_uuid == uuid
+            if key_ranges is not None:
+                clause = and_(clause, or_(*[
+                    and_(high_column >= low, low_column < high) for (low, high) in key_ranges
+                ]))
+            return clause
+
+        def in_ranges(key):
+            return key_ranges is None or any(low <= key < high for (low, high) in key_ranges)
+
+        chunk_rows = connection.execute(
+            select([cl_bundle_contents_chunk.c.data])
+                .where(make_range_clause(
+                    cl_bundle_contents_chunk,
+                    cl_bundle_contents_chunk.c.first_key,
+                    cl_bundle_contents_chunk.c.last_key))
+                .order_by(cl_bundle_contents_chunk.c.first_key)
+        ).fetchall()
+        entries = []
+        for row in chunk_rows:
+            for entry in decode_chunk(row.data):
+                if in_ranges(entry_key(entry[0], entry[1])):
+                    entries.append(entry)
+
+        delta_clause = make_range_clause(
+            cl_bundle_contents_delta, cl_bundle_contents_delta.c.key, cl_bundle_contents_delta.c.key)
+        if max_delta_id is not None:
+            delta_clause = and_(delta_clause, cl_bundle_contents_delta.c.id <= max_delta_id)
+        delta_rows = connection.execute(
+            select([cl_bundle_contents_delta.c.key, cl_bundle_contents_delta.c.entry])
+                .where(delta_clause)
+                .order_by(cl_bundle_contents_delta.c.id)
+        ).fetchall()
+        if delta_rows:
+            entries = apply_deltas(entries, [
+                (row.key, None if row.entry is None else json.loads(row.entry))
+                for row in delta_rows
+            ])
+        return entries
 
     #############################################################################
     # Worksheet-related model methods follow!
@@ -792,7 +1519,7 @@ class BundleModel(object):
                 cl_worksheet_item.c.subworksheet_uuid == cl_worksheet.c.uuid,
                 cl_worksheet_item.c.worksheet_uuid == base_worksheet_uuid)
 
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             worksheet_rows = connection.execute(
               cl_worksheet.select().distinct().where(clause)
             ).fetchall()
@@ -839,10 +1566,22 @@ class BundleModel(object):
         their existing worksheets.
         Note: keywords has basically same semantics as search_bundle_uuids.
         '''
+        return self.search_worksheets_page(user_id, keywords)['worksheets']
+
+    def search_worksheets_page(self, user_id, keywords):
+        '''
+        Same as search_worksheets, but return {'worksheets': ..., 'next': ...},
+        where next is a continuation token to pass as .after=<token> to get the
+        next page of results, or None if there are no more.
+        '''
         clauses = []
         offset = 0
         limit = 1000
+        after = None
         sort_key = [cl_worksheet.c.name]
+        sort_desc = [False]
+        # What the structure of the query depends on (see _execute_search_query)
+        shape = ['worksheets', user_id == self.root_user_id]
 
         # Number nested subqueries
         subquery_index = [0]
@@ -854,8 +1593,10 @@ class BundleModel(object):
             # Special
             if value == '.sort':
                 sort_key[0] = field
+                sort_desc[0] = False
             elif value == '.sort-':
-                sort_key[0] = desc(field)
+                sort_key[0] = field
+                sort_desc[0] = True
             else:
                 # Ordinary value
                 if isinstance(value, list):
@@ -882,11 +1623,14 @@ class BundleModel(object):
                     value = value.split(',')
             else:
                 key, value = 'uuid_name', keyword
+            shape.append((key, self._get_keyword_shape(key, value)))
 
             clause = None
             # Special functions
             if key == '.offset':
                 offset = int(value)
+            elif key == '.after':
+                after = value
             elif key == '.limit':
                 limit = int(value)
             # Bundle fields
@@ -921,6 +1665,10 @@ class BundleModel(object):
                     cl_worksheet.c.uuid.like('%' + value + '%'),
                     cl_worksheet.c.name.like('%' + value + '%'),
                 )
+                # Narrow down the candidates using the substring index.
+                candidates = self._search_token_query('worksheet', value)
+                if candidates is not None:
+                    clause = and_(cl_worksheet.c.uuid.in_(alias(candidates)), clause)
             elif key == '':  # Match any field
                 clause = []
                 clause.append(cl_worksheet.c.uuid.like('%' + value + '%'))
@@ -946,23 +1694,23 @@ class BundleModel(object):
             )))
             clause = and_(clause, or_(access_via_owner, access_via_group))
 
+        if after is not None:
+            clause = and_(clause, self._make_keyset_clause(sort_key[0], sort_desc[0], cl_worksheet.c.id, after))
+
         cols_to_select = [cl_worksheet.c.id,
                           cl_worksheet.c.uuid,
                           cl_worksheet.c.name,
                           cl_worksheet.c.title,
                           cl_worksheet.c.frozen,
                           cl_worksheet.c.owner_id]
-        query = select(cols_to_select).distinct().where(clause).offset(offset).limit(limit)
-
-        # Sort
-        if sort_key[0] is not None:
-            query = query.order_by(sort_key[0])
+        query = self._make_keyset_query(cols_to_select, sort_key[0], sort_desc[0], cl_worksheet.c.id, clause)
+        query = query.offset(offset).limit(limit)
 
-        #print self._render_query(query)
-        with self.engine.begin() as connection:
-            rows = connection.execute(query).fetchall()
+        with self._begin(read_only=True) as connection:
+            rows = self._execute_search_query(connection, tuple(shape), query)
             if not rows:
-                return []
+                return {'worksheets': [], 'next': None}
+        next_token = self._make_continuation_token(rows, sort_key[0], limit)
 
         # Get permissions of the worksheets
         worksheet_uuids = [row.uuid for row in rows]
@@ -972,10 +1720,11 @@ class BundleModel(object):
         row_dicts = []
         for row in rows:
             row = str_key_dict(row)
+            row.pop('sort_value', None)
             row['group_permissions'] = uuid_group_permissions[row['uuid']]
             row_dicts.append(row)
 
-        return row_dicts
+        return {'worksheets': row_dicts, 'next': next_token}
 
     def new_worksheet(self, worksheet):
         '''
@@ -988,8 +1737,9 @@ class BundleModel(object):
         worksheet_value.pop('tags')
         worksheet_value.pop('items')
         worksheet_value.pop('last_item_id')
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             result = connection.execute(cl_worksheet.insert().values(worksheet_value))
+            self._update_search_tokens(connection, 'worksheet', worksheet.uuid, [worksheet.uuid, worksheet.name])
             worksheet.id = result.lastrowid
 
     def add_worksheet_item(self, worksheet_uuid, item):
@@ -1008,35 +1758,60 @@ class BundleModel(object):
           'type': type,
           'sort_key': None,
         }
-        with self.engine.begin() as connection:
-            connection.execute(cl_worksheet_item.insert().values(item_value))
+        with self._begin() as connection:
+            result = connection.execute(cl_worksheet_item.insert().values(item_value))
+            # See codalab.objects.worksheet for an explanation of the sort_key protocol.
+            item_id = result.inserted_primary_key[0]
+            connection.execute(cl_worksheet_item.update().where(
+                cl_worksheet_item.c.id == item_id
+            ).values({'sort_key': item_id}))
+
+    def get_worksheet_items(self, worksheet_uuid, after=None, limit=None):
+        '''
+        Return {'items': ..., 'next': ...}, where items are the row dicts of
+        the items of the given worksheet in order, starting after the page that
+        ended with the continuation token |after| (if any) and up to |limit|
+        of them (if any), and next is the continuation token for the next page,
+        or None if there are no more.
+        '''
+        clause = cl_worksheet_item.c.worksheet_uuid == worksheet_uuid
+        if after is not None:
+            clause = and_(clause, self._make_keyset_clause(
+                cl_worksheet_item.c.sort_key, False, cl_worksheet_item.c.id, after))
+        query = self._make_keyset_query(
+            cl_worksheet_item.c, cl_worksheet_item.c.sort_key, False, cl_worksheet_item.c.id, clause)
+        if limit is not None:
+            query = query.limit(limit)
+        with self._begin(read_only=True) as connection:
+            rows = connection.execute(query).fetchall()
+        items = []
+        for row in rows:
+            item = str_key_dict(row)
+            del item['sort_value']
+            item['value'] = self.decode_str(item['value'])
+            items.append(item)
+        return {'items': items, 'next': self._make_continuation_token(rows, cl_worksheet_item.c.sort_key, limit)}
 
     def add_shadow_worksheet_items(self, old_bundle_uuid, new_bundle_uuid):
         '''
         For each occurrence of old_bundle_uuid in any worksheet, add
         new_bundle_uuid right after it (a shadow).
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             # Find all the worksheet_items that old_bundle_uuid appears in
             query = select([cl_worksheet_item.c.worksheet_uuid, cl_worksheet_item.c.sort_key]).where(cl_worksheet_item.c.bundle_uuid == old_bundle_uuid)
-            old_items = connection.execute(query)
-            #print 'add_shadow_worksheet_items', old_items
-
-            # Go through and insert a worksheet item with new_bundle_uuid after
-            # each of the old items.
-            new_items = []
-            for old_item in old_items:
-                new_item = {
-                  'worksheet_uuid': old_item.worksheet_uuid,
-                  'bundle_uuid': new_bundle_uuid,
-                  'type': worksheet_util.TYPE_BUNDLE,
-                  'value': '',  # TODO: replace with None once we change tables.py
-                  'sort_key': old_item.sort_key,  # Can't really do after, so use the same value.
-                }
-                new_items.append(new_item)
-                connection.execute(cl_worksheet_item.insert().values(new_item))
-            # sqlite doesn't support batch insertion
-            #connection.execute(cl_worksheet_item.insert().values(new_items))
+            old_items = connection.execute(query).fetchall()
+
+            # Insert a worksheet item with new_bundle_uuid after each of the old
+            # items.
+            new_items = [{
+              'worksheet_uuid': old_item.worksheet_uuid,
+              'bundle_uuid': new_bundle_uuid,
+              'type': worksheet_util.TYPE_BUNDLE,
+              'value': '',  # TODO: replace with None once we change tables.py
+              'sort_key': old_item.sort_key,  # Can't really do after, so use the same value.
+            } for old_item in old_items]
+            self.do_multirow_insert(connection, cl_worksheet_item, new_items)
 
     def update_worksheet_items(self, worksheet_uuid, last_item_id, length, new_items):
         '''
@@ -1050,31 +1825,129 @@ class BundleModel(object):
 
         If this worksheet were updated between the time it was retrieved and
         updated, this method will raise a UsageError.
+
+        Only the difference between the old and new items is written: items
+        that are kept stay in place (unless the ones before an insertion have
+        to be moved down to make room), removed items are deleted and added items are inserted. So a
+        concurrent update is detected if it removed any of the old items, or
+        inserted items among them: those have a larger id than last_item_id but
+        a sort key that isn't, unlike the items appended since.
         '''
         clause = and_(
           cl_worksheet_item.c.worksheet_uuid == worksheet_uuid,
           cl_worksheet_item.c.id <= last_item_id,
         )
-        # See codalab.objects.worksheet for an explanation of the sort_key protocol.
-        # We need to produce sort keys here that are strictly upper-bounded by the
-        # last known item id in this worksheet, and which monotonically increase.
-        # The expression last_item_id + i - len(new_items) works. It can produce
-        # negative sort keys, but that's fine.
-        new_item_values = [{
-          'worksheet_uuid': worksheet_uuid,
-          'bundle_uuid': bundle_uuid,
-          'subworksheet_uuid': subworksheet_uuid,
-          'value': self.encode_str(value),
-          'type': type,
-          'sort_key': (last_item_id + i - len(new_items)),
-        } for (i, (bundle_uuid, subworksheet_uuid, value, type)) in enumerate(new_items)]
-        with self.engine.begin() as connection:
-            result = connection.execute(cl_worksheet_item.delete().where(clause))
+        with self._begin() as connection:
+            # Lock the worksheet, so that concurrent updates see each other's
+            # items instead of both passing the checks below.
+            connection.execute(select([cl_worksheet.c.id]).where(
+                cl_worksheet.c.uuid == worksheet_uuid
+            ).with_for_update())
+            old_rows = connection.execute(select([
+                cl_worksheet_item.c.id,
+                cl_worksheet_item.c.bundle_uuid,
+                cl_worksheet_item.c.subworksheet_uuid,
+                cl_worksheet_item.c.value,
+                cl_worksheet_item.c.type,
+                cl_worksheet_item.c.sort_key,
+            ]).where(clause)).fetchall()
             message = 'Found extra items for worksheet %s' % (worksheet_uuid,)
-            precondition(result.rowcount <= length, message)
-            if result.rowcount < length:
+            precondition(len(old_rows) <= length, message)
+            if len(old_rows) < length:
+                raise UsageError('Worksheet %s was updated concurrently!' % (worksheet_uuid,))
+            inserted_row = connection.execute(select([cl_worksheet_item.c.id]).where(and_(
+                cl_worksheet_item.c.worksheet_uuid == worksheet_uuid,
+                cl_worksheet_item.c.id > last_item_id,
+                cl_worksheet_item.c.sort_key <= last_item_id,
+            )).limit(1)).fetchone()
+            if inserted_row is not None:
                 raise UsageError('Worksheet %s was updated concurrently!' % (worksheet_uuid,))
-            self.do_multirow_insert(connection, cl_worksheet_item, new_item_values)
+
+            # Match up the old and new items.
+            old_rows.sort(key=item_sort_key)
+            old_items = [
+                (row.bundle_uuid, row.subworksheet_uuid, self.decode_str(row.value), row.type)
+                for row in old_rows
+            ]
+            new_items = [tuple(item) for item in new_items]
+            kept_rows = [None] * len(new_items)
+            matcher = difflib.SequenceMatcher(None, old_items, new_items, autojunk=False)
+            for (i, j, size) in matcher.get_matching_blocks():
+                kept_rows[j:j + size] = old_rows[i:i + size]
+            sort_keys = self._get_new_item_sort_keys(
+                [None if row is None else item_sort_key(row)[0] for row in kept_rows], last_item_id)
+
+            kept_ids = set(row.id for row in kept_rows if row is not None)
+            deleted_ids = [row.id for row in old_rows if row.id not in kept_ids]
+            if deleted_ids:
+                result = connection.execute(cl_worksheet_item.delete().where(
+                    cl_worksheet_item.c.id.in_(deleted_ids)
+                ))
+                if result.rowcount < len(deleted_ids):
+                    raise UsageError('Worksheet %s was updated concurrently!' % (worksheet_uuid,))
+            updated_values = [
+                {'item_id': row.id, 'new_sort_key': sort_key}
+                for (row, sort_key) in zip(kept_rows, sort_keys)
+                if row is not None and row.sort_key != sort_key
+            ]
+            if updated_values:
+                connection.execute(cl_worksheet_item.update().where(
+                    cl_worksheet_item.c.id == bindparam('item_id')
+                ).values(sort_key=bindparam('new_sort_key')), updated_values)
+            self.do_multirow_insert(connection, cl_worksheet_item, [{
+              'worksheet_uuid': worksheet_uuid,
+              'bundle_uuid': bundle_uuid,
+              'subworksheet_uuid': subworksheet_uuid,
+              'value': self.encode_str(value),
+              'type': type,
+              'sort_key': sort_key,
+            } for ((bundle_uuid, subworksheet_uuid, value, type), row, sort_key) in zip(new_items, kept_rows, sort_keys)
+              if row is None])
+
+    def _get_new_item_sort_keys(self, kept_sort_keys, last_item_id):
+        '''
+        Given the sort keys of the items in the new order of a worksheet (None
+        for added items), return sort keys for all of them. Kept items keep
+        theirs if the added items fit in between, and otherwise only the kept
+        items before the added ones are moved down to make room.
+
+        See codalab.objects.worksheet for an explanation of the sort_key protocol.
+        We need to produce sort keys here that are strictly upper-bounded by the
+        last known item id in this worksheet, and which monotonically increase.
+        Negative sort keys are fine.
+        '''
+        n = len(kept_sort_keys)
+        sort_keys = list(kept_sort_keys)
+        i = 0
+        while i < n:
+            if sort_keys[i] is not None:
+                i += 1
+                continue
+            j = i
+            while j < n and sort_keys[j] is None:
+                j += 1
+            # Items i, ..., j - 1 are added between the items i - 1 and j.
+            high = sort_keys[j] if j < n else last_item_id + 1
+            if i > 0 and high - sort_keys[i - 1] >= j - i:
+                # They fit. The first one can share the sort key of item i - 1,
+                # since it gets a larger id.
+                start, low = i, sort_keys[i - 1] - 1
+            else:
+                # Renumber the items start, ..., j - 1 (moving the kept ones
+                # down) for the smallest start that leaves room for them. Below
+                # the first item there always is, so leave gaps there.
+                start = max(i - 1, 0)
+                while start > 0 and high - sort_keys[start - 1] - 1 < j - start:
+                    start -= 1
+                if start > 0:
+                    low = sort_keys[start - 1]
+                else:
+                    low = high - (j - start + 1) * self.WORKSHEET_ITEM_SORT_KEY_GAP
+            # Spread the items evenly between low and high (exclusive).
+            for k in range(start, j):
+                sort_keys[k] = low + (k - start + 1) * (high - low) // (j - start + 1)
+            i = j
+        return sort_keys
 
     def update_worksheet_metadata(self, worksheet, info):
         '''
@@ -1089,7 +1962,7 @@ class BundleModel(object):
         if 'owner_id' in info:
             worksheet.owner_id = info['owner_id']
         worksheet.validate()
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             if 'tags' in info:
                 # Delete old tags
                 result = connection.execute(cl_worksheet_tag.delete().where(cl_worksheet_tag.c.worksheet_uuid == worksheet.uuid))
@@ -1101,12 +1974,14 @@ class BundleModel(object):
                 connection.execute(cl_worksheet.update().where(
                     cl_worksheet.c.uuid == worksheet.uuid
                 ).values(info))
+            if 'name' in info:
+                self._update_search_tokens(connection, 'worksheet', worksheet.uuid, [worksheet.uuid, worksheet.name])
 
     def delete_worksheet(self, worksheet_uuid):
         '''
         Delete the worksheet with the given uuid.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(cl_group_worksheet_permission.delete().where(
                 cl_group_worksheet_permission.c.object_uuid == worksheet_uuid
             ))
@@ -1119,6 +1994,10 @@ class BundleModel(object):
             connection.execute(cl_worksheet_tag.delete().where(
                 cl_worksheet_tag.c.worksheet_uuid == worksheet_uuid
             ))
+            connection.execute(cl_search_token.delete().where(and_(
+                cl_search_token.c.object_type == 'worksheet',
+                cl_search_token.c.object_uuid == worksheet_uuid,
+            )))
             connection.execute(cl_worksheet.delete().where(
                 cl_worksheet.c.uuid == worksheet_uuid
             ))
@@ -1145,7 +2024,7 @@ class BundleModel(object):
         '''
         Return a list of row dicts --one per group-- for the given owner.
         '''
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(cl_group.select().where(
                 cl_group.c.owner_id == owner_id
             )).fetchall()
@@ -1155,7 +2034,7 @@ class BundleModel(object):
         '''
         Create the group specified by the given row dict.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             result = connection.execute(cl_group.insert().values(group_dict))
             group_dict['id'] = result.lastrowid
         return group_dict
@@ -1165,7 +2044,7 @@ class BundleModel(object):
         Get a list of groups, all of which satisfy the clause given by kwargs.
         '''
         clause = self.make_kwargs_clause(cl_group, kwargs)
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(
               cl_group.select().where(clause)
             ).fetchall()
@@ -1215,7 +2094,7 @@ class BundleModel(object):
         # Union
         q0 = union(*filter(lambda q : q is not None, [q0, q1, q2]))
 
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(q0).fetchall()
             if not rows:
                 return []
@@ -1232,7 +2111,7 @@ class BundleModel(object):
         '''
         Delete the group with the given uuid.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(cl_group_bundle_permission.delete().\
                 where(cl_group_bundle_permission.c.group_uuid == uuid)
             )
@@ -1251,7 +2130,7 @@ class BundleModel(object):
         Add user as a member of a group.
         '''
         row = {'group_uuid': group_uuid, 'user_id': user_id, 'is_admin': is_admin}
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             result = connection.execute(cl_user_group.insert().values(row))
             row['id'] = result.lastrowid
         return row
@@ -1260,7 +2139,7 @@ class BundleModel(object):
         '''
         Add user as a member of a group.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(cl_user_group.delete().\
                 where(cl_user_group.c.user_id == user_id).\
                 where(cl_user_group.c.group_uuid == group_uuid)
@@ -1270,7 +2149,7 @@ class BundleModel(object):
         '''
         Add user as a member of a group.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(cl_user_group.update().\
                 where(cl_user_group.c.user_id == user_id).\
                 where(cl_user_group.c.group_uuid == group_uuid).\
@@ -1283,7 +2162,7 @@ class BundleModel(object):
         Examples: user_id=..., group_uuid=...
         '''
         clause = self.make_kwargs_clause(cl_user_group, kwargs)
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             rows = connection.execute(
               cl_user_group.select().where(clause)
             ).fetchall()
@@ -1303,7 +2182,7 @@ class BundleModel(object):
         Add specified permission for the given (group, object) pair.
         '''
         row = {'group_uuid': group_uuid, 'object_uuid': object_uuid, 'permission': permission}
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             result = connection.execute(table.insert().values(row))
             row['id'] = result.lastrowid
         return row
@@ -1316,7 +2195,7 @@ class BundleModel(object):
         '''
         Delete permissions for the given (group, object) pair.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(table.delete(). \
                 where(table.c.group_uuid == group_uuid). \
                 where(table.c.object_uuid == object_uuid)
@@ -1331,7 +2210,7 @@ class BundleModel(object):
         Update permission for the given (group, object) pair.
         There should be one.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(table.update(). \
                 where(table.c.group_uuid == group_uuid). \
                 where(table.c.object_uuid == object_uuid). \
@@ -1341,16 +2220,19 @@ class BundleModel(object):
     def update_worksheet_permission(self, group_uuid, worksheet_uuid, permission):
         self.update_permission(cl_group_worksheet_permission, group_uuid, worksheet_uuid, permission)
 
-    def batch_get_group_permissions(self, table, user_id, object_uuids):
+    def batch_get_group_permissions(self, table, user_id, object_uuids, user_groups=None):
         '''
         Return map from object_uuid to list of {group_uuid: ..., group_name: ..., permission: ...}
         Note: if user_id != None, only involve groups that user_id is in. If user_id is None (i.e.
         user is not logged in), involve only the public group.
+        user_groups: the groups that user_id is in, if already known (see _get_user_groups).
         '''
-        with self.engine.begin() as connection:
+        with self._begin(read_only=True) as connection:
             if user_id is None:
                 # Not logged in: include only public group
                 group_restrict = (table.c.group_uuid == self.public_group_uuid)
+            elif user_id != self.root_user_id and user_groups is not None:
+                group_restrict = table.c.group_uuid.in_(user_groups)
             elif user_id != self.root_user_id:
                 # Logged in but not root: include only public group and groups that user_id is in
                 group_restrict = or_(
@@ -1454,12 +2336,24 @@ class BundleModel(object):
             else:
                 raise UsageError("Invalid field: '%s', expected user|command|uuid|date" % field_name)
 
+            # Use the daily rollups if they have everything we need.
+            query = self._make_event_rollup_query(field_name, query_info)
+            if query is not None:
+                if offset != None:
+                    query = query.offset(offset)
+                if limit != None:
+                    query = query.limit(limit)
+                with self._begin() as connection:
+                    return {'counts': connection.execute(query).fetchall()}
+
         # Build up query
         if query_info.get('count'):
             select_args = []
             if field is not None:
                 select_args.append(field)
             select_args.append(func.count(cl_event.c.id).label('cnt'))
+            if field is not None:
+                select_args.append(func.sum(cl_event.c.duration).label('duration'))
         else:
             select_args = [cl_event]
         query = select(select_args)
@@ -1491,7 +2385,7 @@ class BundleModel(object):
 
         # Make query
         info = {}
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             #print query
             rows = connection.execute(query).fetchall()
             if query_info.get('count'):
@@ -1500,6 +2394,100 @@ class BundleModel(object):
                 info['events'] = reversed(rows)
         return info
 
+    def _make_event_rollup_query(self, field_name, query_info):
+        '''
+        Return a query computing the number and total duration of the events
+        grouped by |field_name| (user, command or date) from the daily rollups,
+        or None if the filters in |query_info| can't be answered from them.
+        '''
+        if query_info.get('args') != None or query_info.get('uuid') != None:
+            return None
+        if field_name == 'user' or (field_name == 'date' and query_info.get('command') == None):
+            if query_info.get('command') != None:
+                return None
+            table = cl_event_user_rollup
+            if field_name == 'user':
+                # Anonymous events are grouped under a NULL user_name, like in the event table.
+                field = func.nullif(table.c.user_name, self.ANONYMOUS_EVENT_USER).label('user_name')
+            else:
+                field = table.c.date
+        elif field_name in ('command', 'date'):
+            if query_info.get('user') != None:
+                return None
+            table = cl_event_command_rollup
+            field = table.c.command if field_name == 'command' else table.c.date
+        else:
+            return None
+
+        query = select([
+            field,
+            func.sum(table.c.count).label('cnt'),
+            func.sum(table.c.duration).label('duration'),
+        ])
+        if query_info.get('user') != None:
+            query = query.where(or_(table.c.user_id == query_info['user'], table.c.user_name == query_info['user']))
+        if query_info.get('command') != None:
+            query = query.where(table.c.command == query_info['command'])
+        if query_info.get('date') != None:
+            query = query.where(table.c.date == query_info['date'])
+        # Sort by decreasing count
+        return query.group_by(field).order_by(desc('cnt'))
+
+    def start_events_log_writer(self, **kwargs):
+        '''
+        From now on, write the events log in the background (see EventsLogWriter,
+        which takes the keyword arguments).  Does nothing if already started.
+        '''
+        if self.events_log_writer is None:
+            self.events_log_writer = EventsLogWriter(self, **kwargs)
+
+    def insert_events(self, events):
+        '''
+        Insert the given rows into the event table and add them to the daily
+        rollups.
+        '''
+        user_totals = collections.defaultdict(lambda: [0, 0.0])
+        command_totals = collections.defaultdict(lambda: [0, 0.0])
+        for event in events:
+            user_key = (
+                event['date'],
+                event['user_id'] or self.ANONYMOUS_EVENT_USER,
+                event['user_name'] or self.ANONYMOUS_EVENT_USER,
+            )
+            for totals in (user_totals[user_key],
+                           command_totals[(event['date'], event['command'])]):
+                totals[0] += 1
+                totals[1] += event['duration']
+
+        with self._begin() as connection:
+            self.do_multirow_insert(connection, cl_event, events)
+            for ((date, user_id, user_name), (count, duration)) in user_totals.iteritems():
+                self._add_to_event_rollup(connection, cl_event_user_rollup,
+                                          {'date': date, 'user_id': user_id, 'user_name': user_name}, count, duration)
+            for ((date, command), (count, duration)) in command_totals.iteritems():
+                self._add_to_event_rollup(connection, cl_event_command_rollup,
+                                          {'date': date, 'command': command}, count, duration)
+
+    def _add_to_event_rollup(self, connection, table, key, count, duration):
+        '''
+        Add |count| events of total |duration| to the row of the rollup |table|
+        with the given |key| (the columns of its unique constraint).
+
+        This method may be overridden by models that have an atomic upsert.
+        '''
+        update = table.update().where(and_(
+            *[table.c[column] == value for (column, value) in key.iteritems()]
+        )).values({
+            'count': table.c.count + count,
+            'duration': table.c.duration + duration,
+        })
+        if connection.execute(update).rowcount == 0:
+            try:
+                connection.execute(table.insert().values(dict(key, count=count, duration=duration)))
+            except DatabaseIntegrityError:
+                # Another writer inserted the row since our update.
+                connection.execute(update)
+
     def update_events_log(self, user_id, user_name, command, args, start_time=None, uuid=None):
         # Find the first uuid in args, so we can index that as a separate column in the DB.
         # Note that the uuid could be either a worksheet or a bundle.
@@ -1516,24 +2504,26 @@ class BundleModel(object):
                         return z
             return None
 
-        with self.engine.begin() as connection:
-            end_time = time.time()
-            if start_time == None:
-                start_time = end_time
-            if uuid == None:
-                uuid = find_uuid(args)
-            info = {
-                'start_time': datetime.datetime.fromtimestamp(start_time),
-                'end_time': datetime.datetime.fromtimestamp(end_time),
-                'date': datetime.datetime.fromtimestamp(end_time).strftime('%Y-%m-%d'),
-                'duration': end_time - start_time,
-                'user_id': user_id,
-                'user_name': user_name,
-                'command': command,
-                'args': json.dumps(args),
-                'uuid': uuid,
-            }
-            connection.execute(cl_event.insert().values(info))
+        end_time = time.time()
+        if start_time == None:
+            start_time = end_time
+        if uuid == None:
+            uuid = find_uuid(args)
+        info = {
+            'start_time': datetime.datetime.fromtimestamp(start_time),
+            'end_time': datetime.datetime.fromtimestamp(end_time),
+            'date': datetime.datetime.fromtimestamp(end_time).strftime('%Y-%m-%d'),
+            'duration': end_time - start_time,
+            'user_id': user_id,
+            'user_name': user_name,
+            'command': command,
+            'args': json.dumps(args),
+            'uuid': uuid,
+        }
+        if self.events_log_writer is not None:
+            self.events_log_writer.add(info)
+        else:
+            self.insert_events([info])
 
     # Operations on the query log
     def date_handler(self, obj): 
@@ -1552,7 +2542,7 @@ class BundleModel(object):
         message = query_info.get('message')
         worksheet_uuid = query_info.get('worksheet_uuid')
         bundle_uuid = query_info.get('bundle_uuid')
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             info = {
                 'time': datetime.datetime.fromtimestamp(time.time()),
                 'sender_user_id': sender_user_id,
@@ -1573,7 +2563,7 @@ class BundleModel(object):
         if user_id1 == None:
             return
         limit = query_info.get('limit')
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             query = select([cl_chat.c.time, cl_chat.c.sender_user_id, cl_chat.c.recipient_user_id, cl_chat.c.message])
             clause = []
             # query all chats that this user sends or receives
@@ -1637,7 +2627,7 @@ class BundleModel(object):
             clauses.append(or_(cl_user.c.user_name.in_(usernames),
                                cl_user.c.email.in_(usernames)))
 
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             rows = connection.execute(select([
                 cl_user
             ]).where(and_(*clauses))).fetchall()
@@ -1651,7 +2641,7 @@ class BundleModel(object):
         :param email: email
         :return: True iff user with EITHER matching username or email exists.
         """
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             row = connection.execute(select([
                 cl_user
             ]).where(or_(
@@ -1669,7 +2659,7 @@ class BundleModel(object):
         :param password:
         :return: (new integer user ID, verification key to send)
         """
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             now = datetime.datetime.utcnow()
             user_id = user_id or uuid.uuid4().hex
 
@@ -1716,7 +2706,7 @@ class BundleModel(object):
         :param user_id: id of user to get verification key for
         :return: verification key, or None if none found for user
         """
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             verify_row = connection.execute(cl_user_verification.select().where(
                 cl_user_verification.c.user_id == user_id
             ).limit(1)).fetchone()
@@ -1739,7 +2729,7 @@ class BundleModel(object):
         :param key: verification key
         :return: True iff succeeded
         """
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             verify_row = connection.execute(cl_user_verification.select().where(
                 cl_user_verification.c.key == key
             ).limit(1)).fetchone()
@@ -1768,7 +2758,7 @@ class BundleModel(object):
         :param user_id: user_id of user for whom to reset password
         :return: reset code
         """
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             now = datetime.datetime.utcnow()
             code = uuid.uuid4().hex
 
@@ -1787,7 +2777,7 @@ class BundleModel(object):
         :param delete: True iff delete code when found
         :return: user_id of associated user if succeeded, None otherwise
         """
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             reset_code_row = connection.execute(cl_user_reset_code.select().where(
                 cl_user_reset_code.c.code == code
             ).limit(1)).fetchone()
@@ -1816,7 +2806,7 @@ class BundleModel(object):
 
         TODO(skoo): merge with get_user when wiring new user system together?
         """
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             rows = connection.execute(select([cl_user]).where(cl_user.c.user_id == user_id))
             user_info = None
             for row in rows:
@@ -1857,7 +2847,7 @@ class BundleModel(object):
         '''
         Update the given user's info with |user_info|.
         '''
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(cl_user.update().where(cl_user.c.user_id == user_info['user_id']).values(user_info))
 
     def increment_user_time_used(self, user_id, amount):
@@ -1878,13 +2868,77 @@ class BundleModel(object):
         })
 
     def _get_disk_used(self, user_id):
-        return self.search_bundle_uuids(user_id, None, ['size=.sum', 'owner_id=' + user_id, 'data_hash=%']) or 0
+        with self._begin() as connection:
+            return self._compute_disk_used(connection, [user_id]).get(user_id, 0)
+
+    def _get_disk_used_by_owner(self, connection, uuids):
+        '''
+        Return {owner_id: total data_size} of the given bundles, counting only
+        bundles that have contents (a data_hash).
+        '''
+        if not uuids:
+            return {}
+        return self._sum_data_size_by_owner(connection, cl_bundle.c.uuid.in_(uuids))
+
+    def _compute_disk_used(self, connection, user_ids=None):
+        '''
+        Return {user_id: disk used} computed from scratch from all the bundles
+        owned by |user_ids| (or by everyone if None).
+        '''
+        clause = true() if user_ids is None else cl_bundle.c.owner_id.in_(user_ids)
+        return self._sum_data_size_by_owner(connection, clause)
+
+    def _sum_data_size_by_owner(self, connection, clause):
+        rows = connection.execute(select([
+            cl_bundle.c.owner_id,
+            func.sum(cl_bundle_search.c.data_size).label('disk_used'),
+        ]).where(and_(
+            clause,
+            cl_bundle.c.uuid == cl_bundle_search.c.bundle_uuid,
+            cl_bundle.c.data_hash != None,
+        )).group_by(cl_bundle.c.owner_id)).fetchall()
+        return dict((row.owner_id, row.disk_used or 0) for row in rows)
+
+    def _apply_disk_used_deltas(self, connection, old_disk_used, new_disk_used):
+        '''
+        Add the difference between |new_disk_used| and |old_disk_used| (both
+        {user_id: amount}) to the disk_used of each user.
+        '''
+        for user_id in set(old_disk_used) | set(new_disk_used):
+            delta = new_disk_used.get(user_id, 0) - old_disk_used.get(user_id, 0)
+            if delta:
+                connection.execute(cl_user.update().where(cl_user.c.user_id == user_id).values(
+                    disk_used=cl_user.c.disk_used + delta
+                ))
 
     def update_user_disk_used(self, user_id):
-        user_info = self.get_user_info(user_id)
-        # Compute from scratch for simplicity
-        user_info['disk_used'] = self._get_disk_used(user_id)
-        self.update_user_info(user_info)
+        '''
+        Recompute the disk used by the given user from scratch.
+        disk_used is otherwise maintained incrementally as bundles change, so this
+        is only needed to correct drift (see reconcile_user_disk_used).
+        '''
+        self.reconcile_user_disk_used([user_id])
+
+    def reconcile_user_disk_used(self, user_ids=None, dry_run=False):
+        '''
+        Recompute the disk used by |user_ids| (or all users if None) from scratch
+        and fix up the users whose recorded disk_used has drifted.
+        Return a list of (user_id, recorded disk_used, actual disk_used) for them.
+        '''
+        with self._begin() as connection:
+            clause = true() if user_ids is None else cl_user.c.user_id.in_(user_ids)
+            rows = connection.execute(select([cl_user.c.user_id, cl_user.c.disk_used]).where(clause)).fetchall()
+            actual_disk_used = self._compute_disk_used(connection, user_ids)
+            drifted = []
+            for row in rows:
+                actual = actual_disk_used.get(row.user_id, 0)
+                if row.disk_used != actual:
+                    drifted.append((row.user_id, row.disk_used, actual))
+                    if not dry_run:
+                        connection.execute(cl_user.update().where(cl_user.c.user_id == row.user_id).values(
+                            disk_used=actual
+                        ))
+        return drifted
 
     #############################################################################
     # OAuth-related methods follow!
@@ -1911,7 +2965,7 @@ class BundleModel(object):
                 ))
 
     def get_oauth2_client(self, client_id):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             row = connection.execute(select([
                 oauth2_client
             ]).where(
@@ -1924,7 +2978,7 @@ class BundleModel(object):
         return OAuth2Client(self, **row)
 
     def save_oauth2_client(self, client):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             result = connection.execute(oauth2_client.insert().values(client.columns))
             client.id = result.lastrowid
         return client
@@ -1937,7 +2991,7 @@ class BundleModel(object):
         else:
             return None
 
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             row = connection.execute(select([oauth2_token]).where(clause).limit(1)).fetchone()
 
         if row is None:
@@ -1946,7 +3000,7 @@ class BundleModel(object):
         return OAuth2Token(self, **row)
 
     def find_oauth2_token(self, client_id, user_id, expires_after):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             row = connection.execute(
                 select([oauth2_token])
                     .where(and_(oauth2_token.c.client_id == client_id,
@@ -1960,13 +3014,13 @@ class BundleModel(object):
         return OAuth2Token(self, **row)
 
     def save_oauth2_token(self, token):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             result = connection.execute(oauth2_token.insert().values(token.columns))
             token.id = result.lastrowid
         return token
 
     def clear_oauth2_tokens(self, client_id, user_id):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(oauth2_token.delete().where(
                 and_(oauth2_token.c.client_id == client_id,
                      oauth2_token.c.user_id == user_id,
@@ -1974,13 +3028,13 @@ class BundleModel(object):
             ))
 
     def delete_oauth2_token(self, token_id):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(oauth2_auth_code.delete().where(
                 oauth2_token.c.id == token_id
             ))
 
     def get_oauth2_auth_code(self, client_id, code):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             row = connection.execute(select([
                 oauth2_auth_code
             ]).where(
@@ -1993,13 +3047,13 @@ class BundleModel(object):
         return OAuth2AuthCode(self, **row)
 
     def save_oauth2_auth_code(self, grant):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             result = connection.execute(oauth2_auth_code.insert().values(grant.columns))
             grant.id = result.lastrowid
         return grant
 
     def delete_oauth2_auth_code(self, auth_code_id):
-        with self.engine.begin() as connection:
+        with self._begin() as connection:
             connection.execute(oauth2_auth_code.delete().where(
                 oauth2_auth_code.c.id == auth_code_id
             ))
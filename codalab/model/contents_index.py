@@ -0,0 +1,235 @@
+'''
+Helpers for storing the contents index of a bundle (see
+worker.file_util.index_contents) compactly.
+
+The index is flattened into a list of entries
+    [parent, name, type, size, perm, link]
+where parent is the path of the parent directory relative to the bundle ('' for
+the top-level directory) and is None for the top-level entry itself.  The
+entries are sorted by their key (see entry_key), i.e. by (depth, parent, name),
+and stored in zlib-compressed chunks of CHUNK_SIZE entries.  Since the chunks
+record the keys of their first and last entries, the entries with keys in a
+given range can be read without decoding the whole index; the entries that
+make up a path and a given number of levels below it lie in one range per
+level (see target_key_ranges).
+
+Changes to the index (see delta_to_entry) are stored separately until they're
+merged into the chunks (see apply_deltas).
+'''
+import heapq
+import json
+import zlib
+
+# Number of entries per chunk.
+CHUNK_SIZE = 256
+
+
+def _to_bytes(string):
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+
+def join_path(parent, name):
+    '''
+    Return the path (relative to the bundle) of the entry |name| in |parent|.
+    '''
+    if parent is None:
+        return ''
+    if parent == '':
+        return name
+    return parent + '/' + name
+
+
+def split_path(path):
+    '''
+    Inverse of join_path: return (parent, name).
+    '''
+    if path == '':
+        return (None, '')
+    if '/' not in path:
+        return ('', path)
+    return tuple(path.rsplit('/', 1))
+
+
+def path_depth(path):
+    '''
+    Return the number of components of |path| (0 for the top-level).
+    '''
+    if path == '':
+        return 0
+    return path.count('/') + 1
+
+
+def _depth_prefix(depth):
+    return '%04d' % depth
+
+
+def entry_key(parent, name):
+    '''
+    Return the sort key of the entry |name| in |parent|, a byte string.
+    Entries sort by depth first, then by parent and name, so the contents of
+    each directory are contiguous and come after the directory itself.
+    '''
+    if parent is None:
+        return _depth_prefix(0)
+    return _depth_prefix(path_depth(parent) + 1) + _to_bytes(parent) + '\0' + _to_bytes(name)
+
+
+def key_depth(key):
+    '''
+    Return the depth of the entry with the given key.
+    '''
+    return int(key[:4])
+
+
+def target_key_ranges(path, depth):
+    '''
+    Return the ranges [low, high) of the keys of the entry at |path| and of
+    its descendants at most |depth| levels below it, one range per level.
+    '''
+    parent, name = split_path(path)
+    key = entry_key(parent, name)
+    ranges = [(key, key + '\0')]
+    base_depth = path_depth(path)
+    path = _to_bytes(path)
+    for level in range(1, depth + 1):
+        prefix = _depth_prefix(base_depth + level)
+        if level == 1:
+            # The parent is exactly path.
+            ranges.append((prefix + path + '\0', prefix + path + '\1'))
+        elif path == '':
+            ranges.append((prefix, _depth_prefix(base_depth + level + 1)))
+        else:
+            # The parent starts with path + '/'.
+            ranges.append((prefix + path + '/', prefix + path + '0'))
+    return ranges
+
+
+def flatten_index(index):
+    '''
+    Return the sorted list of entries of the tree |index|.
+    '''
+    entries = []
+    stack = [(None, index)]
+    while stack:
+        parent, entry = stack.pop()
+        name = '' if parent is None else entry['name']
+        entries.append([parent, name, entry['type'], entry['size'], entry['perm'], entry.get('link')])
+        for child in entry.get('contents', []):
+            stack.append((join_path(parent, name), child))
+    entries.sort(key=lambda entry: entry_key(entry[0], entry[1]))
+    return entries
+
+
+def entry_to_dict(entry, root_name):
+    '''
+    Return the index dict (without contents) of |entry|, naming the top-level
+    entry |root_name|.
+    '''
+    parent, name, type_, size, perm, link = entry
+    result = {'name': root_name if parent is None else name, 'type': type_, 'size': size, 'perm': perm}
+    if link is not None:
+        result['link'] = link
+    return result
+
+
+def build_index(entries, root_name, root_path='', depth=None):
+    '''
+    Rebuild the tree of the entry at |root_path| from the sorted |entries|,
+    which must contain it and its descendants at most |depth| levels below it
+    (all of them if depth is None). Directories |depth| levels below it have
+    no contents. Return None if the entry is missing.
+    '''
+    directories = {}
+    root = None
+    for entry in entries:
+        path = join_path(entry[0], entry[1])
+        if path == root_path:
+            root = result = entry_to_dict(entry, root_name)
+            level = 0
+        elif entry[0] in directories:
+            result = entry_to_dict(entry, root_name)
+            parent_result, parent_level = directories[entry[0]]
+            parent_result['contents'].append(result)
+            level = parent_level + 1
+        else:
+            continue
+        if result['type'] == 'directory' and (depth is None or level < depth):
+            result['contents'] = []
+            directories[path] = (result, level)
+    return root
+
+
+def make_chunks(entries):
+    '''
+    Split the sorted |entries| into rows of the bundle_contents_chunk table
+    (without bundle_uuid).
+    '''
+    chunks = []
+    for i in range(0, len(entries), CHUNK_SIZE):
+        chunk_entries = entries[i:i + CHUNK_SIZE]
+        chunks.append({
+            'first_key': entry_key(chunk_entries[0][0], chunk_entries[0][1]),
+            'last_key': entry_key(chunk_entries[-1][0], chunk_entries[-1][1]),
+            'num_entries': len(chunk_entries),
+            'data': zlib.compress(json.dumps(chunk_entries)),
+        })
+    return chunks
+
+
+def decode_chunk(data):
+    '''
+    Return the entries stored in a chunk.
+    '''
+    return json.loads(zlib.decompress(data))
+
+
+DELTA_ACTIONS = ('add', 'modify', 'remove')
+
+
+def delta_to_entry(delta):
+    '''
+    Return (key, entry) for a change to the index, a dict with the fields
+        action: One of 'add', 'modify' or 'remove'.
+        path: Path of the entry relative to the bundle ('' for the top-level).
+        type, size, perm, link: The new fields of the entry (see
+            worker.file_util.index_contents), unless it's removed.
+    where entry is None if the entry is removed.
+    '''
+    parent, name = split_path(delta['path'])
+    if delta['action'] == 'remove':
+        entry = None
+    else:
+        entry = [parent, name, delta['type'], delta['size'], delta['perm'], delta.get('link')]
+    return (entry_key(parent, name), entry)
+
+
+def apply_deltas(entries, deltas):
+    '''
+    Return the sorted entries resulting from applying the (key, entry) deltas,
+    in order, to the sorted |entries|.
+    '''
+    changes = {}
+    for (key, entry) in deltas:
+        changes[key] = entry
+    kept = ((entry_key(entry[0], entry[1]), entry) for entry in entries)
+    kept = ((key, entry) for (key, entry) in kept if key not in changes)
+    changed = sorted((key, entry) for (key, entry) in changes.iteritems() if entry is not None)
+    return [entry for (key, entry) in heapq.merge(kept, changed)]
+
+
+def remove_orphans(entries):
+    '''
+    Return the sorted |entries| without those whose parent isn't a directory
+    among them, e.g. the contents of a removed directory.
+    '''
+    directories = set()
+    result = []
+    for entry in entries:
+        if entry[0] is not None and entry[0] not in directories:
+            continue
+        if entry[2] == 'directory':
+            directories.add(join_path(entry[0], entry[1]))
+        result.append(entry)
+    return result
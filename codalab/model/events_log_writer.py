@@ -0,0 +1,76 @@
+'''
+EventsLogWriter takes the writes to the events log off the critical path of
+requests: events are queued and a background thread inserts them in batches.
+'''
+import atexit
+import Queue
+import threading
+import time
+import traceback
+
+
+class EventsLogWriter(object):
+    '''
+    Insert the events given to add() in the background, in batches, every
+    |flush_interval| seconds or as soon as |batch_size| events are waiting.
+    add() blocks when |max_queue_size| events are waiting (backpressure).
+    close() (also called at exit) writes all the remaining events.
+    '''
+    def __init__(self, model, flush_interval=0.5, batch_size=100, max_queue_size=10000):
+        self.model = model
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = Queue.Queue(max_queue_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, event):
+        '''
+        Queue |event| (a row of the event table) to be written.
+        '''
+        with self._lock:
+            if not self._closed:
+                self._queue.put(event)
+                return
+        # The background thread is gone, so just write it now.
+        self.model.insert_events([event])
+
+    def close(self):
+        '''
+        Stop the background thread after it has written all the queued events.
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    event = self._queue.get(timeout=max(deadline - time.time(), 0.001))
+                except Queue.Empty:
+                    break
+                if event is None:  # Closed
+                    done = True
+                    break
+                batch.append(event)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.model.insert_events(batch)
+        except Exception:
+            # Losing some events is better than taking down the server.
+            print '=== INTERNAL ERROR: failed to write %d events' % len(batch)
+            traceback.print_exc()
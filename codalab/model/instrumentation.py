@@ -0,0 +1,243 @@
+'''
+ModelInstrumentation records how much the model methods called by each request
+cost: number of calls, wall time, rows returned and number and time of SQL
+statements, per model method and per request (e.g. RPC command or REST route).
+
+Times are aggregated into histograms with power-of-two buckets, so recording a
+call is just a few dict updates and the statistics take constant space.
+'''
+from contextlib import contextmanager
+import collections
+import functools
+import inspect
+import threading
+import time
+
+from sqlalchemy import event
+
+
+class Histogram(object):
+    '''
+    Histogram of durations (in seconds). Bucket 0 counts durations below 1ms
+    and bucket i > 0 those in [2^(i-1), 2^i) ms.
+    '''
+    NUM_BUCKETS = 24
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * self.NUM_BUCKETS
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bucket = min(int(value * 1000).bit_length(), self.NUM_BUCKETS - 1)
+        self.buckets[bucket] += 1
+
+    def percentile(self, fraction):
+        '''
+        Return an upper bound (the end of the bucket) of the given percentile.
+        '''
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for (bucket, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(float(2 ** bucket) / 1000, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': list(self.buckets),
+        }
+
+
+class CallStats(object):
+    '''
+    Statistics of the calls of one model method, or of one kind of request.
+    '''
+    def __init__(self):
+        self.time = Histogram()
+        self.errors = 0
+        self.rows = 0
+        self.statements = 0
+        self.statement_time = 0.0
+        # For requests: method name -> CallStats of the methods they called.
+        self.methods = collections.defaultdict(CallStats)
+
+    def add(self, frame, elapsed):
+        self.time.add(elapsed)
+        self.errors += frame.error
+        self.rows += frame.rows
+        self.statements += frame.statements
+        self.statement_time += frame.statement_time
+
+    def to_dict(self):
+        result = {
+            'calls': self.time.count,
+            'time': self.time.to_dict(),
+            'errors': self.errors,
+            'rows': self.rows,
+            'statements': self.statements,
+            'statement_time': self.statement_time,
+        }
+        if self.methods:
+            result['methods'] = dict((name, stats.to_dict()) for (name, stats) in self.methods.iteritems())
+        return result
+
+
+class _Frame(object):
+    '''
+    What a call (of a method or a request) in progress has cost so far.
+    '''
+    __slots__ = ('error', 'rows', 'statements', 'statement_time')
+
+    def __init__(self):
+        self.error = 0
+        self.rows = 0
+        self.statements = 0
+        self.statement_time = 0.0
+
+
+class ModelInstrumentation(object):
+    '''
+    Call instrument(model) to record the calls of the public methods of |model|
+    and the SQL statements executed on its engines, and record_request(model,
+    name) around each request. Methods called by other methods count in both.
+    '''
+    # Public methods of the model that are just helpers.
+    UNINSTRUMENTED_METHODS = frozenset([
+        'create_tables', 'date_handler', 'decode_str', 'do_multirow_insert',
+        'encode_str', 'get_bundle_cache_stats', 'get_read_engine', 'make_clause',
+        'make_kwargs_clause', 'request_scope', 'start_events_log_writer',
+    ])
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def instrument(self, model):
+        for (name, method) in inspect.getmembers(model, inspect.ismethod):
+            if name.startswith('_') or name in self.UNINSTRUMENTED_METHODS:
+                continue
+            setattr(model, name, self._wrap(name, method))
+        engines = [model.engine]
+        if model.read_engine is not None:
+            engines.append(model.read_engine)
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        model.instrumentation = self
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.time()
+            self.methods = collections.defaultdict(CallStats)
+            self.requests = collections.defaultdict(CallStats)
+
+    def get_stats(self):
+        '''
+        Return {'start_time', 'methods': {name: stats}, 'requests': {name: stats}},
+        where the stats of requests also have the stats of the methods they
+        called, by method.
+        '''
+        with self._lock:
+            return {
+                'start_time': self.start_time,
+                'methods': dict((name, stats.to_dict()) for (name, stats) in self.methods.iteritems()),
+                'requests': dict((name, stats.to_dict()) for (name, stats) in self.requests.iteritems()),
+            }
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            stack = self._get_stack()
+            frame = _Frame()
+            stack.append(frame)
+            start_time = time.time()
+            try:
+                result = method(*args, **kwargs)
+                if isinstance(result, (list, tuple, dict, set)):
+                    frame.rows = len(result)
+                return result
+            except Exception:
+                frame.error = 1
+                raise
+            finally:
+                elapsed = time.time() - start_time
+                stack.pop()
+                request = getattr(self._local, 'request', None)
+                # Only count the calls made by the request itself.
+                is_request_call = request is not None and len(stack) == request[2]
+                if is_request_call:
+                    request[1].rows += frame.rows
+                with self._lock:
+                    self.methods[name].add(frame, elapsed)
+                    if is_request_call:
+                        self.requests[request[0]].methods[name].add(frame, elapsed)
+        return wrapper
+
+    @contextmanager
+    def request(self, name):
+        '''
+        Record the calls made within this block as a request called |name|.
+        '''
+        stack = self._get_stack()
+        frame = _Frame()
+        previous = getattr(self._local, 'request', None)
+        self._local.request = (name, frame, len(stack) + 1)
+        stack.append(frame)
+        start_time = time.time()
+        try:
+            yield
+        except Exception:
+            frame.error = 1
+            raise
+        finally:
+            elapsed = time.time() - start_time
+            stack.pop()
+            self._local.request = previous
+            with self._lock:
+                self.requests[name].add(frame, elapsed)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.statement_start_time = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_time = getattr(self._local, 'statement_start_time', None)
+        elapsed = time.time() - start_time if start_time is not None else 0.0
+        for frame in self._get_stack():
+            frame.statements += 1
+            frame.statement_time += elapsed
+
+
+@contextmanager
+def record_request(model, name):
+    '''
+    Record the model calls made within this block as a request called |name|,
+    if |model| is instrumented.
+    '''
+    if model.instrumentation is None:
+        yield
+    else:
+        with model.instrumentation.request(name):
+            yield
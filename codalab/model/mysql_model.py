@@ -6,6 +6,7 @@ from sqlalchemy import (
     create_engine,
     event,
     exc,
+    text,
 )
 from sqlalchemy.pool import Pool
 
@@ -41,16 +42,35 @@ def ping_connection(dbapi_connection, connection_record, connection_proxy):
             raise
 
 class MySQLModel(BundleModel):
-    def __init__(self, engine_url, default_user_info):
+    def __init__(self, engine_url, default_user_info, read_engine_url=None):
         if not engine_url.startswith('mysql://'):
             raise UsageError('Engine URL should start with mysql://')
+        if read_engine_url is not None and not read_engine_url.startswith('mysql://'):
+            raise UsageError('Read engine URL should start with mysql://')
         engine = create_engine(engine_url, strategy='threadlocal', pool_size=20, max_overflow=100, pool_recycle=3600)
-        super(MySQLModel, self).__init__(engine, default_user_info)
+        read_engine = None
+        if read_engine_url is not None:
+            read_engine = create_engine(read_engine_url, strategy='threadlocal', pool_size=20, max_overflow=100, pool_recycle=3600)
+        super(MySQLModel, self).__init__(engine, default_user_info, read_engine)
 
     def do_multirow_insert(self, connection, table, values):
-        # MySQL allows for more efficient multi-row insertions.
-        if values:
-            connection.execute(table.insert().values(values))
+        # MySQL allows for more efficient multi-row insertions.  Keep each
+        # statement bounded, since it must fit in max_allowed_packet.
+        for i in range(0, len(values), self.INSERT_CHUNK_SIZE):
+            connection.execute(table.insert().values(values[i:i + self.INSERT_CHUNK_SIZE]))
+
+    def _add_to_event_rollup(self, connection, table, key, count, duration):
+        # Atomic, unlike an update followed by an insert when nothing was updated.
+        values = dict(key, count=count, duration=duration)
+        columns = sorted(values)
+        connection.execute(text(
+            'INSERT INTO `%s` (%s) VALUES (%s) ON DUPLICATE KEY UPDATE '
+            '`count` = `count` + VALUES(`count`), `duration` = `duration` + VALUES(`duration`)' % (
+                table.name,
+                ', '.join('`%s`' % column for column in columns),
+                ', '.join(':%s' % column for column in columns),
+            )
+        ), **values)
 
     def encode_str(self, value):
         return value.encode('utf-8')
@@ -2,19 +2,47 @@
 SQLiteModel is a subclass of BundleModel that stores metadata in a sqlite3
 database in a local file in the CodaLab home directory.
 """
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 
 from codalab.common import UsageError
 from codalab.model.bundle_model import BundleModel
 
 
+def enable_savepoints(engine):
+    '''
+    pysqlite begins transactions itself, lazily, which breaks SAVEPOINT (used
+    by units of work, see BundleModel.request_scope). Make SQLAlchemy begin them
+    instead. See:
+    http://docs.sqlalchemy.org/en/rel_1_0/dialects/sqlite.html#pysqlite-serializable
+    '''
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(connection):
+        connection.execute('BEGIN')
+
+
 class SQLiteModel(BundleModel):
-    def __init__(self, engine_url, default_user_info):
+    # Units of work would hold SQLite's database-wide locks for whole requests.
+    UNITS_OF_WORK = False
+
+    def __init__(self, engine_url, default_user_info, read_engine_url=None):
         if not engine_url.startswith('sqlite:///'):
             raise UsageError('Engine URL should start with sqlite:///')
+        if read_engine_url is not None and not read_engine_url.startswith('sqlite:///'):
+            raise UsageError('Read engine URL should start with sqlite:///')
 
         engine = create_engine(engine_url, strategy='threadlocal')
-        super(SQLiteModel, self).__init__(engine, default_user_info)
+        read_engine = None
+        if read_engine_url is not None:
+            read_engine = create_engine(read_engine_url, strategy='threadlocal')
+        if self.UNITS_OF_WORK:
+            enable_savepoints(engine)
+            if read_engine is not None:
+                enable_savepoints(read_engine)
+        super(SQLiteModel, self).__init__(engine, default_user_info, read_engine)
 
     def encode_str(self, value):
         return value
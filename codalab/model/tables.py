@@ -10,7 +10,9 @@ from sqlalchemy import (
   UniqueConstraint,
 )
 from sqlalchemy.types import (
+  BigInteger,
   Integer,
+  LargeBinary,
   String,
   Text,
   Boolean,
@@ -34,6 +36,9 @@ bundle = Table(
   Column('data_hash', String(63), nullable=True),
   Column('state', String(63), nullable=False),
   Column('owner_id', String(255), nullable=True),
+  # Incremented on every change to the bundle (including its metadata), so that
+  # cached copies of the bundle can be validated cheaply.
+  Column('version', Integer, nullable=False, default=0),
   UniqueConstraint('uuid', name='uix_1'),
   Index('bundle_data_hash_index', 'data_hash'),
   sqlite_autoincrement=True,
@@ -51,6 +56,44 @@ bundle_metadata = Table(
   sqlite_autoincrement=True,
 )
 
+# Denormalized, typed copy of the metadata keys that are searched and sorted
+# on most often (see codalab.model.util.BUNDLE_SEARCH_KEYS).  Kept in sync with
+# bundle_metadata by BundleModel.
+bundle_search = Table(
+  'bundle_search',
+  db_metadata,
+  Column('bundle_uuid', String(63), ForeignKey(bundle.c.uuid), primary_key=True, nullable=False),
+  Column('name', String(255), nullable=True),
+  Column('created', Integer, nullable=True),
+  Column('data_size', BigInteger, nullable=True),
+  Column('time', Float, nullable=True),
+  Column('memory', Float, nullable=True),
+  Column('job_handle', String(255), nullable=True),
+  Column('description', Text, nullable=True),
+  Index('bundle_search_name_index', 'name'),
+  Index('bundle_search_created_index', 'created'),
+  Index('bundle_search_data_size_index', 'data_size'),
+  Index('bundle_search_time_index', 'time'),
+  Index('bundle_search_memory_index', 'memory'),
+  Index('bundle_search_job_handle_index', 'job_handle'),
+)
+
+# Substring index: the trigrams (see codalab.model.util.get_search_tokens) of
+# the uuid, name and description of bundles and the uuid and name of
+# worksheets.  Used to narrow down bare-keyword searches, which would
+# otherwise need a LIKE '%...%' over every row.
+search_token = Table(
+  'search_token',
+  db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
+  Column('object_type', String(20), nullable=False),  # bundle or worksheet
+  Column('object_uuid', String(63), nullable=False),
+  Column('token', String(16), nullable=False),
+  Index('search_token_token_index', 'token', 'object_type', 'object_uuid'),
+  Index('search_token_object_uuid_index', 'object_uuid'),
+  sqlite_autoincrement=True,
+)
+
 # For each child_uuid, we have: key = child_path, target = (parent_uuid, parent_path)
 bundle_dependency = Table(
   'bundle_dependency',
@@ -65,6 +108,23 @@ bundle_dependency = Table(
   sqlite_autoincrement=True,
 )
 
+# Transitive closure of bundle_dependency: one row per (ancestor, descendant)
+# pair, with the length of the shortest dependency path between them.
+# Maintained by BundleModel, so that all the ancestors or descendants of a
+# bundle can be fetched with a single query.
+bundle_closure = Table(
+  'bundle_closure',
+  db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
+  # Deliberately omit ForeignKey(bundle.c.uuid), as for bundle_dependency.
+  Column('ancestor_uuid', String(63), nullable=False),
+  Column('descendant_uuid', String(63), nullable=False),
+  Column('depth', Integer, nullable=False),
+  Index('bundle_closure_ancestor_index', 'ancestor_uuid', 'depth'),
+  Index('bundle_closure_descendant_index', 'descendant_uuid', 'depth'),
+  sqlite_autoincrement=True,
+)
+
 # Stores actions sent from the client to the worker.
 bundle_action = Table(
   'bundle_action',
@@ -76,17 +136,32 @@ bundle_action = Table(
 )
 
 # Stores information about the files, directories and links stored in the
-# bundle.
-bundle_contents_index = Table(
-  'bundle_contents_index',
+# bundle, as a sorted list of entries split into compressed chunks (see
+# codalab.model.contents_index).
+bundle_contents_chunk = Table(
+  'bundle_contents_chunk',
+  db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
+  Column('bundle_uuid', String(63), ForeignKey(bundle.c.uuid), nullable=False),
+  Column('first_key', LargeBinary, nullable=False),  # Key of the first entry in the chunk
+  Column('last_key', LargeBinary, nullable=False),  # Key of the last entry in the chunk
+  Column('num_entries', Integer, nullable=False),
+  Column('data', LargeBinary, nullable=False),  # zlib-compressed JSON list of entries
+  Index('bundle_contents_chunk_bundle_uuid_index', 'bundle_uuid', mysql_length=63),
+  sqlite_autoincrement=True,
+)
+
+# Changes to the contents index of a bundle that haven't been merged into its
+# chunks yet, applied in order of id.
+bundle_contents_delta = Table(
+  'bundle_contents_delta',
   db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
   Column('bundle_uuid', String(63), ForeignKey(bundle.c.uuid), nullable=False),
-  Column('path', Text, nullable=False),
-  Column('type', String(63), nullable=False),
-  Column('size', Integer, nullable=False),
-  Column('perm', Integer, nullable=False),
-  Column('link', Text, nullable=True),
-  Index('bundle_uuid_index', 'bundle_uuid', mysql_length=63),
+  Column('key', LargeBinary, nullable=False),  # Key of the entry changed
+  Column('entry', Text, nullable=True),  # JSON-encoded entry, null if it was removed
+  Index('bundle_contents_delta_bundle_uuid_index', 'bundle_uuid', mysql_length=63),
+  sqlite_autoincrement=True,
 )
 
 # The worksheet table does not have many columns now, but it will eventually
@@ -126,6 +201,7 @@ worksheet_item = Table(
 
   Column('sort_key', Integer, nullable=True),
   Index('worksheet_item_worksheet_uuid_index', 'worksheet_uuid'),
+  Index('worksheet_item_worksheet_uuid_sort_key_index', 'worksheet_uuid', 'sort_key', 'id'),
   Index('worksheet_item_bundle_uuid_index', 'bundle_uuid'),
   Index('worksheet_item_subworksheet_uuid_index', 'subworksheet_uuid'),
   sqlite_autoincrement=True,
@@ -224,6 +300,36 @@ event = Table(
   sqlite_autoincrement=True,
 )
 
+# Daily rollups of the events, maintained as events are logged, so that
+# aggregate queries don't need to scan the event table.
+event_user_rollup = Table(
+  'event_user_rollup',
+  db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
+  Column('date', String(63), nullable=False),
+  # Empty (rather than NULL) for anonymous events, see BundleModel.ANONYMOUS_EVENT_USER.
+  Column('user_id', String(63), nullable=False),
+  Column('user_name', String(63), nullable=False),
+  Column('count', Integer, nullable=False),  # Number of events
+  Column('duration', Float, nullable=False),  # Total duration of the events
+  UniqueConstraint('date', 'user_id', 'user_name', name='uix_event_user_rollup'),
+  Index('event_user_rollup_user_name_index', 'user_name'),
+  sqlite_autoincrement=True,
+)
+
+event_command_rollup = Table(
+  'event_command_rollup',
+  db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
+  Column('date', String(63), nullable=False),
+  Column('command', String(63), nullable=False),
+  Column('count', Integer, nullable=False),  # Number of events
+  Column('duration', Float, nullable=False),  # Total duration of the events
+  UniqueConstraint('date', 'command', name='uix_event_command_rollup'),
+  Index('event_command_rollup_command_index', 'command'),
+  sqlite_autoincrement=True,
+)
+
 # Store information about users.
 user = Table(
   'user',
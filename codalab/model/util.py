@@ -1,8 +1,219 @@
 '''
 Some utility classes and methods used with the CodaLab bundle model.
 '''
+import base64
+import collections
+import json
+import re
+import threading
+
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.sql.selectable import Select
+
+from codalab.common import UsageError
+
 class LikeQuery(str):
     '''
     Used for a string that should be used to construct a LIKE clause instead of
     an equality clause in make_bundle_clause.
     '''
+
+
+# Metadata keys that are mirrored into the typed columns of the bundle_search
+# table, along with the function used to convert the stored text value.
+BUNDLE_SEARCH_KEYS = {
+    'name': unicode,
+    'created': int,
+    'data_size': int,
+    'time': float,
+    'memory': float,
+    'job_handle': unicode,
+    'description': unicode,
+}
+
+
+def bundle_search_values(metadata_values):
+    '''
+    Given a list of bundle_metadata row dicts (metadata_key, metadata_value),
+    return a dict mapping each key in BUNDLE_SEARCH_KEYS to its typed value (or
+    None if the bundle doesn't have that key or its value can't be converted).
+    '''
+    result = dict((key, None) for key in BUNDLE_SEARCH_KEYS)
+    for row in metadata_values:
+        key = str(row['metadata_key'])
+        if key not in BUNDLE_SEARCH_KEYS:
+            continue
+        try:
+            result[key] = BUNDLE_SEARCH_KEYS[key](row['metadata_value'])
+        except (TypeError, ValueError):
+            result[key] = None
+    return result
+
+
+# Length of the substrings stored in the search_token table.
+SEARCH_TOKEN_LENGTH = 3
+
+
+def get_search_tokens(*strings):
+    '''
+    Return the set of (lowercased) trigrams occurring in any of the given
+    strings.  Strings that are None are skipped.
+    '''
+    tokens = set()
+    for s in strings:
+        if not s:
+            continue
+        s = s.lower()
+        for i in range(len(s) - SEARCH_TOKEN_LENGTH + 1):
+            tokens.add(s[i:i + SEARCH_TOKEN_LENGTH])
+    return tokens
+
+
+def get_query_search_tokens(value):
+    '''
+    Return the set of trigrams that any string containing the LIKE pattern
+    |value| must contain (the wildcards % and _ split the pattern).
+    '''
+    return get_search_tokens(*re.split('[%_]', value))
+
+
+def compute_ancestors(uuids, parents, known_ancestors):
+    '''
+    Compute the rows of the bundle_closure table for the bundles |uuids|.
+    |parents| maps each of |uuids| to the set of uuids it depends on, and
+    |known_ancestors| maps every other parent to its {ancestor_uuid: depth}.
+    Return {uuid: {ancestor_uuid: depth}} for |uuids|, where depth is the
+    length of the shortest dependency path.
+    '''
+    uuids = set(uuids)
+    # Order the bundles so that parents come before their children.
+    order = []
+    visited = set()
+    for root in uuids:
+        stack = [(root, False)]
+        while stack:
+            uuid, finished = stack.pop()
+            if finished:
+                order.append(uuid)
+                continue
+            if uuid in visited:
+                continue
+            visited.add(uuid)
+            stack.append((uuid, True))
+            for parent in parents.get(uuid, ()):
+                if parent in uuids and parent not in visited:
+                    stack.append((parent, False))
+
+    ancestors = dict(known_ancestors)
+    for uuid in order:
+        result = {}
+        for parent in parents.get(uuid, ()):
+            candidates = [(parent, 1)]
+            candidates.extend((a, d + 1) for (a, d) in ancestors.get(parent, {}).iteritems())
+            for (ancestor, depth) in candidates:
+                if ancestor == uuid:  # Cycle (shouldn't happen)
+                    continue
+                if ancestor not in result or depth < result[ancestor]:
+                    result[ancestor] = depth
+        ancestors[uuid] = result
+    return dict((uuid, ancestors[uuid]) for uuid in uuids)
+
+
+def encode_continuation_token(sort_value, last_id):
+    '''
+    Return an opaque token identifying the position (sort_value, last_id) in
+    the results of a search, used for keyset pagination.
+    '''
+    return base64.urlsafe_b64encode(json.dumps([sort_value, last_id])).rstrip('=')
+
+
+def decode_continuation_token(token):
+    '''
+    Inverse of encode_continuation_token: return (sort_value, last_id).
+    '''
+    try:
+        token = str(token)
+        sort_value, last_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return sort_value, int(last_id)
+    except (TypeError, ValueError):
+        raise UsageError('Invalid continuation token: %s' % token)
+
+
+class VersionedLRUCache(object):
+    '''
+    Thread-safe, fixed-capacity cache of (version, value) pairs, evicting the
+    least recently used entry when full.  A lookup only hits if the cached
+    version matches the current version given by the caller.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        '''
+        Return the value cached for |key| at |version|, or None.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # Mark as most recently used
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, value)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def add_misses(self, count):
+        with self._lock:
+            self.misses += count
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else None,
+            }
+
+
+def get_bind_params(query):
+    '''
+    Return the bind parameters of |query| (including those of LIMIT and
+    OFFSET), in an order that only depends on the structure of the query, so
+    that they can be matched up with those of another query of the same
+    structure.
+    '''
+    binds = []
+    for element in visitors.iterate(query, {}):
+        if isinstance(element, BindParameter):
+            binds.append(element)
+        elif isinstance(element, Select):
+            for clause in (element._limit_clause, element._offset_clause):
+                if isinstance(clause, BindParameter):
+                    binds.append(clause)
+    return binds
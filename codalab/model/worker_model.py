@@ -319,3 +319,20 @@ class WorkerModel(object):
             if row:
                 return True
             return False
+
+    def is_running_bundle(self, user_id, worker_id, uuid):
+        """
+        Checks whether the given user running a worker with the given ID is
+        running the bundle with the given UUID. Used to prevent a user from
+        updating bundles running on another user's worker.
+        """
+        with self._engine.begin() as conn:
+            row = conn.execute(
+                cl_worker_run.select()
+                    .where(and_(cl_worker_run.c.user_id == user_id,
+                                cl_worker_run.c.worker_id == worker_id,
+                                cl_worker_run.c.run_uuid == uuid))
+            ).fetchone()
+            if row:
+                return True
+            return False
@@ -31,7 +31,7 @@ from codalab.objects.metadata import Metadata
 
 
 class Bundle(ORMObject):
-    COLUMNS = ('uuid', 'bundle_type', 'command', 'data_hash', 'state', 'owner_id')
+    COLUMNS = ('uuid', 'bundle_type', 'command', 'data_hash', 'state', 'owner_id', 'version')
     # Bundle subclasses should have the following class-level attributes:
     #   - BUNDLE_TYPE: a string bundle type
     #   - METADATA_SPECS: a list of MetadataSpec objects
@@ -72,6 +72,8 @@ class Bundle(ORMObject):
             precondition(dependencies is not None, 'No dependencies: %s' % (row,))
             if 'uuid' not in row:
                 row['uuid'] = spec_util.generate_uuid()
+            if 'version' not in row:
+                row['version'] = 0
         super(Bundle, self).update_in_memory(row)
         if metadata is not None:
             self.metadata = Metadata(self.METADATA_SPECS, metadata)
@@ -132,8 +134,10 @@ class Bundle(ORMObject):
             if os.path.exists(link_path):
                 path_util.remove(link_path)
             # Either copy (but not follow further symlinks) or symlink.
+            # Neither the dependency nor the copy (which becomes part of this
+            # bundle) is modified afterwards, so they can share their files.
             if copy:
-                path_util.copy(target, link_path, follow_symlinks=False)
+                path_util.copy(target, link_path, follow_symlinks=False, hardlink=True)
             else:
                 os.symlink(target, link_path)
 
@@ -0,0 +1,24 @@
+'''
+BundleRecord is a lightweight projection of a bundle, returned by
+BundleModel.batch_get_bundle_records for hot internal paths like the worker
+loop, which only need a few fields of many bundles.
+
+Unlike Bundle, a BundleRecord is not validated, only has the columns,
+metadata keys and dependencies that were asked for (other attributes are
+unset), and stores its metadata as a plain dict of (already typed) values.
+'''
+
+
+class BundleRecord(object):
+    __slots__ = ('id', 'uuid', 'bundle_type', 'command', 'data_hash', 'state', 'owner_id',
+                 'metadata', 'dependencies')
+
+    def __init__(self, row):
+        self.update_in_memory(row)
+
+    def update_in_memory(self, row):
+        for (key, value) in row.iteritems():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return 'BundleRecord(uuid=%r)' % (str(self.uuid),)
@@ -1,8 +1,12 @@
 '''
 Defines ORM classes for groups and permissions.
 '''
+from contextlib import contextmanager
+import threading
+
 from codalab.model.orm_object import ORMObject
 from codalab.common import (
+    IntegrityError,
     NotFoundError,
     precondition,
     UsageError,
@@ -15,6 +19,8 @@ from codalab.model.tables import (
     GROUP_OBJECT_PERMISSION_ALL,
     GROUP_OBJECT_PERMISSION_READ,
     GROUP_OBJECT_PERMISSION_NONE,
+    bundle as cl_bundle,
+    worksheet as cl_worksheet,
     group_bundle_permission as cl_group_bundle_permission,
     group_object_permission as cl_group_worksheet_permission,
 )
@@ -98,35 +104,162 @@ def get_single_group(model, group_spec, search_fn):
 ############################################################
 # Checking permissions
 
-def _check_permissions(model, table, user, object_uuids, owner_ids, need_permission):
-    if len(object_uuids) == 0:
-        return
-    have_permissions = model.get_user_permissions(table, user.unique_id if user else None, object_uuids, owner_ids)
-    #print '_check_permissions %s %s, have %s, need %s' % (user, object_uuids, map(permission_str, have_permissions.values()), permission_str(need_permission))
-    if min(have_permissions.values()) >= need_permission:
-        return
-    if user:
-        user_str = '%s(%s)' % (user.name, user.unique_id)
-    else:
-        user_str = None
-    if table == cl_group_bundle_permission:
-        object_type = 'bundle'
-    elif table == cl_group_worksheet_permission:
-        object_type = 'worksheet'
-    else:
-        raise IntegrityError('Unexpected table: %s' % table)
-    raise PermissionError("User %s does not have sufficient permissions on %s %s (have %s, need %s)." % \
-        (user_str, object_type, ' '.join(object_uuids), ' '.join(map(permission_str, have_permissions.values())), permission_str(need_permission)))
+class PermissionResolver(object):
+    '''
+    Computes the permissions of one user on bundles and worksheets.  Meant to
+    live for the duration of a single request (or RPC call): the user's groups
+    are loaded once, and the owner and group permissions of each object are
+    fetched in batches and memoized by uuid.
+    '''
+    def __init__(self, model, user):
+        self.model = model
+        self.user = user
+        self.user_id = user.unique_id if user else None
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Forget everything memoized (call after changing owners, permissions or
+        group memberships).
+        '''
+        self._user_groups = None
+        self._owner_ids = {cl_group_bundle_permission: {}, cl_group_worksheet_permission: {}}
+        self._group_permissions = {cl_group_bundle_permission: {}, cl_group_worksheet_permission: {}}
+
+    def is_root(self):
+        return self.user_id == self.model.root_user_id
+
+    def get_user_groups(self):
+        '''
+        Return the set of uuids of the groups that the user is in.
+        '''
+        if self._user_groups is None:
+            self._user_groups = set(self.model._get_user_groups(self.user_id))
+        return self._user_groups
+
+    def get_owner_ids(self, table, object_uuids):
+        '''
+        Return map from object_uuid to owner_id (objects that don't exist are omitted).
+        '''
+        owner_ids = self._owner_ids[table]
+        missing = [uuid for uuid in set(object_uuids) if uuid not in owner_ids]
+        if missing:
+            object_table = cl_bundle if table == cl_group_bundle_permission else cl_worksheet
+            owner_ids.update(self.model.get_owner_ids(object_table, missing))
+        return dict((uuid, owner_ids[uuid]) for uuid in object_uuids if uuid in owner_ids)
+
+    def get_group_permissions(self, table, object_uuids):
+        '''
+        Return map from object_uuid to list of {group_uuid: ..., group_name: ..., permission: ...}
+        for the groups that the user is in (all groups if the user is root).
+        '''
+        group_permissions = self._group_permissions[table]
+        missing = [uuid for uuid in set(object_uuids) if uuid not in group_permissions]
+        if missing:
+            user_groups = None if self.is_root() else self.get_user_groups()
+            result = self.model.batch_get_group_permissions(table, self.user_id, missing, user_groups=user_groups)
+            for uuid in missing:
+                group_permissions[uuid] = result[uuid]
+        return dict((uuid, group_permissions[uuid]) for uuid in object_uuids)
+
+    def get_permissions(self, table, object_uuids, owner_ids=None):
+        '''
+        Return map from object_uuid to the permission that the user has on it.
+        owner_ids: optional map from object_uuid to owner_id (fetched if not given).
+        '''
+        if self.is_root():
+            return dict((uuid, GROUP_OBJECT_PERMISSION_ALL) for uuid in object_uuids)
+        if owner_ids is None:
+            owner_ids = self.get_owner_ids(table, object_uuids)
+        else:
+            self._owner_ids[table].update(owner_ids)
+        permissions = dict((uuid, GROUP_OBJECT_PERMISSION_NONE) for uuid in object_uuids)
+        remaining_uuids = []
+        for uuid in object_uuids:
+            # Owner has all permissions.
+            if owner_ids.get(uuid) == self.user_id:
+                permissions[uuid] = GROUP_OBJECT_PERMISSION_ALL
+            else:
+                remaining_uuids.append(uuid)
+        if remaining_uuids:
+            user_groups = self.get_user_groups()
+            for uuid, rows in self.get_group_permissions(table, remaining_uuids).iteritems():
+                for row in rows:
+                    if row['group_uuid'] in user_groups:
+                        permissions[uuid] = max(permissions[uuid], row['permission'])
+        return permissions
+
+    def get_group_bundle_permissions(self, bundle_uuids):
+        return self.get_group_permissions(cl_group_bundle_permission, bundle_uuids)
+    def get_group_worksheet_permissions(self, worksheet_uuids):
+        return self.get_group_permissions(cl_group_worksheet_permission, worksheet_uuids)
+
+    def get_bundle_permissions(self, bundle_uuids):
+        return self.get_permissions(cl_group_bundle_permission, bundle_uuids)
+    def get_worksheet_permissions(self, worksheet_uuids, owner_ids=None):
+        return self.get_permissions(cl_group_worksheet_permission, worksheet_uuids, owner_ids)
+
+    def check_permissions(self, table, object_uuids, need_permission, owner_ids=None):
+        '''
+        Raise a PermissionError unless the user has at least |need_permission|
+        on all of the given objects.
+        '''
+        if len(object_uuids) == 0:
+            return
+        have_permissions = self.get_permissions(table, object_uuids, owner_ids)
+        if min(have_permissions.values()) >= need_permission:
+            return
+        if self.user:
+            user_str = '%s(%s)' % (self.user.name, self.user.unique_id)
+        else:
+            user_str = None
+        if table == cl_group_bundle_permission:
+            object_type = 'bundle'
+        elif table == cl_group_worksheet_permission:
+            object_type = 'worksheet'
+        else:
+            raise IntegrityError('Unexpected table: %s' % table)
+        raise PermissionError("User %s does not have sufficient permissions on %s %s (have %s, need %s)." % \
+            (user_str, object_type, ' '.join(object_uuids), ' '.join(map(permission_str, have_permissions.values())), permission_str(need_permission)))
+
+
+_local = threading.local()
+
+@contextmanager
+def permission_scope():
+    '''
+    Within this block (e.g., for the duration of a request), the permission
+    checks of this thread share one PermissionResolver per model and user.
+    '''
+    previous = getattr(_local, 'resolvers', None)
+    _local.resolvers = {}
+    try:
+        yield
+    finally:
+        _local.resolvers = previous
+
+def get_permission_resolver(model, user):
+    '''
+    Return the PermissionResolver for |model| and |user| of the current
+    permission_scope, or a new one if we're not in a scope.
+    '''
+    resolvers = getattr(_local, 'resolvers', None)
+    if resolvers is None:
+        return PermissionResolver(model, user)
+    key = (id(model), user.unique_id if user else None)
+    if key not in resolvers:
+        resolvers[key] = PermissionResolver(model, user)
+    return resolvers[key]
 
 def check_bundles_have_read_permission(model, user, bundle_uuids):
-    _check_permissions(model, cl_group_bundle_permission, user, bundle_uuids, model.get_bundle_owner_ids(bundle_uuids), GROUP_OBJECT_PERMISSION_READ)
+    get_permission_resolver(model, user).check_permissions(cl_group_bundle_permission, bundle_uuids, GROUP_OBJECT_PERMISSION_READ)
 def check_bundles_have_all_permission(model, user, bundle_uuids):
-    _check_permissions(model, cl_group_bundle_permission, user, bundle_uuids, model.get_bundle_owner_ids(bundle_uuids), GROUP_OBJECT_PERMISSION_ALL)
+    get_permission_resolver(model, user).check_permissions(cl_group_bundle_permission, bundle_uuids, GROUP_OBJECT_PERMISSION_ALL)
 
 def check_worksheet_has_read_permission(model, user, worksheet):
-    _check_permissions(model, cl_group_worksheet_permission, user, [worksheet.uuid], {worksheet.uuid: worksheet.owner_id}, GROUP_OBJECT_PERMISSION_READ)
+    get_permission_resolver(model, user).check_permissions(cl_group_worksheet_permission, [worksheet.uuid], GROUP_OBJECT_PERMISSION_READ, {worksheet.uuid: worksheet.owner_id})
 def check_worksheet_has_all_permission(model, user, worksheet):
-    _check_permissions(model, cl_group_worksheet_permission, user, [worksheet.uuid], {worksheet.uuid: worksheet.owner_id}, GROUP_OBJECT_PERMISSION_ALL)
+    get_permission_resolver(model, user).check_permissions(cl_group_worksheet_permission, [worksheet.uuid], GROUP_OBJECT_PERMISSION_ALL, {worksheet.uuid: worksheet.owner_id})
 
 ############################################################
 # Parsing functions for permissions.
@@ -29,8 +29,14 @@ from codalab.bundles.run_bundle import RunBundle
 from codalab.bundles.make_bundle import MakeBundle
 from codalab.lib.bundle_action import BundleAction
 from codalab.machines import remote_machine
+from codalab.machines.local_machine import LocalMachine
+from worker.file_util import ContentsIndexTracker
 
 class Worker(object):
+    # Minimum number of seconds between two updates of the contents index of a
+    # running bundle, each of which walks its whole directory.
+    CONTENTS_INDEX_UPDATE_INTERVAL = 30
+
     def __init__(self, bundle_store, model, machine, auth_handler):
         self.bundle_store = bundle_store
         self.model = model
@@ -38,6 +44,10 @@ class Worker(object):
         self.verbose = 0
         self.machine = machine
         self.auth_handler = auth_handler  # In order to get names of owners
+        # uuid => (ContentsIndexTracker, time of its last update) of the bundles
+        # started by a LocalMachine, whose contents index is updated with deltas
+        # as they run.
+        self.contents_trackers = {}
 
     def pretty_print(self, message):
         time_str = datetime.datetime.utcnow().isoformat()[:19].replace('T', ' ')
@@ -111,6 +121,8 @@ class Worker(object):
                     if status != None:
                         status['started'] = int(time.time())
                         started = True
+                        if isinstance(self.machine, LocalMachine):
+                            self.contents_trackers[bundle.uuid] = (ContentsIndexTracker(status['temp_dir']), 0)
 
                 except Exception as e:
                     # If there's an exception, we just make the bundle fail
@@ -183,12 +195,16 @@ class Worker(object):
         '''
         uuids = self.model.search_bundle_uuids(worksheet_uuid=None, user_id=self.model.root_user_id,
                                                keywords=['state='+','.join([State.RUNNING, State.QUEUED])])
-        bundles = self.model.batch_get_bundles(uuid=uuids)
-        def _failed(bundle):
+        records = self.model.batch_get_bundle_records(['state'], ['last_updated'], uuid=uuids)
+        def _failed(record):
+            last_updated = record.metadata.get('last_updated')
+            if last_updated is None:
+                return False
             now = int(time.time())
-            since_last_update = now - bundle.metadata.last_updated
+            since_last_update = now - last_updated
             return since_last_update >= update_timeout
-        failed_bundles = filter(_failed, bundles)
+        # Only load the full bundles that need to be updated.
+        failed_bundles = self.model.batch_get_bundles(uuid=[record.uuid for record in records if _failed(record)])
         for bundle in failed_bundles:
             failure_msg = 'No response from worker in %s' % formatting.duration_str(update_timeout)
             status = {'state': State.FAILED, 'success': False, 'bundle': bundle, 'failure_message': failure_msg}
@@ -205,15 +221,23 @@ class Worker(object):
         # Lookup all the uuids and bundles of the relevant job handles
         handles = [status['job_handle'] for status in statuses]
         uuids = self.model.search_bundle_uuids(worksheet_uuid=None, user_id=self.model.root_user_id, keywords=['job_handle='+','.join(handles)])
-        bundles = self.model.batch_get_bundles(uuid=uuids)
-        handle_to_bundles = {}
-        for bundle in bundles:
-            handle = bundle.metadata.job_handle
-            handle_to_bundles[handle] = bundle
+        records = self.model.batch_get_bundle_records(['state'], ['job_handle'], uuid=uuids)
+        handle_to_records = {}
+        for record in records:
+            handle = record.metadata.get('job_handle')
+            handle_to_records[handle] = record
+        # Only load the full bundles that still need to be updated.
+        running_uuids = [record.uuid for record in records if record.state not in [State.READY, State.FAILED]]
+        uuid_to_bundles = {bundle.uuid: bundle for bundle in self.model.batch_get_bundles(uuid=running_uuids)}
+        status_bundle_uuids = set()
         for status in statuses:
             handle = status['job_handle']
-            bundle = handle_to_bundles.get(handle)
-            if not bundle:
+            record = handle_to_records.get(handle)
+            if not record:
+                continue
+            status_bundle_uuids.add(record.uuid)
+            bundle = uuid_to_bundles.get(record.uuid)
+            if not bundle:  # Skip bundles that have already completed.
                 continue
             status['bundle'] = bundle
             new_statuses.append(status)
@@ -229,11 +253,12 @@ class Worker(object):
         # Make a note of runnning jobs (according to the database) which aren't
         # mentioned in statuses.  These are probably zombies, and we want to
         # get rid of them if they have been issued a kill action.
-        status_bundle_uuids = set(status['bundle'].uuid for status in statuses)
-        running_bundles = self.model.batch_get_bundles(state=State.RUNNING)
-        for bundle in running_bundles:
-            if bundle.uuid in status_bundle_uuids: continue  # Exists, skip
-            if BundleAction.KILL not in getattr(bundle.metadata, 'actions', set()): continue  # Not killing
+        running_records = self.model.batch_get_bundle_records(['state'], ['actions'], state=State.RUNNING)
+        for record in running_records:
+            if record.uuid in status_bundle_uuids: continue  # Exists, skip
+            if BundleAction.KILL not in record.metadata.get('actions', []): continue  # Not killing
+            bundle = self._safe_get_bundle(record.uuid)
+            if not bundle: continue  # Might have been deleted
             status = {'state': State.FAILED, 'bundle': bundle}
             print 'work_manager: %s (%s): killing zombie %s' % (bundle.uuid, bundle.state, status)
             self.update_running_bundle(status)
@@ -275,7 +300,14 @@ class Worker(object):
 
         # See if the bundle is completed.
         success = status.get('success')
-        if success is not None:
+        if success is None:
+            if bundle.uuid in self.contents_trackers:
+                (tracker, last_update_time) = self.contents_trackers[bundle.uuid]
+                if status['last_updated'] - last_update_time >= self.CONTENTS_INDEX_UPDATE_INTERVAL:
+                    self.model.add_bundle_contents_deltas(bundle.uuid, tracker.get_deltas())
+                    self.contents_trackers[bundle.uuid] = (tracker, status['last_updated'])
+        else:
+            self.contents_trackers.pop(bundle.uuid, None)
             # Re-install dependencies.
             # - For RunBundle, remove the dependencies.
             # - For MakeBundle, copy.  This way, we maintain the invariant that
@@ -292,8 +324,12 @@ class Worker(object):
                     print >>sys.stderr, 'Worker.finalize_bundle: installing (copying) dependencies to %s (MakeBundle)' % temp_dir
                     bundle.install_dependencies(self.bundle_store, self.get_parent_dict(bundle), temp_dir, copy=True)
 
-                db_update['data_hash'] = '0x%s' % path_util.hash_path(temp_dir)
-                metadata.update(data_size=path_util.get_size(temp_dir))
+                (data_hash, data_size, index) = path_util.scan_path(temp_dir, num_threads=self.bundle_store.hash_threads)
+                db_update['data_hash'] = '0x%s' % data_hash
+                metadata.update(data_size=data_size)
+                # This also drops the deltas recorded while the bundle ran.
+                index['name'] = bundle.uuid
+                self.model.update_bundle_contents_index(bundle.uuid, index)
             except Exception as e:
                 print '=== INTERNAL ERROR: %s' % e
                 traceback.print_exc()
@@ -320,10 +356,11 @@ class Worker(object):
 
             # Update user statistics
             self.model.increment_user_time_used(bundle.owner_id, getattr(bundle.metadata, 'time', 0))
-            self.model.update_user_disk_used(bundle.owner_id)
 
         # Update database!
         self.model.update_bundle(bundle, db_update)
+        if db_update.get('state') == State.READY:
+            self.bundle_store.deduplicate(self.model, bundle.uuid, db_update.get('data_hash'), metadata.get('data_size'))
 
 
     def update_created_bundles(self):
@@ -335,7 +372,8 @@ class Worker(object):
         '''
         #print '-- Updating CREATED bundles! --'
         with self.profile('Getting CREATED bundles...'):
-            bundles = self.model.batch_get_bundles(state=State.CREATED)
+            bundles = self.model.batch_get_bundle_records(
+              ['state'], ['allow_failed_dependencies'], fetch_dependencies=True, state=State.CREATED)
             if self.verbose >= 1 and len(bundles) > 0:
                 self.pretty_print('Updating %s created bundles.' % (len(bundles),))
         parent_uuids = set(
@@ -343,7 +381,7 @@ class Worker(object):
         )
 
         with self.profile('Getting parents...'):
-            parents = self.model.batch_get_bundles(uuid=parent_uuids)
+            parents = self.model.batch_get_bundle_records(['state'], uuid=parent_uuids)
         all_parent_states = {parent.uuid: parent.state for parent in parents}
         all_parent_uuids = set(all_parent_states)
         bundles_to_fail = []
@@ -356,7 +394,7 @@ class Worker(object):
             parent_states = {uuid: all_parent_states[uuid] for uuid in parent_uuids}
 
             acceptable_states = [State.READY]
-            if bundle.metadata.allow_failed_dependencies:
+            if bundle.metadata.get('allow_failed_dependencies'):
                 acceptable_states.append(State.FAILED)
             else:
                 failed_uuids = [
@@ -372,10 +410,13 @@ class Worker(object):
                 bundles_to_stage.append(bundle)
 
         with self.profile('Failing %s bundles...' % (len(bundles_to_fail),)):
+            # Updating metadata needs the full bundles.
+            full_bundles = self.model.batch_get_bundles(uuid=[bundle.uuid for (bundle, _) in bundles_to_fail])
+            uuid_to_full_bundles = {bundle.uuid: bundle for bundle in full_bundles}
             for (bundle, failure_message) in bundles_to_fail:
                 metadata_update = {'failure_message': failure_message}
                 update = {'state': State.FAILED, 'metadata': metadata_update}
-                self.model.update_bundle(bundle, update)
+                self.model.update_bundle(uuid_to_full_bundles[bundle.uuid], update)
         self.update_bundle_states(bundles_to_stage, State.STAGED)
         num_processed = len(bundles_to_fail) + len(bundles_to_stage)
         num_blocking  = len(bundles) - num_processed
@@ -16,9 +16,12 @@ from codalab.model.orm_object import ORMObject
 # These sort keys will be strictly upper-bounded by the maximum id at the time
 # at which the edit was BEGUN. This ensures that any worksheet items appended to
 # the sheet between the time the edit was begun and committed will have ids
-# greater than the maximum sort key.
+# greater than the maximum sort key. Items appended one at a time get their id as
+# their sort key (items from before that have none), and ties are broken by id,
+# which also lets an inserted item share the sort key of the item before it,
+# so items can be fetched in order from the index on (worksheet_uuid, sort_key, id).
 def item_sort_key(item):
-    return item['id'] if item['sort_key'] is None else item['sort_key']
+    return (item['id'] if item['sort_key'] is None else item['sort_key'], item['id'])
 
 class Worksheet(ORMObject):
     COLUMNS = ('uuid', 'name', 'owner_id', 'title', 'frozen')
@@ -43,6 +43,10 @@ from codalab.server.auth import LocalUserAuthHandler
 from codalab.server.authenticated_plugin import AuthenticatedPlugin
 from codalab.server.rpc_file_handle import RPCFileHandle
 
+# Default and maximum number of items returned by get_worksheet_items.
+WORKSHEET_ITEMS_PAGE_SIZE = 1000
+MAX_WORKSHEET_ITEMS_PAGE_SIZE = 10000
+
 
 class BundleService(object):
     '''
@@ -81,6 +85,15 @@ class BundleService(object):
     def search_worksheets(self, keywords, worksheet_uuid=None):
         return self.client.search_worksheets(keywords)
 
+    def search_worksheets_page(self, keywords):
+        return self.client.search_worksheets_page(keywords)
+
+    def search_bundle_uuids_page(self, keywords, worksheet_uuid=None):
+        return self.client.search_bundle_uuids_page(worksheet_uuid, keywords)
+
+    def get_worksheet_items_page(self, uuid, after, limit):
+        return self.client.get_worksheet_items_page(uuid, after, limit)
+
     def get_worksheet_uuid(self, spec):
         # generic function sometimes get uuid already just return it.
         if spec_util.UUID_REGEX.match(spec):
@@ -288,6 +301,9 @@ class BundleService(object):
     def get_user_info(self, user_id):
         return self.client.get_user_info(user_id, True)
 
+    def get_model_stats(self, reset):
+        return self.client.get_model_stats(reset)
+
     def get_faq(self):
         return self.client.get_faq()
 
@@ -426,12 +442,56 @@ def post_worksheets_command():
     return json.dumps(result)
 
 
+def _get_search_keywords():
+    '''
+    Return the search keywords given by the query parameters |keywords|
+    (space-separated) and |after| (a continuation token from a previous page).
+    '''
+    keywords = shlex.split(request.query.get('keywords', ''))
+    after = request.query.get('after')
+    if after:
+        keywords.append('.after=' + after)
+    return keywords
+
+
+@get('/api/worksheets/search/')
+def get_worksheets_search():
+    service = BundleService()
+    return service.search_worksheets_page(_get_search_keywords())
+
+
+@get('/api/bundles/search/')
+def get_bundles_search():
+    service = BundleService()
+    worksheet_uuid = request.query.get('worksheet_uuid') or None
+    return service.search_bundle_uuids_page(_get_search_keywords(), worksheet_uuid)
+
+
 @get('/api/worksheets/<uuid:re:%s>/' % spec_util.UUID_STR)
 def get_worksheet_content(uuid):
     service = BundleService()
     return service.full_worksheet(uuid)
 
 
+@get('/api/worksheets/<uuid:re:%s>/items/' % spec_util.UUID_STR)
+def get_worksheet_items(uuid):
+    '''
+    Return a page of the items of a worksheet. The query parameters are |limit|
+    (the maximum number of items, WORKSHEET_ITEMS_PAGE_SIZE by default and at
+    most MAX_WORKSHEET_ITEMS_PAGE_SIZE) and |after| (a continuation token from
+    a previous page).
+    '''
+    service = BundleService()
+    try:
+        limit = int(request.query.get('limit', WORKSHEET_ITEMS_PAGE_SIZE))
+    except ValueError:
+        abort(httplib.BAD_REQUEST, 'Invalid limit.')
+    if limit <= 0:
+        abort(httplib.BAD_REQUEST, 'Limit must be positive.')
+    limit = min(limit, MAX_WORKSHEET_ITEMS_PAGE_SIZE)
+    return service.get_worksheet_items_page(uuid, request.query.get('after') or None, limit)
+
+
 @post('/api/worksheets/<uuid:re:%s>/' % spec_util.UUID_STR,
       apply=AuthenticatedPlugin())
 def post_worksheet_content(uuid):
@@ -562,6 +622,17 @@ def get_users():
     }
 
 
+@get('/api/model_stats/', apply=AuthenticatedPlugin())
+def get_model_stats():
+    '''
+    Return the statistics of the model calls made by the requests to this
+    server process (root only). With the query parameter reset=1, start
+    recording from scratch afterwards.
+    '''
+    service = BundleService()
+    return service.get_model_stats(request.query.get('reset') == '1')
+
+
 @get('/api/faq/')
 def get_faq():
     """
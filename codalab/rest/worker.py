@@ -4,11 +4,12 @@ import json
 
 from bottle import abort, local, post, request
 
+from codalab.lib import spec_util
 from codalab.server.authenticated_plugin import AuthenticatedPlugin
 
 
 @post('/worker/<worker_id>/checkin',
-      apply=AuthenticatedPlugin())
+      apply=AuthenticatedPlugin(), unit_of_work=False)
 def checkin(worker_id):
     """
     Checks in with the bundle service, storing information about the worker.
@@ -44,7 +45,7 @@ def check_reply_permission(worker_id, socket_id):
 
 
 @post('/worker/<worker_id>/reply/<socket_id:int>',
-      apply=AuthenticatedPlugin())
+      apply=AuthenticatedPlugin(), unit_of_work=False)
 def reply(worker_id, socket_id):
     """
     Replies with a single JSON message to the given socket ID.
@@ -54,7 +55,7 @@ def reply(worker_id, socket_id):
 
 
 @post('/worker/<worker_id>/reply_data/<socket_id:int>',
-      apply=AuthenticatedPlugin())
+      apply=AuthenticatedPlugin(), unit_of_work=False)
 def reply_data(worker_id, socket_id):
     """
     Replies with a stream of data to the given socket ID. This reply mechanism
@@ -77,3 +78,20 @@ def reply_data(worker_id, socket_id):
     check_reply_permission(worker_id, socket_id)
     local.worker_model.send_json_message(socket_id, header_message, 60, autoretry=False)
     local.worker_model.send_stream(socket_id, request['wsgi.input'], 60)
+
+
+@post('/worker/<worker_id>/update_contents_index/<uuid:re:%s>' % spec_util.UUID_STR,
+      apply=AuthenticatedPlugin())
+def update_contents_index(worker_id, uuid):
+    """
+    Records changes to the contents index of a bundle running on the worker.
+    The JSON body has the fields:
+        deltas: List of changes, see BundleModel.add_bundle_contents_deltas.
+        merge: If true, the changes are merged into the stored index, e.g.
+               once the bundle has finished running.
+    """
+    if not local.worker_model.is_running_bundle(request.user.user_id, worker_id, uuid):
+        abort(httplib.FORBIDDEN, 'Not your bundle!')
+    local.model.add_bundle_contents_deltas(uuid, request.json['deltas'])
+    if request.json.get('merge'):
+        local.model.merge_bundle_contents_deltas(uuid)
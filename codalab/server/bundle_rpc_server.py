@@ -30,6 +30,8 @@ from codalab.common import (
     PermissionError,
 )
 from codalab.client.remote_bundle_client import RemoteBundleClient
+from codalab.model.instrumentation import record_request
+from codalab.objects.permission import permission_scope
 from codalab.server.file_server import FileServer
 
 
@@ -79,6 +81,8 @@ class BundleRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
 
         # This server is backed by a LocalBundleClient that processes client commands
         self.client = manager.client('local', is_cli=False)
+        # Write the events log in the background, off the critical path of the RPCs.
+        self.client.model.start_events_log_writer()
 
         # This server is backed by a file server that processes file commands.
         self.file_server = FileServer()
@@ -118,7 +122,9 @@ class BundleRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
                     start_time = time.time()
 
                     # Dynamically bind method and call it
-                    result = getattr(target, command)(*args, **kwargs)
+                    with permission_scope(), record_request(self.client.model, command), \
+                            self.client.model.request_scope():
+                        result = getattr(target, command)(*args, **kwargs)
 
                     # Log this activity.
                     if not isinstance(target, FileServer):
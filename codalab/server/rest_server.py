@@ -21,6 +21,8 @@ from bottle import (
 )
 
 from codalab.common import exception_to_http_error
+from codalab.model.instrumentation import record_request
+from codalab.objects.permission import permission_scope
 import codalab.rest.account
 import codalab.rest.bundle
 import codalab.rest.example
@@ -42,7 +44,13 @@ ROUTES_NOT_LOGGED_REGEXES = [
 
 
 class SaveEnvironmentPlugin(object):
-    """Saves environment objects in the local request variable."""
+    """
+    Saves environment objects in the local request variable.
+
+    Each request is a unit of work (see BundleModel.request_scope), unless its
+    route is declared with unit_of_work=False, e.g. because it waits for other
+    processes to see its writes.
+    """
     api = 2
     
     def __init__(self, manager):
@@ -60,7 +68,24 @@ class SaveEnvironmentPlugin(object):
             local.bundle_store = self.manager.bundle_store()
             local.config = self.manager.config
             local.emailer = self.manager.emailer()
-            return callback(*args, **kwargs)
+            unit_of_work = route.config.get('unit_of_work', True)
+            with permission_scope(), record_request(local.model, '%s %s' % (route.method, route.rule)), \
+                    local.model.request_scope(unit_of_work):
+                try:
+                    result = callback(*args, **kwargs)
+                except HTTPResponse as e:
+                    result = e
+                if isinstance(result, HTTPResponse):
+                    if isinstance(result, HTTPError) or result.status_code >= 400:
+                        # Errors (including the exceptions converted by
+                        # ErrorAdapter, which runs within this plugin) roll
+                        # back the writes.
+                        raise result
+                    # Keep the writes of redirects and other responses.
+                    response = result
+                else:
+                    return result
+            raise response
 
         return wrapper
 
@@ -102,6 +127,9 @@ class LoggingPlugin(object):
                 and request.content_type == 'application/json'):
                 args.append(request.json)
 
+            # Started here rather than at startup so that the writer thread
+            # runs in each process forked by the server.
+            local.model.start_events_log_writer()
             local.model.update_events_log(
                 start_time=start_time,
                 user_id=getattr(getattr(local, 'user', None), 'user_id', ''),
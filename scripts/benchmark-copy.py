@@ -0,0 +1,90 @@
+#!./venv/bin/python
+"""
+Compares copying a directory with rsync (the old path_util.copy) against
+copying it in-process with each of the strategies of copy_util, checking that
+the copies have the same hash.
+
+Copies the given directory, or a generated one, into a temporary directory
+(use --temp-dir to copy across file systems):
+    scripts/benchmark-copy.py --files 100 --size 16
+    scripts/benchmark-copy.py /path/to/bundle --temp-dir /other/disk
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.append('.')
+
+from codalab.lib import copy_util, path_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('path', nargs='?', help='Directory to copy (generated if not given)')
+parser.add_argument('-f', '--files', type=int, default=200, help='Number of files to generate')
+parser.add_argument('-s', '--size', type=float, default=8, help='Size of each generated file in megabytes')
+parser.add_argument('-d', '--temp-dir', help='Where to generate the directory and make the copies')
+parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs of each configuration (the best is reported)')
+args = parser.parse_args()
+
+temp_dir = tempfile.mkdtemp(dir=args.temp_dir)
+path = args.path
+if path is None:
+    path = os.path.join(temp_dir, 'bundle')
+    print 'Generating %d files of %s MB in %s' % (args.files, args.size, path)
+    for i in range(args.files):
+        directory = os.path.join(path, 'dir%d' % (i % 10))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file%d' % i), 'wb') as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+path = os.path.abspath(path)
+
+
+def copy_rsync(dest):
+    if subprocess.call(['rsync', '-prl', path + '/', dest]) != 0:
+        raise Exception('rsync failed')
+
+
+def copy_with(strategies):
+    def copy(dest):
+        copier = copy_util.TreeCopier(strategies)
+        copier.copy(path, dest)
+        return copier.counts
+    return copy
+
+
+try:
+    total_size = path_util.get_size(path)
+    print '%d files, %.1f MB' % (len(path_util.recursive_ls(path)[1]), total_size / 1024.0 / 1024)
+    expected_hash = path_util.hash_directory(path)
+
+    configurations = [('rsync', copy_rsync), ('default', copy_with(None))]
+    configurations += [(strategy, copy_with([strategy])) for strategy in copy_util.STRATEGIES]
+    for (name, copy) in configurations:
+        best_time = None
+        counts = None
+        for i in range(args.repeat):
+            dest = os.path.join(temp_dir, 'copy')
+            # Don't count writing back the data of the previous copy.
+            subprocess.call(['sync'])
+            start_time = time.time()
+            try:
+                counts = copy(dest)
+            except Exception as e:
+                print '%-16s failed: %s' % (name, e)
+                break
+            elapsed = time.time() - start_time
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+            digest = path_util.hash_directory(dest)
+            path_util.remove(dest)
+            if digest != expected_hash:
+                print 'MISMATCH with %s: %s != %s' % (name, digest, expected_hash)
+                sys.exit(1)
+        if best_time is not None:
+            print '%-16s %.3fs, %.1f MB/s%s' % (
+                name, best_time, total_size / 1024.0 / 1024 / best_time,
+                ' (%s)' % ', '.join('%s: %d files' % item for item in sorted(counts.items())) if counts else '')
+finally:
+    shutil.rmtree(temp_dir)
@@ -0,0 +1,69 @@
+#!./venv/bin/python
+"""
+Compares hashing a directory one file at a time (the old serial path) against
+hashing with thread pools of various sizes, checking that the digests agree.
+
+Hashes the given directory, or a generated one in a temporary directory:
+    scripts/benchmark-hash-directory.py --files 1000 --size 4
+    scripts/benchmark-hash-directory.py /path/to/bundle --threads 1 4 16
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append('.')
+
+from codalab.lib import path_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('path', nargs='?', help='Directory to hash (generated if not given)')
+parser.add_argument('-f', '--files', type=int, default=200, help='Number of files to generate')
+parser.add_argument('-s', '--size', type=float, default=8, help='Size of each generated file in megabytes')
+parser.add_argument('-t', '--threads', type=int, nargs='+', default=[2, 4, 8, 16], help='Thread pool sizes to try')
+parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs of each configuration (the best is reported)')
+args = parser.parse_args()
+
+temp_dir = None
+path = args.path
+if path is None:
+    temp_dir = tempfile.mkdtemp()
+    path = os.path.join(temp_dir, 'bundle')
+    print 'Generating %d files of %s MB in %s' % (args.files, args.size, path)
+    for i in range(args.files):
+        directory = os.path.join(path, 'dir%d' % (i % 10))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file%d' % i), 'wb') as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+path = os.path.abspath(path)
+
+try:
+    dirs_and_files = path_util.recursive_ls(path)
+    total_size = path_util.get_size(path, dirs_and_files)
+    print '%d files, %.1f MB' % (len(dirs_and_files[1]), total_size / 1024.0 / 1024)
+    # Read everything once so that all the runs hash from the page cache.
+    path_util.hash_directory(path, dirs_and_files)
+
+    serial_time = None
+    expected_hash = None
+    for num_threads in [1] + args.threads:
+        best_time = None
+        for _ in range(args.repeat):
+            start_time = time.time()
+            digest = path_util.hash_directory(path, dirs_and_files, num_threads)
+            elapsed = time.time() - start_time
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+        if expected_hash is None:
+            expected_hash = digest
+            serial_time = best_time
+        elif digest != expected_hash:
+            print 'MISMATCH with %d threads: %s != %s' % (num_threads, digest, expected_hash)
+            sys.exit(1)
+        print '%3d thread(s): %.3fs, %.1f MB/s, %.2fx' % (
+            num_threads, best_time, total_size / 1024.0 / 1024 / best_time, serial_time / best_time)
+    print 'Digest: %s' % expected_hash
+finally:
+    if temp_dir is not None:
+        shutil.rmtree(temp_dir)
@@ -9,10 +9,10 @@ import sys
 sys.path.append('.')
 
 from codalab.common import State
+from codalab.lib import path_util
 from codalab.lib.codalab_manager import CodaLabManager
-from codalab.model.tables import bundle as cl_bundle, bundle_contents_index as cl_bundle_contents_index
+from codalab.model.tables import bundle as cl_bundle, bundle_contents_chunk as cl_bundle_contents_chunk
 from sqlalchemy import distinct, select
-from worker.file_util import index_contents
 
 
 manager = CodaLabManager()
@@ -26,7 +26,7 @@ with engine.begin() as conn:
         .where(cl_bundle.c.state.in_([State.READY, State.FAILED]))
     ).fetchall()
     indexed_bundles = conn.execute(
-        select([distinct(cl_bundle_contents_index.c.bundle_uuid)])
+        select([distinct(cl_bundle_contents_chunk.c.bundle_uuid)])
     ).fetchall()
 
 uuids_to_index = (set(bundle.uuid for bundle in bundles) -
@@ -34,5 +34,5 @@ uuids_to_index = (set(bundle.uuid for bundle in bundles) -
 
 for uuid in uuids_to_index:
     print 'Indexing', uuid
-    index = index_contents(bundle_store.get_bundle_location(uuid))
+    _, _, index = path_util.scan_path(bundle_store.get_bundle_location(uuid), compute_hash=False)
     model.update_bundle_contents_index(uuid, index)
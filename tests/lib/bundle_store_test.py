@@ -0,0 +1,116 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from codalab.common import State
+from codalab.lib import path_util
+from codalab.lib.bundle_store import MultiDiskBundleStore
+
+
+class FakeBundle(object):
+  def __init__(self, uuid, data_hash):
+    self.uuid = uuid
+    self.data_hash = data_hash
+    self.state = State.READY
+    self.dependencies = []
+
+
+class FakeModel(object):
+  def __init__(self, bundles):
+    self.bundles = bundles
+    self.record_queries = 0
+
+  def batch_get_bundle_records(self, columns, uuid=None, data_hash=None, state=None):
+    self.record_queries += 1
+    return self.batch_get_bundles(uuid, data_hash, state)
+
+  def batch_get_bundles(self, uuid=None, data_hash=None, state=None):
+    return [
+      bundle for bundle in self.bundles
+      if (uuid is None or bundle.uuid in uuid) and
+         (data_hash is None or bundle.data_hash == data_hash) and
+         (state is None or bundle.state == state)
+    ]
+
+
+class MultiDiskBundleStoreDeduplicateTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.store = MultiDiskBundleStore(self.temp_directory, deduplicate=True)
+    self.uuids = ['0x%032x' % i for i in range(3)]
+    for uuid in self.uuids:
+      self.write_bundle(uuid, 'same contents')
+    self.data_hash = '0x%s' % path_util.hash_directory(self.store.get_bundle_location(self.uuids[0]))
+    self.model = FakeModel([FakeBundle(uuid, self.data_hash) for uuid in self.uuids])
+
+  def tearDown(self):
+    path_util.remove(self.temp_directory)
+
+  def write_bundle(self, uuid, contents):
+    path = self.store.get_bundle_location(uuid)
+    os.makedirs(os.path.join(path, 'dir'))
+    for name in ['file', 'dir/file']:
+      with open(os.path.join(path, name), 'w') as f:
+        f.write(contents)
+    os.chmod(os.path.join(path, 'file'), 0444)
+    os.symlink('file', os.path.join(path, 'link'))
+
+  def get_inode(self, uuid, name='dir/file'):
+    return os.lstat(os.path.join(self.store.get_bundle_location(uuid), name)).st_ino
+
+  def get_references(self):
+    index = self.store.get_dedup_index('default')
+    try:
+      return index.get_uuids(self.data_hash)
+    finally:
+      index.close()
+
+  def test_deduplicate(self):
+    # Nothing to share with yet.
+    self.model.bundles[1].state = self.model.bundles[2].state = State.RUNNING
+    self.assertEqual(self.store.deduplicate(self.model, self.uuids[0], self.data_hash, 100), 0)
+    self.assertEqual(self.get_references(), self.uuids[:1])
+    self.assertEqual(self.store.deduplicate(self.model, self.uuids[1], self.data_hash, 100), 26)
+    self.assertEqual(self.store.deduplicate(self.model, self.uuids[2], self.data_hash, 100), 26)
+    self.assertEqual(self.get_references(), self.uuids)
+    self.assertEqual(len(set(self.get_inode(uuid) for uuid in self.uuids)), 1)
+    for uuid in self.uuids:
+      self.assertEqual('0x%s' % path_util.hash_directory(self.store.get_bundle_location(uuid)), self.data_hash)
+
+    # The other bundles keep the data.
+    self.store.cleanup(self.uuids[0], dry_run=False)
+    self.assertFalse(os.path.exists(self.store.get_bundle_location(self.uuids[0])))
+    self.assertEqual(self.get_references(), self.uuids[1:])
+    file_stat = os.lstat(os.path.join(self.store.get_bundle_location(self.uuids[1]), 'file'))
+    self.assertEqual((file_stat.st_nlink, stat.S_IMODE(file_stat.st_mode)), (2, 0444))
+
+  def test_empty(self):
+    self.assertEqual(self.store.deduplicate(self.model, self.uuids[1], self.data_hash, 0), 0)
+    self.assertEqual(self.model.record_queries, 0)
+    self.assertEqual(self.get_references(), [])
+
+  def test_not_enabled(self):
+    self.store.deduplicate_bundles = False
+    self.assertEqual(self.store.deduplicate(self.model, self.uuids[1], self.data_hash, 100), 0)
+    self.assertNotEqual(self.get_inode(self.uuids[0]), self.get_inode(self.uuids[1]))
+
+  def test_health_check(self):
+    self.store.deduplicate(self.model, self.uuids[1], self.data_hash, 100)
+    self.assertEqual(self.get_references(), self.uuids[:2])
+    # Unshare a file.
+    path = os.path.join(self.store.get_bundle_location(self.uuids[1]), 'file')
+    os.remove(path)
+    with open(path, 'w') as f:
+      f.write('same contents')
+    os.chmod(path, 0444)
+    # Without checking the contents, only report it.
+    self.store.health_check(self.model, force=True)
+    self.assertNotEqual(self.get_inode(self.uuids[0], 'file'), self.get_inode(self.uuids[1], 'file'))
+    self.store.health_check(self.model, force=True, compute_data_hash=True)
+    self.assertEqual(self.get_inode(self.uuids[0], 'file'), self.get_inode(self.uuids[1], 'file'))
+
+    # Forget the bundles that are gone.
+    self.model.bundles.pop(0)
+    self.store.health_check(self.model, force=True)
+    self.assertEqual(self.get_references(), self.uuids[1:2])
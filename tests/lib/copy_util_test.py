@@ -0,0 +1,81 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from codalab.lib import copy_util, path_util
+
+
+class CopyUtilTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.source = os.path.join(self.temp_directory, 'source')
+    os.makedirs(os.path.join(self.source, 'dir', 'subdir'))
+    for (name, size) in [('empty', 0), ('small', 100), ('dir/large', 3 * 1024 * 1024 + 7)]:
+      with open(os.path.join(self.source, name), 'wb') as f:
+        f.write(os.urandom(size))
+    os.chmod(os.path.join(self.source, 'small'), 0750)
+    os.symlink('dir', os.path.join(self.source, 'dir_link'))
+    os.symlink('missing', os.path.join(self.source, 'dir', 'broken_link'))
+    os.mkfifo(os.path.join(self.source, 'fifo'))
+    os.chmod(os.path.join(self.source, 'dir', 'subdir'), 0500)
+
+  def tearDown(self):
+    path_util.remove(self.temp_directory)
+
+  def get_modes(self, path):
+    (directories, files) = path_util.recursive_ls(path)
+    return dict(
+      (path_util.get_relative_path(path, entry), os.lstat(entry).st_mode)
+      for entry in directories + files
+    )
+
+  def check_copy(self, dest):
+    os.remove(os.path.join(self.source, 'fifo'))  # Not copied
+    self.assertEqual(path_util.hash_directory(dest), path_util.hash_directory(self.source))
+    self.assertEqual(self.get_modes(dest), self.get_modes(self.source))
+
+  def test_strategies(self):
+    for strategies in [None, ['copy_file_range'], ['sendfile'], ['read_write']]:
+      dest = os.path.join(self.temp_directory, 'dest-%s' % strategies)
+      copier = copy_util.TreeCopier(strategies)
+      copier.copy(self.source, dest)
+      self.assertEqual(sum(copier.counts.values()), 3)
+      if strategies is not None:
+        # Fall back to read_write if the strategy isn't supported here.
+        self.assertIn(copier.counts.keys()[0], strategies + ['read_write'])
+    self.check_copy(dest)
+
+  def test_hardlink(self):
+    dest = os.path.join(self.temp_directory, 'dest')
+    self.assertEqual(copy_util.copy(self.source, dest, hardlink=True), {'hardlink': 3})
+    self.check_copy(dest)
+    self.assertEqual(os.stat(os.path.join(dest, 'small')).st_ino, os.stat(os.path.join(self.source, 'small')).st_ino)
+
+  def test_path_util_copy(self):
+    dest = os.path.join(self.temp_directory, 'dest')
+    path_util.copy(self.source, dest)
+    self.check_copy(dest)
+    self.assertFalse(stat.S_ISLNK(os.lstat(os.path.join(dest, 'small')).st_mode))
+    self.assertNotEqual(os.stat(os.path.join(dest, 'small')).st_ino, os.stat(os.path.join(self.source, 'small')).st_ino)
+    # Single files too.
+    path_util.copy(os.path.join(self.source, 'small'), os.path.join(self.temp_directory, 'small'))
+    self.assertEqual(
+      path_util.hash_file_contents(os.path.join(self.temp_directory, 'small')),
+      path_util.hash_file_contents(os.path.join(self.source, 'small')))
+
+  def test_preserve_hardlinks(self):
+    other = os.path.join(self.temp_directory, 'other')
+    os.mkdir(other)
+    os.link(os.path.join(self.source, 'small'), os.path.join(other, 'small'))
+    copier = copy_util.TreeCopier(preserve_hardlinks=True)
+    copier.copy(self.source, os.path.join(self.temp_directory, 'dest'))
+    copier.copy(other, os.path.join(self.temp_directory, 'other_dest'))
+    self.assertEqual(copier.counts['preserved_hardlink'], 1)
+    self.assertEqual(
+      os.stat(os.path.join(self.temp_directory, 'dest', 'small')).st_ino,
+      os.stat(os.path.join(self.temp_directory, 'other_dest', 'small')).st_ino)
+    self.assertNotEqual(
+      os.stat(os.path.join(self.temp_directory, 'dest', 'small')).st_ino,
+      os.stat(os.path.join(self.source, 'small')).st_ino)
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from codalab.lib import path_util
+from codalab.lib.hash_cache import FileHashCache
+
+
+class FileHashCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.bundle_path = os.path.join(self.temp_directory, 'bundle')
+    os.mkdir(self.bundle_path)
+    for i in range(5):
+      self.write_file('file%d' % i, 'contents %d' % i)
+    os.symlink('file0', os.path.join(self.bundle_path, 'link'))
+    self.hash_cache = FileHashCache(os.path.join(self.temp_directory, 'file_hashes.sqlite'))
+    self.hashed_paths = []
+
+  def tearDown(self):
+    self.hash_cache.close()
+    shutil.rmtree(self.temp_directory)
+
+  def write_file(self, name, contents, age=60):
+    path = os.path.join(self.bundle_path, name)
+    with open(path, 'w') as f:
+      f.write(contents)
+    # Files modified just now are not cached. Whole seconds survive being
+    # read back and set again as floats.
+    mtime = int(time.time()) - age
+    os.utime(path, (mtime, mtime))
+
+  def hash_directory(self, **kwargs):
+    self.hashed_paths = []
+    def hash_file_contents(path):
+      self.hashed_paths.append(os.path.basename(path))
+      return original_hash_file_contents(path)
+    original_hash_file_contents = path_util.hash_file_contents
+    with mock.patch('codalab.lib.path_util.hash_file_contents', hash_file_contents):
+      return path_util.hash_directory(self.bundle_path, num_threads=1, hash_cache=self.hash_cache, **kwargs)
+
+  def test_cached_hashes(self):
+    expected_hash = path_util.hash_directory(self.bundle_path)
+    self.assertEqual(self.hash_directory(), expected_hash)
+    self.assertEqual(len(self.hashed_paths), 6)
+    # Only the link is hashed again.
+    self.assertEqual(self.hash_directory(), expected_hash)
+    self.assertEqual(self.hashed_paths, ['link'])
+    # Even with a new cache on the same file.
+    self.hash_cache.close()
+    self.hash_cache = FileHashCache(self.hash_cache.path)
+    self.assertEqual(self.hash_directory(), expected_hash)
+    self.assertEqual(self.hashed_paths, ['link'])
+
+  def test_modified_files(self):
+    self.hash_directory()
+    self.write_file('file1', 'new contents')
+    self.write_file('file2', 'just now', age=0)
+    self.write_file('file5', 'new file')
+    self.assertEqual(self.hash_directory(), path_util.hash_directory(self.bundle_path))
+    self.assertEqual(sorted(self.hashed_paths), ['file1', 'file2', 'file5', 'link'])
+    # file2 was modified too recently to be cached.
+    self.hash_directory()
+    self.assertEqual(sorted(self.hashed_paths), ['file2', 'link'])
+
+  def test_verify(self):
+    self.hash_directory()
+    # Change the contents but not the size or mtime.
+    path = os.path.join(self.bundle_path, 'file3')
+    mtime = os.stat(path).st_mtime
+    self.write_file('file3', 'CONTENTS 3')
+    os.utime(path, (mtime, mtime))
+    expected_hash = path_util.hash_directory(self.bundle_path)
+    self.assertNotEqual(self.hash_directory(), expected_hash)
+    self.assertEqual(self.hash_directory(verify=True), expected_hash)
+    self.assertEqual(len(self.hashed_paths), 6)
+    # The cache has been fixed.
+    self.assertEqual(self.hash_directory(), expected_hash)
+    self.assertEqual(self.hashed_paths, ['link'])
+
+  def test_prune(self):
+    self.hash_directory()
+    os.remove(os.path.join(self.bundle_path, 'file4'))
+    self.hash_cache.close()
+    self.hash_cache = FileHashCache(self.hash_cache.path)
+    self.hash_directory()
+    self.assertEqual(self.hash_cache.prune(), 1)
+    self.assertEqual(self.hash_cache.prune(), 0)
+    self.hash_directory()
+    self.assertEqual(self.hashed_paths, ['link'])
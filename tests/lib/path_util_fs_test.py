@@ -6,6 +6,7 @@ import tempfile
 import unittest
 
 from codalab.lib import path_util
+from worker.file_util import index_contents
 
 
 class PathUtilFSTest(unittest.TestCase):
@@ -77,3 +78,48 @@ class PathUtilFSTest(unittest.TestCase):
     os.symlink(link_target, symlink_path)
     link_hash = path_util.hash_file_contents(symlink_path)
     self.assertEqual(link_hash, expected_hash)
+
+  def test_hash_directory_threads(self):
+    '''
+    Test that hashing files in parallel gives the same hash as hashing them
+    one at a time.
+    '''
+    for i in range(50):
+      with open(os.path.join(self.bundle_path, 'blah', 'file%d' % i), 'w') as fd:
+        fd.write(self.contents * i)
+    os.symlink('foo', os.path.join(self.bundle_path, 'link'))
+    (directories, files) = path_util.recursive_ls(self.bundle_path)
+    self.assertEqual(
+      path_util.hash_files_contents(files, num_threads=4),
+      [path_util.hash_file_contents(path) for path in files])
+    expected_hash = path_util.hash_directory(self.bundle_path, num_threads=1)
+    for num_threads in [2, 4, 100]:
+      self.assertEqual(path_util.hash_directory(self.bundle_path, num_threads=num_threads), expected_hash)
+
+  def test_remove_keeps_shared_file_permissions(self):
+    shared_path = os.path.join(self.temp_directory, 'shared')
+    os.link(self.bundle_files[1], shared_path)
+    os.chmod(shared_path, 0444)
+    os.chmod(os.path.join(self.bundle_path, 'asdf'), 0555)
+    path_util.remove(self.bundle_path)
+    self.assertFalse(os.path.exists(self.bundle_path))
+    self.assertEqual(stat.S_IMODE(os.stat(shared_path).st_mode), 0444)
+
+  def test_scan_path(self):
+    '''
+    Test that scan_path gives the same hash, size and contents index as
+    hash_directory, get_size and index_contents.
+    '''
+    os.symlink('asdf', os.path.join(self.bundle_path, 'dir_link'))
+    os.symlink('missing', os.path.join(self.bundle_path, 'asdf', 'broken_link'))
+    os.chmod(self.bundle_files[1], 0600)
+    for path in [self.bundle_path, self.bundle_files[0], os.path.join(self.bundle_path, 'dir_link')]:
+      dirs_and_files = path_util.recursive_ls(path) if os.path.isdir(path) and not os.path.islink(path) else ([], [path])
+      self.assertEqual(path_util.scan_path(path), (
+        path_util.hash_directory(path, dirs_and_files),
+        path_util.get_size(path, dirs_and_files),
+        index_contents(path),
+      ))
+    self.assertEqual(
+      path_util.scan_path(self.bundle_path, compute_hash=False),
+      (None, path_util.get_size(self.bundle_path), index_contents(self.bundle_path)))
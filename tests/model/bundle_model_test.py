@@ -1,5 +1,6 @@
+from cStringIO import StringIO
 import mock
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select
 from sqlalchemy.engine.reflection import Inspector
 import unittest
 
@@ -7,6 +8,10 @@ from codalab.model.bundle_model import (
   BundleModel,
   db_metadata,
 )
+from codalab.common import State, UsageError
+from codalab.model.tables import bundle as cl_bundle, worksheet_item as cl_worksheet_item
+from codalab.objects.worksheet import Worksheet
+from worker.file_util import restrict_contents_index
 
 
 def metadata_to_dicts(uuid, metadata):
@@ -116,3 +121,392 @@ class BundleModelTest(unittest.TestCase):
       retrieved_bundle = self.model.get_bundle(bundle.uuid)
     self.assertTrue(isinstance(retrieved_bundle, MockBundle))
     self.assertTrue(retrieved_bundle._validate_called)
+
+  def test_bundle_cache(self):
+    get_bundle_subclass_path = 'codalab.model.bundle_model.get_bundle_subclass'
+    with mock.patch(get_bundle_subclass_path, lambda bundle_type: MockBundle), \
+         mock.patch.dict(MockBundle._fields, {'state': State.READY}):
+      bundle = MockBundle()
+      self.model.save_bundle(bundle)
+      self.model.get_bundle(bundle.uuid)
+      self.model.get_bundle(bundle.uuid)
+      stats = self.model.get_bundle_cache_stats()
+      self.assertEqual((stats['size'], stats['hits'], stats['misses']), (1, 1, 1))
+
+      # Another process changes the bundle.
+      with self.engine.begin() as connection:
+        connection.execute(cl_bundle.update().values(version=cl_bundle.c.version + 1))
+      self.model.get_bundle(bundle.uuid)
+      self.model.get_bundle(bundle.uuid)
+      stats = self.model.get_bundle_cache_stats()
+      self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (2, 2, 0.5))
+
+      self.model.delete_bundles([bundle.uuid])
+      self.assertEqual(self.model.get_bundle_cache_stats()['size'], 0)
+      self.assertEqual(self.model.batch_get_bundles(uuid=bundle.uuid), [])
+
+  def test_bundle_search_table(self):
+    self.model.root_user_id = '0'
+    sizes = {'uuid_a': 300, 'uuid_b': 20, 'uuid_c': 1000}
+    for (uuid, size) in sizes.iteritems():
+      self.save_bundle(uuid, metadata={'name': 'name_' + uuid, 'data_size': str(size)})
+
+    search = lambda keywords: self.model.search_bundle_uuids('0', None, keywords)
+    self.assertEqual(search(['size=.sort']), ['uuid_b', 'uuid_a', 'uuid_c'])
+    self.assertEqual(search(['size=.sort-']), ['uuid_c', 'uuid_a', 'uuid_b'])
+    self.assertEqual(search(['size=.sum']), 1320)
+    self.assertEqual(search(['name_uuid_b']), ['uuid_b'])
+    self.assertEqual(search(['name=name_uuid_c']), ['uuid_c'])
+
+    self.model.delete_bundles(['uuid_c'])
+    self.assertEqual(search(['size=.sum']), 320)
+
+  def test_substring_search(self):
+    self.model.root_user_id = '0'
+    descriptions = {'uuid_a': 'Some Baseline', 'uuid_b': 'Better model'}
+    for (uuid, description) in descriptions.iteritems():
+      self.save_bundle(uuid, metadata={'name': 'run_' + uuid, 'description': description})
+
+    search = lambda keywords: sorted(self.model.search_bundle_uuids('0', None, keywords))
+    self.assertEqual(search(['baseline']), ['uuid_a'])
+    self.assertEqual(search(['run_uuid_b']), ['uuid_b'])
+    self.assertEqual(search(['uuid']), ['uuid_a', 'uuid_b'])
+    self.assertEqual(search(['b']), ['uuid_a', 'uuid_b'])  # Too short for the index
+    self.assertEqual(search(['lineSome']), [])
+
+    worksheet = Worksheet({'name': 'my_worksheet', 'owner_id': '0', 'title': None,
+                           'frozen': None, 'items': None, 'tags': []})
+    self.model.new_worksheet(worksheet)
+    search = lambda keywords: [row['uuid'] for row in self.model.search_worksheets('0', keywords)]
+    self.assertEqual(search(['worksh']), [worksheet.uuid])
+    self.model.update_worksheet_metadata(worksheet, {'name': 'renamed'})
+    self.assertEqual(search(['worksh']), [])
+    self.assertEqual(search(['rename']), [worksheet.uuid])
+
+  def test_keyset_pagination(self):
+    self.model.root_user_id = '0'
+    names = [('uuid_1', 'b'), ('uuid_2', 'a'), ('uuid_3', 'b'), ('uuid_4', 'c'), ('uuid_5', 'a')]
+    for (uuid, name) in names:
+      self.save_bundle(uuid, metadata={'name': name})
+
+    def search_all(keywords, limit=2):
+      uuids, token = [], None
+      while True:
+        page = self.model.search_bundle_uuids_page(
+          '0', None, keywords + ['.limit=%d' % limit] + (['.after=' + token] if token else []))
+        uuids.extend(page['uuids'])
+        token = page['next']
+        if token is None:
+          return uuids
+
+    self.assertEqual(search_all([]), ['uuid_1', 'uuid_2', 'uuid_3', 'uuid_4', 'uuid_5'])
+    self.assertEqual(search_all(['name=.sort']), ['uuid_2', 'uuid_5', 'uuid_1', 'uuid_3', 'uuid_4'])
+    self.assertEqual(search_all(['name=.sort-']), ['uuid_4', 'uuid_3', 'uuid_1', 'uuid_5', 'uuid_2'])
+    self.assertRaises(UsageError, self.model.search_bundle_uuids_page, '0', None, ['.after=garbage'])
+
+    # NULL sort values come first in ascending order.
+    for (uuid, data_hash) in [('uuid_6', None), ('uuid_7', '0xb'), ('uuid_8', None), ('uuid_9', '0xa')]:
+      self.save_bundle(uuid, data_hash=data_hash, metadata={'name': 'hashed'})
+    self.assertEqual(search_all(['name=hashed', 'data_hash=.sort'], limit=1), ['uuid_6', 'uuid_8', 'uuid_9', 'uuid_7'])
+    self.assertEqual(search_all(['name=hashed', 'data_hash=.sort-'], limit=1), ['uuid_7', 'uuid_9', 'uuid_8', 'uuid_6'])
+
+    for name in ['ws_b', 'ws_a', 'ws_c']:
+      self.model.new_worksheet(Worksheet({'name': name, 'owner_id': '0', 'title': None,
+                                          'frozen': None, 'items': None, 'tags': []}))
+    page = self.model.search_worksheets_page('0', ['.limit=2'])
+    self.assertEqual([row['name'] for row in page['worksheets']], ['ws_a', 'ws_b'])
+    page = self.model.search_worksheets_page('0', ['.limit=2', '.after=' + page['next']])
+    self.assertEqual([row['name'] for row in page['worksheets']], ['ws_c'])
+    self.assertIsNone(page['next'])
+
+  def test_search_query_cache(self):
+    self.model.root_user_id = '0'
+    for uuid in ['uuid_a', 'uuid_b']:
+      self.save_bundle(uuid, metadata={'name': 'name_' + uuid})
+
+    search = lambda keywords: self.model.search_bundle_uuids('0', None, keywords)
+    self.assertEqual(search(['name=name_uuid_a', '.limit=5']), ['uuid_a'])
+    self.assertEqual(search(['name=name_uuid_b', '.limit=1']), ['uuid_b'])
+    self.assertEqual(search(['name=name_uuid_%']), ['uuid_a', 'uuid_b'])  # LIKE
+    self.assertEqual(search(['name=name_uuid_a,name_uuid_b', 'id=.sort-']), ['uuid_b', 'uuid_a'])
+    self.assertEqual(self.model.query_cache.get_stats()['hits'], 1)
+
+    self.model.slow_query_threshold = 0
+    with mock.patch('sys.stderr', StringIO()) as stderr:
+      self.assertEqual(search(['name=name_uuid_b']), ['uuid_b'])
+    self.assertIn('SLOW QUERY', stderr.getvalue())
+    self.assertIn('Query plan:', stderr.getvalue())
+
+  def test_get_worksheet_items(self):
+    self.model.encode_str = self.model.decode_str = lambda value: value
+    worksheet = Worksheet({'name': 'ws', 'owner_id': '0', 'title': None,
+                           'frozen': None, 'items': None, 'tags': []})
+    self.model.new_worksheet(worksheet)
+    for value in ['a', 'b', 'c']:
+      self.model.add_worksheet_item(worksheet.uuid, (None, None, value, 'markup'))
+    items = self.model.get_worksheet(worksheet.uuid, fetch_items=True).items
+    last_item_id = self.model.get_worksheet(worksheet.uuid, fetch_items=True).last_item_id
+    # Replace the first two items while another one is appended.
+    self.model.add_worksheet_item(worksheet.uuid, (None, None, 'd', 'markup'))
+    self.model.update_worksheet_items(worksheet.uuid, last_item_id, 3, [(None, None, 'x', 'markup'), (None, None, 'y', 'markup')] + items[2:])
+
+    values, token = [], None
+    while True:
+      page = self.model.get_worksheet_items(worksheet.uuid, token, 2)
+      values.extend(item['value'] for item in page['items'])
+      token = page['next']
+      if token is None:
+        break
+    self.assertEqual(values, ['x', 'y', 'c', 'd'])
+    self.assertEqual([item[2] for item in self.model.get_worksheet(worksheet.uuid, fetch_items=True).items], values)
+
+  def test_update_worksheet_items_diff(self):
+    self.model.encode_str = self.model.decode_str = lambda value: value
+    worksheet = Worksheet({'name': 'ws', 'owner_id': '0', 'title': None,
+                           'frozen': None, 'items': None, 'tags': []})
+    self.model.new_worksheet(worksheet)
+    markup = lambda value: (None, None, value, 'markup')
+    for value in ['a', 'b', 'c']:
+      self.model.add_worksheet_item(worksheet.uuid, markup(value))
+    self.model.add_worksheet_item(worksheet.uuid, ('0x1', None, '', 'bundle'))
+    self.model.add_shadow_worksheet_items('0x1', '0x2')
+
+    def get_items():
+      worksheet_info = self.model.get_worksheet(worksheet.uuid, fetch_items=True)
+      with self.engine.begin() as connection:
+        ids = [row.id for row in connection.execute(
+          select([cl_worksheet_item.c.id, cl_worksheet_item.c.sort_key]).order_by(cl_worksheet_item.c.sort_key, cl_worksheet_item.c.id)
+        )]
+      return worksheet_info, ids
+
+    worksheet_info, old_ids = get_items()
+    old_worksheet_info = worksheet_info
+    self.assertEqual([item[0] for item in worksheet_info.items], [None, None, None, '0x1', '0x2'])
+    # Edit a line: only that one is replaced.
+    new_items = [markup('a'), markup('B'), markup('c')] + worksheet_info.items[3:]
+    self.model.update_worksheet_items(worksheet.uuid, worksheet_info.last_item_id, 5, new_items)
+    worksheet_info, ids = get_items()
+    self.assertEqual(worksheet_info.items, new_items)
+    self.assertEqual([ids[0]] + ids[2:4], [old_ids[0]] + old_ids[2:4])
+    self.assertNotIn(old_ids[1], ids)
+    # Insert lines with no room between the keys of their neighbors.
+    stale_worksheet_info = worksheet_info
+    new_items = new_items[:1] + [markup('x'), markup('y')] + new_items[1:]
+    self.model.update_worksheet_items(worksheet.uuid, worksheet_info.last_item_id, 5, new_items)
+    self.assertEqual(get_items()[0].items, new_items)
+    # Concurrent update, which only inserted lines
+    self.assertRaises(UsageError, self.model.update_worksheet_items, worksheet.uuid,
+                      stale_worksheet_info.last_item_id, 5, stale_worksheet_info.items)
+    # Items appended since are fine.
+    self.model.add_worksheet_item(worksheet.uuid, markup('z'))
+    self.model.update_worksheet_items(worksheet.uuid, get_items()[0].last_item_id - 1, 7, new_items)
+    self.assertEqual(get_items()[0].items, new_items + [markup('z')])
+    # Concurrent update, which already replaced 'b'
+    self.assertRaises(UsageError, self.model.update_worksheet_items, worksheet.uuid, old_worksheet_info.last_item_id, 5, [])
+
+  def test_update_worksheet_items_rows_written(self):
+    self.model.encode_str = self.model.decode_str = lambda value: value
+    worksheet = Worksheet({'name': 'ws', 'owner_id': '0', 'title': None,
+                           'frozen': None, 'items': None, 'tags': []})
+    self.model.new_worksheet(worksheet)
+    markup = lambda value: (None, None, value, 'markup')
+    for value in 'abcde':
+      self.model.add_worksheet_item(worksheet.uuid, markup(value))
+
+    rows_written = []
+    def count_rows_written(conn, cursor, statement, parameters, context, executemany):
+      if statement.startswith(('INSERT INTO worksheet_item', 'UPDATE worksheet_item')):
+        rows_written[0] += len(parameters) if executemany else 1
+    event.listen(self.engine, 'before_cursor_execute', count_rows_written)
+
+    def update(new_values):
+      worksheet_info = self.model.get_worksheet(worksheet.uuid, fetch_items=True)
+      new_items = [markup(value) for value in new_values]
+      rows_written[:] = [0]
+      self.model.update_worksheet_items(
+        worksheet.uuid, worksheet_info.last_item_id, len(worksheet_info.items), new_items)
+      self.assertEqual(self.model.get_worksheet(worksheet.uuid, fetch_items=True).items, new_items)
+      return rows_written[0]
+
+    # Only the added line is written, even though the items appended one at a
+    # time leave no room between their sort keys.
+    self.assertEqual(update('abcdef'), 1)
+    self.assertEqual(update('abXcdef'), 1)
+    self.assertEqual(update('abXYcdef'), 1)
+    # Inserting right before that line moves the lines before it down.
+    self.assertEqual(update('abWXYcdef'), 3)
+    # Which leaves room for the next ones.
+    self.assertEqual(update('aZbWXYcdef'), 1)
+    self.assertEqual(update('aZbWXYcdefg'), 1)
+
+  def test_batch_get_bundle_records(self):
+    self.save_bundle('parent')
+    self.save_bundle('child', ['parent'], bundle_type='run', state='created', metadata={
+      'name': 'child', 'job_handle': 'handle', 'last_updated': '12'})
+
+    records = self.model.batch_get_bundle_records(['state'], fetch_dependencies=True, uuid=['child', 'parent'])
+    self.assertEqual([record.uuid for record in records], ['parent', 'child'])
+    self.assertEqual([record.state for record in records], ['my_state', 'created'])
+    self.assertEqual([dep.parent_uuid for dep in records[1].dependencies], ['parent'])
+    self.assertFalse(hasattr(records[1], 'command'))
+    self.assertFalse(hasattr(records[1], 'metadata'))
+    self.assertFalse(hasattr(records[1], '__dict__'))
+
+    [record] = self.model.batch_get_bundle_records([], ['last_updated', 'actions'], uuid='child')
+    self.assertEqual(record.metadata, {'last_updated': 12, 'actions': []})
+
+  def test_disk_used_ledger(self):
+    self.model.default_user_info = {'time_quota': 0, 'disk_quota': 0}
+    self.model.get_user_info('u1')
+    disk_used = lambda: self.model.get_user_info('u1')['disk_used']
+    for (uuid, data_hash) in [('uuid_a', '0xa'), ('uuid_b', '0xb'), ('uuid_c', None)]:
+      self.save_bundle(uuid, owner_id='u1', data_hash=data_hash, metadata={'data_size': 100})
+    self.assertEqual(disk_used(), 200)
+    self.model.remove_data_hash_references(['uuid_a'])
+    self.assertEqual(disk_used(), 100)
+    self.model.delete_bundles(['uuid_a', 'uuid_b', 'uuid_c'])
+    self.assertEqual(disk_used(), 0)
+
+    # Drift gets corrected by reconciliation.
+    self.model.update_user_info({'user_id': 'u1', 'disk_used': 42})
+    self.assertEqual(self.model.reconcile_user_disk_used(dry_run=True), [('u1', 42, 0)])
+    self.assertEqual(disk_used(), 42)
+    self.assertEqual(self.model.reconcile_user_disk_used(['u1']), [('u1', 42, 0)])
+    self.assertEqual(disk_used(), 0)
+    self.assertEqual(self.model.reconcile_user_disk_used(), [])
+
+  def make_bundle(self, uuid, parent_uuids=(), **fields):
+    """
+    Return a MockBundle with the given uuid, dependencies on the given parents
+    and no metadata, except for the given fields.
+    """
+    bundle = MockBundle()
+    bundle._fields = dict(MockBundle._fields, uuid=uuid, metadata={}, dependencies=[
+      {'child_uuid': uuid, 'child_path': parent_uuid, 'parent_uuid': parent_uuid, 'parent_path': ''}
+      for parent_uuid in parent_uuids
+    ])
+    bundle._fields.update(fields)
+    bundle.uuid = uuid
+    return bundle
+
+  def save_bundle(self, uuid, parent_uuids=(), **fields):
+    bundle = self.make_bundle(uuid, parent_uuids, **fields)
+    self.model.save_bundle(bundle)
+    return bundle
+
+  def test_save_bundles(self):
+    self.model.root_user_id = '0'
+    self.save_bundle('a')
+    bundles = []
+    for (uuid, parent_uuids) in [('a', []), ('b', ['a']), ('c', ['b'])]:
+      bundles.append(self.make_bundle(uuid, parent_uuids, metadata={'name': 'bundle_' + uuid}))
+    self.model.INSERT_CHUNK_SIZE = 2  # Several statements for the search tokens
+    self.model.save_bundles(bundles)
+
+    self.assertFalse(hasattr(bundles[0], 'id'))  # Already existed
+    self.assertEqual(self.model.get_bundle_names(['b', 'c']), {'b': 'bundle_b', 'c': 'bundle_c'})
+    self.assertEqual(sorted(self.model.search_bundle_uuids('0', None, ['bundle_'])), ['b', 'c'])
+    self.assertEqual(self.model.get_ancestors(['c']), {'a': 2, 'b': 1})
+    with self.engine.begin() as connection:
+      ids = dict(connection.execute(select([cl_bundle.c.uuid, cl_bundle.c.id])).fetchall())
+    self.assertEqual((bundles[1].id, bundles[2].id), (ids['b'], ids['c']))
+
+  def test_events_log_rollups(self):
+    self.model.update_events_log('1', 'alice', 'ls', [], start_time=0)
+    self.model.update_events_log('1', 'alice', 'cat', ['0x' + '1' * 32])
+    self.model.update_events_log('2', 'bob', 'ls', [])
+    for _ in range(3):
+      self.model.update_events_log(None, None, 'ls', [])
+    counts = lambda field, **query_info: [
+      tuple(row)[:2] for row in self.model.get_events_log_info(dict(query_info, group_by=field), None, None)['counts']
+    ]
+    self.assertEqual(counts('user'), [(None, 3), ('alice', 2), ('bob', 1)])
+    self.assertEqual(counts('command', count=True), [('ls', 5), ('cat', 1)])
+    self.assertEqual(counts('command', date='1970-01-01'), [])
+    self.assertEqual(counts('user', command='cat', count=True), [('alice', 1)])  # Not in the rollups
+    self.assertEqual(counts('uuid', count=True), [(None, 5), ('0x' + '1' * 32, 1)])
+    rows = self.model.get_events_log_info({'group_by': 'user', 'user': 'alice'}, None, None)['counts']
+    self.assertGreater(rows[0].duration, 1000)
+
+  def test_bundle_contents_index(self):
+    self.save_bundle('a')
+    entry = lambda name, **kwargs: dict({'name': name, 'type': 'file', 'size': 1, 'perm': 0644}, **kwargs)
+    index = entry('a', type='directory', contents=[
+      entry('d', type='directory', contents=[entry('x'), entry('y', type='link', link='../z')]),
+      entry('d-e', type='directory', contents=[]),
+      entry('z'),
+    ])
+    with mock.patch('codalab.model.contents_index.CHUNK_SIZE', 2):
+      self.model.update_bundle_contents_index('a', index)
+    self.assertEqual(self.model.get_bundle_contents_index('a'), index)
+    self.assertIsNone(self.model.get_bundle_contents_index('b'))
+    for path in ['', 'd', 'd/x', 'd-e', 'z', 'z/x', 'w']:
+      for depth in [0, 1, 2, None]:
+        self.assertEqual(self.model.get_bundle_contents_target_info('a', path, depth),
+                         restrict_contents_index(index, path, depth))
+    self.assertRaises(UsageError, self.model.update_bundle_contents_index, 'a', entry('b'))
+    self.model.delete_bundles(['a'])
+    self.assertIsNone(self.model.get_bundle_contents_index('a'))
+
+  def test_bundle_contents_deltas(self):
+    self.save_bundle('a')
+    entry = lambda name, **kwargs: dict({'name': name, 'type': 'file', 'size': 1, 'perm': 0644}, **kwargs)
+    delta = lambda action, path, **kwargs: dict({'action': action, 'path': path, 'type': 'file', 'size': 1, 'perm': 0644}, **kwargs)
+    self.model.add_bundle_contents_deltas('a', [delta('add', '', type='directory'), delta('add', 'd', type='directory')])
+    self.model.add_bundle_contents_deltas('a', [delta('add', 'd/x'), delta('add', 'z')])
+    self.assertEqual(self.model.get_bundle_contents_index('a'), entry('a', type='directory', contents=[
+      entry('d', type='directory', contents=[entry('x')]), entry('z'),
+    ]))
+    self.model.merge_bundle_contents_deltas('a')
+    self.model.add_bundle_contents_deltas('a', [delta('modify', 'z', size=2), delta('remove', 'd')])
+    expected = entry('a', type='directory', contents=[entry('z', size=2)])
+    self.assertEqual(self.model.get_bundle_contents_target_info('a', '', 1), expected)
+    self.model.merge_bundle_contents_deltas('a')
+    self.assertEqual(self.model.get_bundle_contents_index('a'), expected)
+    self.assertIsNone(self.model.get_bundle_contents_target_info('a', 'd/x', 0))  # Removed with d
+    self.assertRaises(UsageError, self.model.add_bundle_contents_deltas, 'a', [delta('move', 'z')])
+
+  def test_provenance_graph(self):
+    # a -> b -> c -> d, and a -> d
+    self.save_bundle('a')
+    self.save_bundle('b', ['a'])
+    self.save_bundle('c', ['b'])
+    self.save_bundle('d', ['c', 'a'])
+
+    self.assertEqual(self.model.get_descendants(['a']), {'b': 1, 'c': 2, 'd': 1})
+    self.assertEqual(self.model.get_descendants(['b'], depth=1), {'c': 1})
+    self.assertEqual(self.model.get_ancestors(['d']), {'a': 1, 'b': 2, 'c': 1})
+    self.assertEqual(self.model.get_ancestors(['c', 'd'], depth=1), {'a': 1, 'b': 1, 'c': 1})
+    self.assertEqual(self.model.get_self_and_descendants(['b'], depth=10), ['b', 'c', 'd'])
+
+    subgraph = self.model.get_provenance_subgraph(['c'], 1)
+    self.assertEqual(subgraph['ancestors'], {'b': 1})
+    self.assertEqual(subgraph['descendants'], {'d': 1})
+    self.assertEqual(sorted((dep['parent_uuid'], dep['child_uuid']) for dep in subgraph['dependencies']),
+                     [('b', 'c'), ('c', 'd')])
+
+    # Deleting b disconnects it from a, but c still records its dependency on b.
+    self.model.delete_bundles(['b'])
+    self.assertEqual(self.model.get_descendants(['a']), {'d': 1})
+    self.assertEqual(self.model.get_descendants(['b']), {'c': 1, 'd': 2})
+    self.assertEqual(self.model.get_ancestors(['d']), {'a': 1, 'b': 2, 'c': 1})
+
+  def test_delete_bundles_chunked(self):
+    # a -> b -> c, and a -> d
+    self.save_bundle('a')
+    self.save_bundle('b', ['a'])
+    self.save_bundle('c', ['b'])
+    self.save_bundle('d', ['a'])
+    counts = self.model.count_descendants(['a', 'b', 'c', 'd'])
+    self.assertEqual(counts, {'a': 3, 'b': 1, 'c': 0, 'd': 0})
+
+    # Deleting descendants first, one bundle per transaction, leaves a
+    # consistent state after every chunk.
+    order = sorted(counts, key=lambda uuid: counts[uuid])
+    self.assertEqual(order[-2:], ['b', 'a'])
+    with mock.patch.object(BundleModel, 'DELETE_CHUNK_SIZE', 1):
+      self.assertEqual(self.model.get_host_worksheet_uuids(order), dict((uuid, []) for uuid in order))
+      self.model.delete_bundles(order[:2])
+      self.assertEqual(self.model.get_descendants(['a']), {'b': 1})
+      self.model.delete_bundles(order[2:])
+    self.assertEqual(self.model.batch_get_bundles(uuid=order), [])
@@ -0,0 +1,30 @@
+import threading
+import unittest
+
+from codalab.model.events_log_writer import EventsLogWriter
+
+
+class MockModel(object):
+  def __init__(self):
+    self.batches = []
+    self.lock = threading.Lock()
+
+  def insert_events(self, events):
+    with self.lock:
+      self.batches.append(list(events))
+
+
+class EventsLogWriterTest(unittest.TestCase):
+  def test_batches_and_close(self):
+    model = MockModel()
+    writer = EventsLogWriter(model, flush_interval=60, batch_size=3, max_queue_size=2)
+    for i in range(7):
+      writer.add({'id': i})
+    writer.close()
+    # Full batches are written right away, the rest on close.
+    self.assertEqual([event['id'] for batch in model.batches for event in batch], range(7))
+    self.assertTrue(all(len(batch) <= 3 for batch in model.batches))
+
+    # After closing, events are written synchronously.
+    writer.add({'id': 7})
+    self.assertEqual(model.batches[-1], [{'id': 7}])
@@ -0,0 +1,63 @@
+import unittest
+
+from sqlalchemy import create_engine
+
+from codalab.common import UsageError
+from codalab.model.bundle_model import BundleModel
+from codalab.model.instrumentation import Histogram, ModelInstrumentation, record_request
+
+
+class HistogramTest(unittest.TestCase):
+  def test_percentiles(self):
+    histogram = Histogram()
+    self.assertIsNone(histogram.percentile(0.5))
+    for value in [0.0005] * 90 + [0.003] * 9 + [1.5]:
+      histogram.add(value)
+    stats = histogram.to_dict()
+    self.assertEqual(stats['count'], 100)
+    self.assertEqual(stats['max'], 1.5)
+    self.assertEqual(stats['p50'], 0.001)  # < 1ms
+    self.assertEqual(stats['p99'], 0.004)  # [2, 4) ms
+    self.assertEqual(histogram.percentile(1.0), 1.5)
+    self.assertEqual(sum(stats['buckets']), 100)
+
+
+class ModelInstrumentationTest(unittest.TestCase):
+  def setUp(self):
+    self.model = BundleModel(create_engine('sqlite://', strategy='threadlocal'), {})
+    self.instrumentation = ModelInstrumentation()
+    self.instrumentation.instrument(self.model)
+
+  def test_not_instrumented(self):
+    model = BundleModel(create_engine('sqlite://', strategy='threadlocal'), {})
+    with record_request(model, 'request'):
+      self.assertEqual(model.batch_get_groups(name='public')[0]['name'], 'public')
+
+  def test_stats(self):
+    with record_request(self.model, 'request'):
+      self.model.batch_get_groups(name='public')
+      self.model.get_group_bundle_permission('0x1', '0x2')  # Calls get_group_permission
+      with self.assertRaises(UsageError):
+        self.model.get_worksheet('0x3', fetch_items=False)
+    self.model.batch_get_groups()  # Not in the request
+
+    stats = self.instrumentation.get_stats()
+    methods = stats['methods']
+    self.assertEqual(methods['batch_get_groups']['calls'], 2)
+    self.assertEqual(methods['batch_get_groups']['rows'], 2)
+    self.assertEqual(methods['batch_get_groups']['statements'], 2)
+    self.assertEqual(methods['get_worksheet']['errors'], 1)
+    self.assertEqual(methods['batch_get_worksheets']['calls'], 1)
+    self.assertEqual(methods['get_group_permission']['calls'], 1)
+
+    request = stats['requests']['request']
+    self.assertEqual(request['calls'], 1)
+    self.assertEqual(request['errors'], 0)
+    self.assertEqual(request['statements'], 3)
+    # Only the calls made by the request itself.
+    self.assertEqual(sorted(request['methods']), ['batch_get_groups', 'get_group_bundle_permission', 'get_worksheet'])
+    self.assertEqual(request['methods']['batch_get_groups']['calls'], 1)
+    self.assertEqual(request['methods']['get_group_bundle_permission']['statements'], 1)
+
+    self.instrumentation.reset()
+    self.assertEqual(self.instrumentation.get_stats()['methods'], {})
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from codalab.common import UsageError
+from codalab.model.sqlite_model import SQLiteModel
+from codalab.model.tables import db_metadata, group as cl_group
+
+
+class SQLiteModelReadEngineTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.model = SQLiteModel(
+      'sqlite:///' + os.path.join(self.temp_dir, 'bundle.db'), {},
+      read_engine_url='sqlite:///' + os.path.join(self.temp_dir, 'replica.db'))
+    # The replica has the schema but never gets any of the writes.
+    db_metadata.create_all(self.model.read_engine)
+
+  def tearDown(self):
+    self.model = None
+    shutil.rmtree(self.temp_dir)
+
+  def get_group_names(self):
+    return sorted(group['name'] for group in self.model.batch_get_groups())
+
+  def test_bad_read_engine_url(self):
+    with self.assertRaises(UsageError):
+      SQLiteModel('sqlite:///' + os.path.join(self.temp_dir, 'bundle.db'), {}, read_engine_url='mysql://replica')
+
+  def test_read_your_writes(self):
+    with self.model.request_scope():
+      self.assertIs(self.model.get_read_engine(), self.model.read_engine)
+      self.assertEqual(self.get_group_names(), [])
+      self.model.create_group({'uuid': '0x1', 'name': 'group1', 'user_defined': True, 'owner_id': '0'})
+      # Reads stick to the primary engine right after the write...
+      self.assertIs(self.model.get_read_engine(), self.model.engine)
+      self.assertEqual(self.get_group_names(), ['group1', 'public'])
+      # ...until the window is over.
+      with mock.patch('time.time', return_value=self.model._local.last_write_time + self.model.read_your_writes_window):
+        self.assertEqual(self.get_group_names(), [])
+
+    # Writes made by a previous request don't count.
+    with self.model.request_scope():
+      self.assertEqual(self.get_group_names(), [])
+
+  def test_no_read_engine(self):
+    self.model.read_engine = None
+    with self.model.request_scope():
+      self.assertIs(self.model.get_read_engine(), self.model.engine)
+      self.assertEqual(self.get_group_names(), ['public'])
+
+
+class UnitOfWorkSQLiteModel(SQLiteModel):
+  UNITS_OF_WORK = True
+
+
+class SQLiteModelUnitOfWorkTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.engine_url = 'sqlite:///' + os.path.join(self.temp_dir, 'bundle.db')
+    self.model = UnitOfWorkSQLiteModel(self.engine_url, {})
+    self.counts = {'checkout': 0, 'commit': 0}
+    event.listen(self.model.engine.pool, 'checkout', lambda *args: self.count('checkout'))
+    event.listen(self.model.engine, 'commit', lambda *args: self.count('commit'))
+
+  def tearDown(self):
+    self.model = None
+    shutil.rmtree(self.temp_dir)
+
+  def count(self, name):
+    self.counts[name] += 1
+
+  def create_group(self, uuid):
+    self.model.create_group({'uuid': uuid, 'name': 'group' + uuid, 'user_defined': True, 'owner_id': '0'})
+
+  def get_committed_group_uuids(self):
+    # Another model sees only what was committed.
+    model = SQLiteModel(self.engine_url, {})
+    return sorted(group['uuid'] for group in model.batch_get_groups(user_defined=True))
+
+  def test_one_transaction(self):
+    with self.model.request_scope():
+      self.create_group('0x1')
+      self.create_group('0x2')
+      self.assertEqual(len(self.model.batch_get_groups(user_defined=True)), 2)
+      self.model.add_user_in_group('0', '0x1', True)
+      self.assertEqual(self.counts, {'checkout': 1, 'commit': 0})
+    self.assertEqual(self.counts, {'checkout': 1, 'commit': 1})
+    self.assertEqual(self.get_committed_group_uuids(), ['0x1', '0x2'])
+
+  def test_failed_call(self):
+    with self.model.request_scope():
+      self.create_group('0x1')
+      # Only the failed call is undone.
+      with self.assertRaises(IntegrityError):
+        with self.model._begin() as connection:
+          connection.execute(cl_group.insert().values({'uuid': '0x2', 'name': 'group0x2', 'user_defined': True}))
+          self.create_group('0x1')
+      self.create_group('0x3')
+    self.assertEqual(self.get_committed_group_uuids(), ['0x1', '0x3'])
+
+  def test_failed_block(self):
+    with self.assertRaises(UsageError):
+      with self.model.request_scope():
+        self.create_group('0x1')
+        raise UsageError('Failed')
+    self.assertEqual(self.get_committed_group_uuids(), [])
+
+  def test_not_unit_of_work(self):
+    with self.model.request_scope(unit_of_work=False):
+      self.create_group('0x1')
+      self.assertEqual(self.get_committed_group_uuids(), ['0x1'])
@@ -0,0 +1,67 @@
+import mock
+import unittest
+
+from sqlalchemy import create_engine
+
+from codalab.common import PermissionError
+from codalab.model.bundle_model import BundleModel
+from codalab.model.tables import (
+  GROUP_OBJECT_PERMISSION_ALL,
+  GROUP_OBJECT_PERMISSION_NONE,
+  GROUP_OBJECT_PERMISSION_READ,
+)
+from codalab.objects.permission import (
+  check_worksheet_has_all_permission,
+  get_permission_resolver,
+  permission_scope,
+)
+from codalab.objects.worksheet import Worksheet
+from codalab.server.auth import User
+
+
+class PermissionResolverTest(unittest.TestCase):
+  def setUp(self):
+    self.model = BundleModel(create_engine('sqlite://', strategy='threadlocal'), {})
+    self.model.root_user_id = '0'
+    self.model.public_group_uuid = self.model.batch_get_groups(name='public')[0]['uuid']
+    self.worksheets = []
+    for name in ['private', 'public']:
+      worksheet = Worksheet({'name': name, 'owner_id': '1', 'title': None,
+                             'frozen': None, 'items': None, 'tags': []})
+      self.model.new_worksheet(worksheet)
+      self.worksheets.append(worksheet)
+    self.model.add_worksheet_permission(self.model.public_group_uuid, self.worksheets[1].uuid,
+                                        GROUP_OBJECT_PERMISSION_READ)
+
+  def test_permissions(self):
+    uuids = [worksheet.uuid for worksheet in self.worksheets]
+    for (user, expected) in [
+        (User('root', '0'), [GROUP_OBJECT_PERMISSION_ALL, GROUP_OBJECT_PERMISSION_ALL]),
+        (User('owner', '1'), [GROUP_OBJECT_PERMISSION_ALL, GROUP_OBJECT_PERMISSION_ALL]),
+        (User('other', '2'), [GROUP_OBJECT_PERMISSION_NONE, GROUP_OBJECT_PERMISSION_READ]),
+        (None, [GROUP_OBJECT_PERMISSION_NONE, GROUP_OBJECT_PERMISSION_READ])]:
+      permissions = get_permission_resolver(self.model, user).get_worksheet_permissions(uuids)
+      self.assertEqual([permissions[uuid] for uuid in uuids], expected)
+
+    with self.assertRaises(PermissionError):
+      check_worksheet_has_all_permission(self.model, User('other', '2'), self.worksheets[1])
+
+  def test_memoization(self):
+    uuids = [worksheet.uuid for worksheet in self.worksheets]
+    user = User('other', '2')
+    with permission_scope():
+      resolver = get_permission_resolver(self.model, user)
+      self.assertIs(get_permission_resolver(self.model, user), resolver)
+      with mock.patch.object(self.model, 'batch_get_group_permissions',
+                             wraps=self.model.batch_get_group_permissions) as batch_get, \
+           mock.patch.object(self.model, '_get_user_groups',
+                             wraps=self.model._get_user_groups) as get_groups:
+        resolver.get_worksheet_permissions(uuids)
+        resolver.get_worksheet_permissions(uuids[1:])
+        resolver.get_group_worksheet_permissions(uuids)
+        self.assertEqual(batch_get.call_count, 1)
+        self.assertEqual(get_groups.call_count, 1)
+        resolver.invalidate()
+        resolver.get_worksheet_permissions(uuids)
+        self.assertEqual(batch_get.call_count, 2)
+    self.assertIsNot(get_permission_resolver(self.model, user), resolver)
@@ -0,0 +1,93 @@
+from cStringIO import StringIO
+import os
+import shutil
+import tempfile
+import unittest
+import wsgiref.util
+
+from bottle import abort, Bottle, HTTPResponse, redirect
+
+from codalab.common import UsageError
+from codalab.model.sqlite_model import SQLiteModel
+from codalab.server.rest_server import ErrorAdapter, SaveEnvironmentPlugin
+from tests.model.sqlite_model_test import UnitOfWorkSQLiteModel
+
+
+class FakeManager(object):
+  def __init__(self, model):
+    self._model = model
+    self.config = {}
+
+  def model(self):
+    return self._model
+
+  def worker_model(self):
+    return None
+
+  upload_manager = download_manager = bundle_store = emailer = worker_model
+
+
+class SaveEnvironmentPluginTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.engine_url = 'sqlite:///' + os.path.join(self.temp_dir, 'bundle.db')
+    self.model = UnitOfWorkSQLiteModel(self.engine_url, {})
+    # Installed in the same order as in run_rest_server.
+    self.app = Bottle(catchall=False)
+    self.app.install(SaveEnvironmentPlugin(FakeManager(self.model)))
+    self.app.install(ErrorAdapter())
+
+  def tearDown(self):
+    self.model = None
+    shutil.rmtree(self.temp_dir)
+
+  def create_group(self, uuid):
+    self.model.create_group({'uuid': uuid, 'name': 'group' + uuid, 'user_defined': True, 'owner_id': '0'})
+
+  def get_committed_group_uuids(self):
+    model = SQLiteModel(self.engine_url, {})
+    return sorted(group['uuid'] for group in model.batch_get_groups(user_defined=True))
+
+  def request(self, path):
+    environ = {'PATH_INFO': path, 'wsgi.errors': StringIO()}
+    wsgiref.util.setup_testing_defaults(environ)
+    statuses = []
+    self.app(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    return int(statuses[0].split()[0])
+
+  def test_unit_of_work(self):
+    @self.app.get('/ok')
+    def ok():
+      self.create_group('0x1')
+      return {}
+
+    @self.app.get('/redirect')
+    def do_redirect():
+      self.create_group('0x2')
+      redirect('/ok')
+
+    @self.app.get('/usage_error')
+    def usage_error():
+      self.create_group('0x3')
+      raise UsageError('Failed')
+
+    @self.app.get('/internal_error')
+    def internal_error():
+      self.create_group('0x4')
+      raise ValueError('Failed')
+
+    @self.app.get('/abort')
+    def do_abort():
+      self.create_group('0x5')
+      abort(403, 'Failed')
+
+    @self.app.get('/error_response')
+    def error_response():
+      self.create_group('0x6')
+      return HTTPResponse('Failed', status=400)
+
+    self.assertEqual([self.request(path) for path in [
+      '/ok', '/redirect', '/usage_error', '/internal_error', '/abort', '/error_response',
+    ]], [200, 302, 400, 500, 403, 400])
+    # Only the successful requests and redirects keep their writes.
+    self.assertEqual(self.get_committed_group_uuids(), ['0x1', '0x2'])
@@ -2,7 +2,7 @@ import os
 import tempfile
 import unittest
 
-from worker.file_util import gzip_file, gzip_string, remove_path, tar_gzip_directory, un_gzip_stream, un_gzip_string, un_tar_directory
+from worker.file_util import ContentsIndexTracker, gzip_file, gzip_string, remove_path, tar_gzip_directory, un_gzip_stream, un_gzip_string, un_tar_directory
 
 
 class FileUtilTest(unittest.TestCase):
@@ -43,4 +43,22 @@ class FileUtilTest(unittest.TestCase):
 
     def test_gzip_string(self):
         self.assertEqual(un_gzip_string(gzip_string('contents')), 'contents')
-    
\ No newline at end of file
+    
+
+    def test_contents_index_tracker(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: remove_path(dir))
+        tracker = ContentsIndexTracker(dir)
+        self.assertEqual([(delta['action'], delta['path']) for delta in tracker.get_deltas()], [('add', '')])
+        os.mkdir(os.path.join(dir, 'd'))
+        with open(os.path.join(dir, 'd', 'f'), 'w') as f:
+            f.write('contents')
+        deltas = tracker.get_deltas()
+        self.assertIn({'action': 'add', 'path': 'd/f', 'type': 'file', 'size': 8, 'perm': deltas[-1]['perm']}, deltas)
+        self.assertEqual(tracker.get_deltas(), [])
+        remove_path(os.path.join(dir, 'd'))
+        self.assertEqual([delta['path'] for delta in tracker.get_deltas() if delta['action'] == 'remove'],
+                         ['d', 'd/f'])
+        os.symlink('missing', os.path.join(dir, 'link'))
+        self.assertEqual([(delta['type'], delta['link']) for delta in tracker.get_deltas() if delta['path'] == 'link'],
+                         [('link', 'missing')])
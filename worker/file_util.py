@@ -4,6 +4,7 @@ from cStringIO import StringIO
 import gzip
 import os
 import shutil
+import stat
 import subprocess
 import tarfile
 import zlib
@@ -81,6 +82,63 @@ def restrict_contents_index(index, path, depth=None):
     return index
 
 
+class ContentsIndexTracker(object):
+    """
+    Tracks the changes to the contents of the given path (e.g. the directory
+    of a running bundle) as contents index deltas, in the format of
+    codalab.model.contents_index.delta_to_entry.
+
+    Each call to get_deltas() lstats everything under the path and returns the
+    changes since the previous call, so that the index can be kept up to date
+    without sending it whole.
+    """
+    def __init__(self, path):
+        self._path = path
+        # Relative path => (index fields, modification time) when last seen
+        self._seen = {}
+
+    def get_deltas(self):
+        current = {}
+        stack = ['']
+        while stack:
+            relative_path = stack.pop()
+            full_path = os.path.join(self._path, relative_path) if relative_path else self._path
+            try:
+                entry_stat = os.lstat(full_path)
+            except OSError:
+                continue  # Removed while we were looking.
+            fields = {'size': entry_stat.st_size, 'perm': entry_stat.st_mode & 0777}
+            if stat.S_ISLNK(entry_stat.st_mode):
+                fields['type'] = 'link'
+                try:
+                    fields['link'] = os.readlink(full_path)
+                except OSError:
+                    continue
+            elif stat.S_ISREG(entry_stat.st_mode):
+                fields['type'] = 'file'
+            elif stat.S_ISDIR(entry_stat.st_mode):
+                fields['type'] = 'directory'
+                try:
+                    file_names = os.listdir(full_path)
+                except OSError:
+                    file_names = []
+                stack.extend(os.path.join(relative_path, file_name) for file_name in file_names)
+            else:
+                continue
+            current[relative_path] = (fields, entry_stat.st_mtime)
+
+        deltas = []
+        for relative_path, (fields, mtime) in sorted(current.iteritems()):
+            if relative_path not in self._seen:
+                deltas.append(dict(fields, action='add', path=relative_path))
+            elif self._seen[relative_path] != (fields, mtime):
+                deltas.append(dict(fields, action='modify', path=relative_path))
+        for relative_path in sorted(set(self._seen) - set(current)):
+            deltas.append({'action': 'remove', 'path': relative_path})
+        self._seen = current
+        return deltas
+
+
 def tar_gzip_directory(directory_path, follow_symlinks=False,
                        exclude_patterns=[], exclude_names=[]):
     """